@@ -19,7 +19,8 @@ CREATE TABLE users (
     password_hash VARCHAR(255) NOT NULL,
     can_login BOOLEAN NOT NULL DEFAULT TRUE,
     can_use_ai BOOLEAN NOT NULL DEFAULT TRUE,
-    is_admin BOOLEAN NOT NULL DEFAULT FALSE
+    is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+    statement_timeout_seconds INTEGER DEFAULT NULL     -- NULL: use the server default
 );
 
 CREATE TABLE teaches (
@@ -33,6 +34,8 @@ CREATE TABLE datasets (
     id SERIAL PRIMARY KEY,
     name VARCHAR(255) NOT NULL,
     dataset TEXT NOT NULL DEFAULT '-- No dataset provided',
+    statements TEXT[] DEFAULT NULL,         -- dataset split into statements, in order
+    content_hash CHAR(64) DEFAULT NULL,     -- SHA-256 of the statements
     is_ai_generated BOOLEAN NOT NULL DEFAULT FALSE
 );
 
@@ -75,6 +78,9 @@ CREATE TABLE queries (
     query TEXT NOT NULL,
     success BOOLEAN NOT NULL,
     result TEXT DEFAULT NULL,
+    result_data BYTEA DEFAULT NULL,     -- compressed rows, for queries returning a dataset
+    result_rows INTEGER DEFAULT NULL,   -- number of rows returned, for queries returning a dataset
+    error_position INTEGER DEFAULT NULL,    -- position of the error in the query (1 is the first character), for failed queries, if known
     ts TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
@@ -89,4 +95,14 @@ CREATE TABLE messages (
     feedback_ts TIMESTAMP DEFAULT NULL
 );
 
-COMMIT;
\ No newline at end of file
+-- Cached LLM answers, by prompt kind and normalized query and error (see server/llm/_cache.py)
+CREATE TABLE llm_answers (
+    key CHAR(64) PRIMARY KEY,
+    kind VARCHAR(255) NOT NULL,
+    answer TEXT NOT NULL,
+    creation_ts TIMESTAMP NOT NULL DEFAULT NOW(),
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX ON llm_answers(creation_ts);
+
+COMMIT;
@@ -0,0 +1,30 @@
+-- Upgrades the schema of an existing deployment to the one created by 01-schema.sql.
+-- Init scripts only run on an empty database: run this once after upgrading the server (`make migrate`).
+-- Safe to run more than once.
+
+BEGIN;
+
+SET search_path TO lensql;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS statement_timeout_seconds INTEGER DEFAULT NULL;
+
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS statements TEXT[] DEFAULT NULL;
+ALTER TABLE datasets ADD COLUMN IF NOT EXISTS content_hash CHAR(64) DEFAULT NULL;
+
+ALTER TABLE queries ADD COLUMN IF NOT EXISTS result_data BYTEA DEFAULT NULL;
+ALTER TABLE queries ADD COLUMN IF NOT EXISTS result_rows INTEGER DEFAULT NULL;
+ALTER TABLE queries ADD COLUMN IF NOT EXISTS error_position INTEGER DEFAULT NULL;
+
+CREATE TABLE IF NOT EXISTS llm_answers (
+    key CHAR(64) PRIMARY KEY,
+    kind VARCHAR(255) NOT NULL,
+    answer TEXT NOT NULL,
+    creation_ts TIMESTAMP NOT NULL DEFAULT NOW(),
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS llm_answers_creation_ts_idx ON llm_answers(creation_ts);
+
+-- Only granted by the default privileges of the schema if this script is run by postgres
+GRANT ALL ON llm_answers TO lensql;
+
+COMMIT;
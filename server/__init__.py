@@ -1,2 +1,2 @@
 from .api import create_app 
-from .db.users import start_cleanup_thread
\ No newline at end of file
+from .db.users import start_expiry_scheduler
\ No newline at end of file
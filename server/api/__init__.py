@@ -29,6 +29,7 @@ def create_app() -> Flask:
     from .datasets import dataset_bp
     from .exercises import exercise_bp
     from .messages import message_bp
+    from .metrics import metrics_bp
     from .queries import query_bp
     from .users import user_bp
 
@@ -37,12 +38,13 @@ def create_app() -> Flask:
     app.register_blueprint(dataset_bp, url_prefix='/datasets')
     app.register_blueprint(exercise_bp, url_prefix='/exercises')
     app.register_blueprint(message_bp, url_prefix='/messages')
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
     app.register_blueprint(query_bp, url_prefix='/queries')
     app.register_blueprint(user_bp, url_prefix='/users')
 
-    # Run cleanup thread
+    # Close idle connections
     if os.getenv('GUNICORN_WORKER_ID', '0') == '0':
-        db.users.start_cleanup_thread()
+        db.users.start_expiry_scheduler()
 
 
     return app
@@ -23,6 +23,9 @@ def login():
     access_token = create_access_token(identity=username, expires_delta=timedelta(minutes=15))
     refresh_token = create_refresh_token(identity=username, expires_delta=timedelta(days=7))
 
+    # Open the user's database connection while the client loads the page
+    db.users.prewarm(username)
+
     return responses.response(True, access_token=access_token, refresh_token=refresh_token)
 
 @auth_bp.route('/refresh', methods=['POST'])
@@ -32,4 +35,6 @@ def refresh():
     current_user = get_jwt_identity()
     access_token = create_access_token(identity=current_user, expires_delta=timedelta(minutes=15))
 
+    db.users.prewarm(current_user)
+
     return responses.response(True, access_token=access_token)
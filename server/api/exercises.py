@@ -115,18 +115,36 @@ def init_dataset():
     username = get_jwt_identity()
     data = request.get_json()
     exercise_id = data['exercise_id']
+    force = data.get('force', False)
 
-    dataset = db.admin.exercises.get_dataset(exercise_id)
+    statements, content_hash = db.admin.exercises.get_dataset_statements(exercise_id)
+
+    token = db.users.CancelToken()
 
     def generate_results() -> Iterable[str]:
-        for query_result in db.users.queries.execute(username=username, query_str=dataset, strip_comments=False):
+        for query_result in db.users.datasets.init(username=username, statements=statements, content_hash=content_hash, force=force, token=token):
+            if query_result.type == 'queue':
+                yield json.dumps({
+                    'type': query_result.type,
+                    'position': query_result.position,
+                }) + '\n'
+                continue
+
+            if query_result.type == 'rejected':
+                yield json.dumps({
+                    'type': query_result.type,
+                    'message': query_result.result,
+                }) + '\n'
+                continue
+
             yield json.dumps({
                 'success': query_result.success,
                 'builtin': True,
                 'query': query_result.query,
                 'type': query_result.type,
                 'data': query_result.result,
+                'truncated': query_result.truncated,
                 'id': None,
             }) + '\n'  # Important: one JSON object per line
 
-    return responses.streaming_response(generate_results())
+    return responses.streaming_response(generate_results(), on_disconnect=token.cancel)
@@ -1,6 +1,8 @@
 '''This module handles message-related endpoints for the API.'''
 
 from flask import Blueprint, request
+import json
+from typing import Iterable
 from flask_jwt_extended import jwt_required, get_jwt_identity
 
 from server import db, llm
@@ -9,6 +11,59 @@ from .util import responses
 message_bp = Blueprint('message', __name__)
 
 
+@message_bp.errorhandler(llm.RateLimited)
+def rate_limited(e: llm.RateLimited):
+    '''Too many requests: tell the client when to try again, instead of waiting.'''
+
+    response = responses.response(False, message=str(e), retry_after=e.retry_after)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def _stream_answer(answer: Iterable[str], query_id: int, msg_idx: int):
+    '''
+    Streams an answer as NDJSON: one `chunk` line for each piece of text, as soon as it is generated,
+    then an `answer` line with the complete answer and its message id. The answer is logged only once complete.
+    '''
+
+    button = request.path
+
+    def generate() -> Iterable[str]:
+        chunks = []
+        try:
+            for chunk in answer:
+                chunks.append(chunk)
+                yield json.dumps({
+                    'type': 'chunk',
+                    'data': chunk,
+                }) + '\n'
+        except Exception as e:
+            yield json.dumps({
+                'type': 'error',
+                'data': str(e),
+            }) + '\n'
+            return
+
+        full_answer = ''.join(chunks)
+        answer_id = db.admin.messages.log(
+            answer=full_answer,
+            button=button,
+            query_id=query_id,
+            msg_idx=msg_idx
+        )
+
+        yield json.dumps({
+            'type': 'answer',
+            'answer': full_answer,
+            'id': answer_id,
+        }) + '\n'
+
+    # The heartbeat detects clients that go away while waiting for the answer: this request then stops following it,
+    # and the answer is not logged. Generation is not stopped: it completes in the background and the answer is cached,
+    # also for other requests following it (see `llm._single_flight`)
+    return responses.streaming_response(generate(), on_disconnect=lambda: None)
+
+
 @message_bp.route('/feedback', methods=['POST'])
 @jwt_required()
 def feedback():
@@ -34,19 +89,13 @@ def explain_error_message():
     data = request.get_json()
     query_id = data['query_id']
     msg_idx = data['msg_idx']
-    
+
     query = db.admin.queries.get(query_id)
     exception = db.admin.queries.get_result(query_id)
-    answer = llm.explain_error_message(query, exception)
-
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
+    position = db.admin.queries.get_error_position(query_id)
+    answer = llm.explain_error_message(username, query, exception, position)
 
-    return responses.response(answer=answer, id=answer_id)
+    return _stream_answer(answer, query_id, msg_idx)
 
 @message_bp.route('/error/locate', methods=['POST'])
 @jwt_required()
@@ -58,16 +107,10 @@ def locate_error_cause():
 
     query = db.admin.queries.get(query_id)
     exception = db.admin.queries.get_result(query_id)
-    answer = llm.locate_error_cause(query, exception)
-
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
+    position = db.admin.queries.get_error_position(query_id)
+    answer = llm.locate_error_cause(username, query, exception, position)
 
-    return responses.response(answer=answer, id=answer_id)
+    return _stream_answer(answer, query_id, msg_idx)
 
 @message_bp.route('/error/example', methods=['POST'])
 @jwt_required()
@@ -77,19 +120,10 @@ def provide_error_example():
     query_id = data['query_id']
     msg_idx = data['msg_idx']
 
-    query = db.admin.queries.get(query_id)
-    exception = db.admin.queries.get_result(query_id)
-    # answer = llm.provide_error_example(query, exception)
-    answer = responses.NOT_IMPLEMENTED
-    
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
+    # answer = llm.provide_error_example(username, query, exception, position)
+    answer = [responses.NOT_IMPLEMENTED]
 
-    return responses.response(answer=answer, id=answer_id)
+    return _stream_answer(answer, query_id, msg_idx)
 
 @message_bp.route('/error/fix', methods=['POST'])
 @jwt_required()
@@ -101,16 +135,10 @@ def fix_query():
 
     query = db.admin.queries.get(query_id)
     exception = db.admin.queries.get_result(query_id)
-    answer = llm.fix_query(query, exception)
-
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
+    position = db.admin.queries.get_error_position(query_id)
+    answer = llm.fix_query(username, query, exception, position)
 
-    return responses.response(answer=answer, id=answer_id)
+    return _stream_answer(answer, query_id, msg_idx)
 
 @message_bp.route('/success/describe', methods=['POST'])
 @jwt_required()
@@ -121,16 +149,9 @@ def describe_my_query():
     msg_idx = data['msg_idx']
 
     query = db.admin.queries.get(query_id)
-    answer = llm.describe_my_query(query)
+    answer = llm.describe_my_query(username, query)
 
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
-
-    return responses.response(answer=answer, id=answer_id)
+    return _stream_answer(answer, query_id, msg_idx)
 
 @message_bp.route('/success/explain', methods=['POST'])
 @jwt_required()
@@ -141,13 +162,6 @@ def explain_my_query():
     msg_idx = data['msg_idx']
 
     query = db.admin.queries.get(query_id)
-    answer = llm.explain_my_query(query)
-
-    answer_id = db.admin.messages.log(
-        answer=answer,
-        button=request.path,
-        query_id=query_id,
-        msg_idx=msg_idx
-    )
+    answer = llm.explain_my_query(username, query)
 
-    return responses.response(answer=answer, id=answer_id)
\ No newline at end of file
+    return _stream_answer(answer, query_id, msg_idx)
@@ -0,0 +1,27 @@
+'''This module handles metrics-related endpoints for the API.'''
+
+from flask import Blueprint
+from flask_jwt_extended import jwt_required, get_jwt_identity
+
+from .util import responses
+from server import db, llm
+
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('', methods=['GET'])
+@jwt_required()
+def get_metrics():
+    '''Get server metrics. Only available to administrators.'''
+
+    username = get_jwt_identity()
+    user_info = db.admin.users.get_info(username)
+    if user_info is None or not user_info['is_admin']:
+        return responses.response(False)
+
+    return responses.response(True,
+        connections=db.users.connection_stats(),
+        prewarm=db.users.prewarm_stats(),
+        query_log=db.admin.queries.log_stats(),
+        llm=llm.stats(),
+    )
@@ -22,18 +22,37 @@ def run_query():
     query = data['query']
     exercise_id = int(data['exercise_id'])
 
-    batch_id = db.admin.queries.log_batch(
-        username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
+    token = db.users.CancelToken()
 
     def generate_results():
-        for query_result in db.users.queries.execute(username=username, query_str=query):
+        batch_id = None
+
+        for query_result in db.users.queries.execute(username=username, query_str=query, token=token):
+            # Waiting for previous requests of the same user to complete: not a result
+            if query_result.type == 'queue':
+                yield json.dumps({
+                    'type': query_result.type,
+                    'position': query_result.position,
+                }) + '\n'
+                continue
+
+            # Not executed (e.g. too many requests waiting): not a query of the student, not logged
+            if query_result.type == 'rejected':
+                yield json.dumps({
+                    'type': query_result.type,
+                    'message': query_result.result,
+                }) + '\n'
+                continue
+
+            if batch_id is None:
+                batch_id = db.admin.queries.log_batch(
+                    username=username,
+                    exercise_id=exercise_id if exercise_id > 0 else None
+                )
+
             query_id = db.admin.queries.log(
                 batch_id=batch_id,
-                query=query_result.query,
-                success=query_result.success,
-                result_str=query_result.result
+                query_result=query_result
             )
             query_result.id = query_id
 
@@ -43,134 +62,73 @@ def run_query():
                 'query': query_result.query,
                 'type': query_result.type,
                 'data': query_result.result,
+                'truncated': query_result.truncated,
                 'id': query_id,
                 'notices': query_result.notices,
             }) + '\n'  # Important: one JSON object per line
 
-    return responses.streaming_response(generate_results())
+    return responses.streaming_response(generate_results(), on_disconnect=token.cancel)
 
 
-@query_bp.route('/builtin/show-search-path', methods=['POST'])
+@query_bp.route('/complete', methods=['POST'])
 @jwt_required()
-def show_search_path():
+def complete():
+    '''Get the names of schemas, tables, columns and functions in the user's database starting with `prefix`.'''
     username = get_jwt_identity()
     data = request.get_json()
-    exercise_id = int(data['exercise_id'])
-    
-    result = db.users.queries.builtin.show_search_path(username)
-
-    batch_id = db.admin.queries.log_batch(
-        username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
+    prefix = data['prefix']
 
-    query_id = db.admin.queries.log(
-        batch_id=batch_id,
-        query=result.query,
-        success=result.success,
-        result_str=result.result
-    )
+    completions = db.users.completion.complete(username, prefix)
 
-    result.id = query_id
+    return responses.response(completions=[completion.to_dict() for completion in completions])
 
-    return responses.response_query(result, is_builtin=True)
-
-@query_bp.route('/builtin/list-schemas', methods=['POST'])
+@query_bp.route('/cancel', methods=['POST'])
 @jwt_required()
-def list_schemas():
+def cancel_query():
+    '''Cancel the query currently running for the user, and the remaining queries in the same request.'''
     username = get_jwt_identity()
-    data = request.get_json()
-    exercise_id = int(data['exercise_id'])
-    
-    result = db.users.queries.builtin.list_schemas(username)
 
-    batch_id = db.admin.queries.log_batch(
-        username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
-
-    query_id = db.admin.queries.log(
-        batch_id=batch_id,
-        query=result.query,
-        success=result.success,
-        result_str=result.result
-    )
+    cancelled = db.users.cancel(username)
 
-    result.id = query_id
+    return responses.response(cancelled)
 
-    return responses.response_query(result, is_builtin=True)
-
-@query_bp.route('/builtin/list-tables', methods=['POST'])
-@jwt_required()
-def list_tables():
+def _run_builtins(commands: list[str]):
     username = get_jwt_identity()
     data = request.get_json()
     exercise_id = int(data['exercise_id'])
-    
-    result = db.users.queries.builtin.list_tables(username)
-
-    batch_id = db.admin.queries.log_batch(
-        username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
-
-    query_id = db.admin.queries.log(
-        batch_id=batch_id,
-        query=result.query,
-        success=result.success,
-        result_str=result.result
-    )
 
-    result.id = query_id
+    unknown = [command for command in commands if command not in db.users.queries.builtin.COMMANDS]
+    if unknown:
+        return responses.response(False, message=f'Unknown builtin command: {", ".join(unknown)}')
 
-    return responses.response_query(result, is_builtin=True)
-
-@query_bp.route('/builtin/list-all-tables', methods=['POST'])
-@jwt_required()
-def list_all_tables():
-    username = get_jwt_identity()
-    data = request.get_json()
-    exercise_id = int(data['exercise_id'])
-    
-    result = db.users.queries.builtin.list_all_tables(username)
+    try:
+        results = db.users.queries.builtin.execute(username, commands)
+    except db.users.QueueFull as e:
+        return responses.response(False, message=str(e))
 
-    batch_id = db.admin.queries.log_batch(
+    query_ids = db.admin.queries.log_all(
         username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
-
-    query_id = db.admin.queries.log(
-        batch_id=batch_id,
-        query=result.query,
-        success=result.success,
-        result_str=result.result
+        exercise_id=exercise_id if exercise_id > 0 else None,
+        query_results=results
     )
 
-    result.id = query_id
+    for result, query_id in zip(results, query_ids):
+        result.id = query_id
 
-    return responses.response_query(result, is_builtin=True)
+    return responses.response_query(*results, is_builtin=True)
 
-@query_bp.route('/builtin/list-constraints', methods=['POST'])
+@query_bp.route('/builtin', methods=['POST'])
 @jwt_required()
-def list_constraints():
-    username = get_jwt_identity()
-    data = request.get_json()
-    exercise_id = int(data['exercise_id'])
-    
-    result = db.users.queries.builtin.list_constraints(username)
+def run_builtins():
+    '''Run several builtin commands, listed in the `commands` field, and return their results in the same order.'''
+    commands = request.get_json().get('commands')
+    if not isinstance(commands, list) or not commands or not all(isinstance(command, str) for command in commands):
+        return responses.response(False, message='`commands` must be a non-empty list of builtin command names')
 
-    batch_id = db.admin.queries.log_batch(
-        username=username,
-        exercise_id=exercise_id if exercise_id > 0 else None
-    )
+    return _run_builtins(commands)
 
-    query_id = db.admin.queries.log(
-        batch_id=batch_id,
-        query=result.query,
-        success=result.success,
-        result_str=result.result
-    )
-
-    result.id = query_id
-
-    return responses.response_query(result, is_builtin=True)
\ No newline at end of file
+@query_bp.route('/builtin/<command>', methods=['POST'])
+@jwt_required()
+def run_builtin(command: str):
+    '''Run a builtin command, e.g. `list-schemas`.'''
+    return _run_builtins([command])
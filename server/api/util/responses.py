@@ -1,4 +1,7 @@
-from typing import Iterable as _Iterable
+import os as _os
+import queue as _queue
+import threading as _threading
+from typing import Callable as _Callable, Iterable as _Iterable
 from flask import jsonify as _jsonify, Response as _Response
 
 from server.sql import QueryResult as _QueryResult
@@ -23,7 +26,67 @@ def response_query(*results: _QueryResult, is_builtin: bool = False) -> _Respons
         for query in results
     ])
 
-def streaming_response(data: _Iterable[str]) -> _Response:
+# Seconds between empty lines sent while waiting for the next streamed item
+HEARTBEAT_SECONDS = float(_os.getenv('HEARTBEAT_SECONDS', '2'))
+
+_END = object()
+
+def _with_heartbeat(data: _Iterable[str], on_disconnect: _Callable[[], None]) -> _Iterable[str]:
+    '''
+    Produces `data` on a separate thread, sending an empty line every `HEARTBEAT_SECONDS` while waiting for it.
+    Writing to a closed connection makes the server close this generator:
+    when that happens before `data` is exhausted, `on_disconnect` is called and `data` is not consumed any further.
+    '''
+
+    items = _queue.Queue()
+    disconnected = _threading.Event()
+
+    def produce():
+        iterator = iter(data)
+        try:
+            for item in iterator:
+                items.put(item)
+                if disconnected.is_set():
+                    break
+        except Exception as e:
+            items.put(e)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+            items.put(_END)
+
+    _threading.Thread(target=produce, daemon=True).start()
+
+    finished = False
+    try:
+        while True:
+            try:
+                item = items.get(timeout=HEARTBEAT_SECONDS)
+            except _queue.Empty:
+                yield '\n'   # ignored by the client, fails if the client has gone away
+                continue
+
+            if item is _END:
+                finished = True
+                return
+            if isinstance(item, Exception):
+                finished = True
+                raise item
+            yield item
+    finally:
+        if not finished:
+            disconnected.set()
+            on_disconnect()
+
+def streaming_response(data: _Iterable[str], *, on_disconnect: _Callable[[], None] | None = None) -> _Response:
+    '''
+    Streams `data` as NDJSON.
+    If `on_disconnect` is given, it is called when the client goes away before the stream is complete.
+    '''
+
+    if on_disconnect is not None:
+        data = _with_heartbeat(data, on_disconnect)
     return _Response(data, content_type='application/x-ndjson')
 
 NOT_IMPLEMENTED = 'This feature is not implemented yet. Please check back later.'
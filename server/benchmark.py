@@ -0,0 +1,245 @@
+'''
+Micro-benchmarks for the request hot path.
+Some benchmarks compare against third-party libraries (e.g. pandas, sqlparse), which need to be installed separately.
+'''
+
+import asyncio
+import datetime
+import decimal
+import time
+import timeit
+
+from server.sql import ResultSet, SQLCode
+
+from dav_tools import argument_parser, messages
+
+
+def _sample_rows(rows: int) -> tuple[list[str], list[tuple]]:
+    '''Rows similar to the ones returned by a typical student query.'''
+
+    columns = ['id', 'name', 'email', 'price', 'created', 'note']
+    data = [
+        (
+            i,
+            f'Name {i}',
+            f'user{i}@example.com',
+            decimal.Decimal(i) / 100,
+            datetime.date(2020, 1, 1) + datetime.timedelta(days=i % 365),
+            None if i % 3 else f'<note & {i}>',
+        )
+        for i in range(rows)
+    ]
+    return columns, data
+
+def _render_pandas(columns: list[str], rows: list[tuple]) -> str:
+    '''Result rendering as it was done before `ResultSet`.'''
+    import pandas as pd
+
+    result = pd.DataFrame(rows, columns=columns).replace({None: 'NULL'})
+    result = result.to_html(
+        classes='table table-bordered table-hover table-responsive',
+        show_dimensions=True,
+        border=0
+    )
+    return result.replace('<thead>', '<thead class="table-dark">').replace('<tbody>', '<tbody class="table-group-divider">')
+
+def benchmark_render(args) -> None:
+    '''Compare HTML rendering of query results with pandas and with `ResultSet`.'''
+
+    repeat = args.repeat
+    columns, data = _sample_rows(args.rows)
+
+    result_set = timeit.timeit(lambda: ResultSet(columns, data).to_html(), number=repeat) / repeat
+    messages.info(f'ResultSet: {result_set * 1000:.2f} ms')
+
+    try:
+        pandas = timeit.timeit(lambda: _render_pandas(columns, data), number=repeat) / repeat
+    except ImportError:
+        messages.warning('pandas is not installed, skipping comparison')
+        return
+
+    messages.info(f'pandas:    {pandas * 1000:.2f} ms ({pandas / result_set:.1f}x slower)')
+
+    if _render_pandas(columns, data) != ResultSet(columns, data).to_html():
+        messages.warning('Rendered HTML differs from pandas')
+
+def _sample_script(rows: int) -> str:
+    '''Dataset script similar to the ones used in exercises.'''
+
+    columns, data = _sample_rows(rows)
+    lines = [
+        '-- Sample dataset',
+        'CREATE TABLE sample (id INT PRIMARY KEY, name TEXT, email TEXT, price NUMERIC, created DATE, note TEXT);',
+        '/* Data */',
+    ]
+    for row in data:
+        values = ', '.join('NULL' if value is None else f"'{value}'" for value in row)
+        lines.append(f'INSERT INTO sample VALUES ({values}); -- row {row[0]}')
+    return '\n'.join(lines)
+
+def benchmark_split(args) -> None:
+    '''Compare statement splitting and comment stripping with sqlparse and with `SQLCode`.'''
+
+    if args.path:
+        with open(args.path, 'r') as file:
+            script = file.read()
+    else:
+        script = _sample_script(args.rows)
+    repeat = args.repeat
+    messages.info(f'Script size: {len(script) / 1024 / 1024:.2f} MB')
+
+    split = timeit.timeit(lambda: [s.strip_comments() for s in SQLCode(script).split()], number=repeat) / repeat
+    messages.info(f'SQLCode:  {split * 1000:.2f} ms')
+
+    try:
+        import sqlparse
+    except ImportError:
+        messages.warning('sqlparse is not installed, skipping comparison')
+        return
+
+    sqlparse_split = timeit.timeit(lambda: [sqlparse.format(s, strip_comments=True) for s in sqlparse.split(script, strip_semicolon=False)], number=repeat) / repeat
+    messages.info(f'sqlparse: {sqlparse_split * 1000:.2f} ms ({sqlparse_split / split:.1f}x slower)')
+
+def benchmark_connect(args) -> None:
+    '''
+    Open connections for many users at once, with several concurrent requests for each user.
+    Users are named `<prefix>1` ... `<prefix>N`, and their databases must already exist.
+    Fails if a user gets more than one connection. See `tests/test_connection.py` for the same check without a database.
+    '''
+
+    from server.db.users import connection, engine
+
+    usernames = [f'{args.prefix}{i}' for i in range(1, args.rows + 1)]
+    requests = [username for username in usernames for _ in range(args.repeat)]
+
+    async def connect_all():
+        return await asyncio.gather(*(connection.get_connection(username) for username in requests), return_exceptions=True)
+
+    start = time.perf_counter()
+    results = engine.run(connect_all())
+    elapsed = time.perf_counter() - start
+
+    errors = [result for result in results if isinstance(result, BaseException)]
+    opened: dict[str, set[int]] = {}
+    for username, result in zip(requests, results):
+        if not isinstance(result, BaseException):
+            opened.setdefault(username, set()).add(id(result))
+
+    messages.info(f'{len(requests)} requests for {len(usernames)} users: {elapsed * 1000:.2f} ms')
+    messages.info(f'Users connected: {len(opened)}, open connections: {len(connection.connections)}, errors: {len(errors)}')
+
+    for error in errors[:5]:
+        messages.error(f'{type(error).__name__}: {error}')
+
+    duplicated = [username for username, conns in opened.items() if len(conns) > 1]
+    if duplicated:
+        messages.critical_error(f'Users with more than one connection: {len(duplicated)}')
+
+def benchmark_admin(args) -> None:
+    '''
+    Compare admin database lookups with a new connection per call and with the pool and prepared statements.
+    Runs `--rows` threads, each doing `--repeat` lookups of the statement timeout of a user, as done for every new connection.
+    '''
+
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from dav_tools import database
+    from server.db.admin import connection, users
+
+    username = f'{args.prefix}1'
+    per_call = database.PostgreSQL(
+        host        =       os.getenv('DB_HOST', 'localhost'),
+        port        =   int(os.getenv('DB_PORT', '5432')),
+        database    =       os.getenv('DB_DATABASE', 'postgres'),
+        user        =       os.getenv('DB_USERNAME', 'postgres'),
+        password    =       os.getenv('DB_PASSWORD', ''),
+    )
+    select = database.sql.SQL('SELECT statement_timeout_seconds FROM {schema}.users WHERE username = {username}').format(
+        schema=database.sql.Identifier(connection.SCHEMA),
+        username=database.sql.Placeholder('username')
+    )
+
+    def run(lookup) -> float:
+        def worker():
+            for _ in range(args.repeat):
+                lookup()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.rows) as executor:
+            for future in [executor.submit(worker) for _ in range(args.rows)]:
+                future.result()
+        return (time.perf_counter() - start) / (args.rows * args.repeat)
+
+    pooled = run(lambda: users.get_statement_timeout(username))
+    messages.info(f'Pool + prepared statements: {pooled * 1000:.3f} ms per lookup')
+
+    unpooled = run(lambda: per_call.execute_and_fetch(select, {'username': username}))
+    messages.info(f'Connection per call:        {unpooled * 1000:.3f} ms per lookup ({unpooled / pooled:.1f}x slower)')
+
+def benchmark_llm(args) -> None:
+    '''
+    Ask many LLM questions at once, to measure the generation queue and the answer cache.
+    `--rows` users each ask `--repeat` questions about one of `--rows` / 2 different queries, so that some questions are repeated.
+    Uses the fake backend unless `LLM_BACKEND` is set: see `server.llm._backends` for its configuration.
+    '''
+
+    import os
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.environ.setdefault('LLM_BACKEND', 'fake')
+    from server import llm
+
+    messages.info(f'Backend: {llm.backend.name}')
+    queries = [f'SELECT * FROM missing_table_{i};' for i in range(max(1, args.rows // 2))]
+
+    def ask(user: int, question: int) -> tuple[str, float | None, float]:
+        start = time.perf_counter()
+        first_chunk = None
+        try:
+            for _ in llm.explain_error_message(f'{args.prefix}{user}', queries[(user + question) % len(queries)], 'relation does not exist'):
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - start
+            return 'ok', first_chunk, time.perf_counter() - start
+        except llm.RateLimited:
+            return 'rate_limited', None, time.perf_counter() - start
+        except Exception:
+            return 'error', first_chunk, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.rows * args.repeat) as executor:
+        results = list(executor.map(lambda i: ask(i // args.repeat, i % args.repeat), range(args.rows * args.repeat)))
+    elapsed = time.perf_counter() - start
+
+    messages.info(f'{len(results)} questions from {args.rows} users: {elapsed:.2f} s')
+    for outcome in ['ok', 'rate_limited', 'error']:
+        messages.info(f'{outcome}: {sum(1 for result in results if result[0] == outcome)}')
+
+    for label, index in [('Time to first chunk', 1), ('Time to answer', 2)]:
+        times = sorted(result[index] for result in results if result[0] == 'ok' and result[index] is not None)
+        if len(times) >= 2:
+            quantiles = statistics.quantiles(times, n=20)
+            p50, p95 = quantiles[9], quantiles[18]
+            messages.info(f'{label}: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, max {times[-1] * 1000:.0f} ms')
+
+    for name, value in llm.stats().items():
+        messages.info(f'{name}: {value}')
+
+BENCHMARKS = {
+    'render': benchmark_render,
+    'split': benchmark_split,
+    'connect': benchmark_connect,
+    'admin': benchmark_admin,
+    'llm': benchmark_llm,
+}
+
+if __name__ == '__main__':
+    argument_parser.set_description('Run micro-benchmarks for the request hot path')
+    argument_parser.add_argument('benchmark', type=str, choices=BENCHMARKS.keys(), help='Benchmark to run')
+    argument_parser.add_argument('--rows', type=int, default=1000, help='Number of rows in the sample data (number of users for connect and llm, of threads for admin)')
+    argument_parser.add_argument('--repeat', type=int, default=10, help='Number of repetitions (concurrent requests per user for connect, lookups per thread for admin, questions per user for llm)')
+    argument_parser.add_argument('--path', type=str, default=None, help='SQL script to use instead of the sample data (split only)')
+    argument_parser.add_argument('--prefix', type=str, default='user', help='Prefix of the usernames (connect, admin and llm only)')
+
+    args = argument_parser.args
+    BENCHMARKS[args.benchmark](args)
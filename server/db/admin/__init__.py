@@ -1 +1 @@
-from . import assignments, auth, dataset, exercises, messages, queries, teachers, users
\ No newline at end of file
+from . import assignments, auth, dataset, exercises, llm_answers, messages, queries, teachers, users
\ No newline at end of file
@@ -0,0 +1,246 @@
+'''
+Write-behind buffering of inserts into the admin database.
+
+Rows are assigned an id immediately, taken from blocks preallocated from the table sequence,
+and are written later in bulk by a background thread. Callers never wait for the database,
+except when a block of ids is exhausted.
+Tables are flushed in the order they are registered, so that rows can reference rows of earlier tables.
+Pending rows are written when the process exits.
+'''
+
+from .connection import db, SCHEMA
+
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable
+from dav_tools import database, messages
+from psycopg2 import extras, InterfaceError, OperationalError
+
+# Number of ids allocated at once for each table
+ID_BLOCK_SIZE           = int(os.getenv('WRITE_BEHIND_ID_BLOCK_SIZE', '100'))
+# Pending rows are written at least this often...
+FLUSH_INTERVAL_SECONDS  = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL_SECONDS', '0.5'))
+# ...or as soon as there are this many of them
+FLUSH_ROWS              = int(os.getenv('WRITE_BEHIND_FLUSH_ROWS', '500'))
+# Maximum time allowed for writing pending rows when the process exits
+SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv('WRITE_BEHIND_SHUTDOWN_TIMEOUT_SECONDS', '30'))
+# Delay before retrying when the database cannot be reached
+RETRY_SECONDS           = 1
+
+
+class Table:
+    '''
+    Rows waiting to be inserted into a table.
+
+    Parameters:
+        name (str): The table name, in the admin schema. Its `id` column must be a serial.
+        columns (list[str]): The columns to insert, except `id`.
+        to_row (Callable | None): Converts the value passed to `append` into a tuple of column values.
+            Runs on the background thread, so expensive conversions (e.g. compression) are not on the request path.
+    '''
+
+    def __init__(self, name: str, columns: list[str], to_row: Callable[[Any], tuple] | None = None):
+        self.name = name
+        self.columns = ['id', *columns]
+        self.to_row = to_row or tuple
+
+        self._ids: deque[int] = deque()
+        self._ids_lock = threading.Lock()
+        # (id, value) pairs, in insertion order
+        self.pending: list[tuple[int, Any]] = []
+        # Ids appended but not written yet, including the ones being written
+        self.unwritten: set[int] = set()
+
+        self._insert = database.sql.SQL('INSERT INTO {schema}.{table}({columns}) VALUES %s').format(
+            schema=database.sql.Identifier(SCHEMA),
+            table=database.sql.Identifier(name),
+            columns=database.sql.SQL(', ').join(map(database.sql.Identifier, self.columns))
+        )
+
+    def allocate_id(self) -> int:
+        '''Takes an id from the preallocated block, allocating a new block if needed.'''
+
+        with self._ids_lock:
+            if not self._ids:
+                query = database.sql.SQL('SELECT nextval(pg_get_serial_sequence({table}, {column})) FROM generate_series(1, {count})').format(
+                    table=database.sql.Literal(f'{SCHEMA}.{self.name}'),
+                    column=database.sql.Literal('id'),
+                    count=database.sql.Literal(ID_BLOCK_SIZE)
+                )
+                self._ids.extend(row[0] for row in db.execute_and_fetch(query))
+            return self._ids.popleft()
+
+    def write(self, rows: list[tuple[int, Any]]) -> None:
+        '''
+        Inserts rows with a single statement.
+        If it fails for reasons other than connectivity, rows are inserted one at a time, and the failing ones are discarded.
+
+        Raises:
+            OperationalError | InterfaceError: If the database cannot be reached. No rows have been written.
+        '''
+
+        values = []
+        for row_id, value in rows:
+            try:
+                values.append((row_id, *self.to_row(value)))
+            except Exception as e:
+                messages.error(f'Discarding row {row_id} of table {self.name}: {e}')
+
+        try:
+            self._execute(values)
+            return
+        except (OperationalError, InterfaceError):
+            raise
+        except Exception as e:
+            messages.warning(f'Cannot write {len(values)} rows to table {self.name}, retrying one at a time: {e}')
+
+        for row in values:
+            try:
+                self._execute([row])
+            except (OperationalError, InterfaceError):
+                raise
+            except Exception as e:
+                messages.error(f'Discarding row {row[0]} of table {self.name}: {e}')
+
+    def _execute(self, values: list[tuple]) -> None:
+        if not values:
+            return
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                extras.execute_values(cur, self._insert, values, page_size=len(values))
+
+
+class WriteBehind:
+    '''Background writer for a group of tables.'''
+
+    def __init__(self, *tables: Table):
+        self.tables = tables
+
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+        self._flush_requested = False
+        # Sequence numbers of the last appended row and of the last written one
+        self._appended = 0
+        self._written = 0
+        # Number of bulk inserts and of rows written, for metrics
+        self.flushes = 0
+        self.rows_written = 0
+
+        atexit.register(self.close)
+
+    def append(self, table: Table, value: Any) -> int:
+        '''
+        Queues a row for insertion.
+
+        Parameters:
+            table (Table): The table, registered in this writer.
+            value (Any): The column values, or the argument of `table.to_row`.
+        Returns:
+            int: The id of the new row.
+        '''
+
+        row_id = table.allocate_id()
+
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'write-behind-{self.tables[0].name}', daemon=True)
+                self._thread.start()
+
+            table.pending.append((row_id, value))
+            table.unwritten.add(row_id)
+            self._appended += 1
+            self._cond.notify_all()
+
+        return row_id
+
+    def is_pending(self, table: Table, row_id: int) -> bool:
+        '''Whether a row has been appended but not written yet.'''
+        with self._cond:
+            return row_id in table.unwritten
+
+    def flush(self, timeout: float | None = None) -> bool:
+        '''
+        Waits until all the rows appended so far have been written.
+
+        Returns:
+            bool: False if the timeout expired first.
+        '''
+
+        with self._cond:
+            target = self._appended
+            if self._written >= target:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self) -> None:
+        '''Writes the pending rows and stops the background thread.'''
+
+        with self._cond:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+
+        self._thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+        if self._thread.is_alive():
+            lost = sum(len(t.unwritten) for t in self.tables)
+            messages.error(f'Timed out writing pending rows at shutdown, {lost} rows lost')
+
+    def stats(self) -> dict:
+        '''Number of rows waiting to be written for each table, and totals since startup.'''
+
+        with self._cond:
+            return {
+                'pending': {table.name: len(table.unwritten) for table in self.tables},
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping or self._flush_requested or sum(len(t.pending) for t in self.tables) >= FLUSH_ROWS,
+                    FLUSH_INTERVAL_SECONDS
+                )
+                self._flush_requested = False
+                batches = [(table, table.pending) for table in self.tables]
+                for table in self.tables:
+                    table.pending = []
+                target = self._appended
+                stopping = self._stopping
+
+            written = 0
+            try:
+                for i, (table, rows) in enumerate(batches):
+                    if not rows:
+                        continue
+                    table.write(rows)
+                    written += len(rows)
+                    batches[i] = (table, [])
+                    with self._cond:
+                        table.unwritten.difference_update(row_id for row_id, _ in rows)
+            except (OperationalError, InterfaceError) as e:
+                messages.error(f'Cannot write pending rows, retrying in {RETRY_SECONDS}s: {e}')
+                # Put back the rows not written, before the ones appended in the meantime
+                with self._cond:
+                    for table, rows in batches:
+                        table.pending[:0] = rows
+                    self.rows_written += written
+                time.sleep(RETRY_SECONDS)
+                continue
+
+            with self._cond:
+                self._written = target
+                if written > 0:
+                    self.flushes += 1
+                    self.rows_written += written
+                self._cond.notify_all()
+                if stopping and self._written >= self._appended:
+                    return
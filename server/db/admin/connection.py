@@ -1,13 +1,163 @@
 from dav_tools import database
 import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+import psycopg2
+from psycopg2 import extensions
 
 SCHEMA = 'lensql'
 
-db = database.PostgreSQL(
+# Maximum number of connections to the admin database
+POOL_SIZE = int(os.getenv('ADMIN_DB_POOL_SIZE', '20'))
+
+
+class _Connection(extensions.connection):
+    '''Connection keeping track of the statements prepared on it.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: set[str] = set()
+
+
+class PreparedStatement:
+    '''
+    Statement prepared on the server once per connection, then executed by name.
+    Parameters are positional (`$1`, `$2`, ...).
+    '''
+
+    def __init__(self, name: str, query: database.sql.Composable):
+        self.name = name
+        self.query = query
+        # `EXECUTE` statements, by number of parameters
+        self._execute: dict[int, database.sql.Composable] = {}
+
+    def _prepare(self, conn: _Connection) -> None:
+        if self.name in conn.prepared:
+            return
+
+        with conn.cursor() as cur:
+            cur.execute(database.sql.SQL('PREPARE {name} AS {query}').format(
+                name=database.sql.Identifier(self.name),
+                query=self.query
+            ))
+        conn.prepared.add(self.name)
+
+    def _execute_sql(self, params: tuple) -> database.sql.Composable:
+        if len(params) not in self._execute:
+            self._execute[len(params)] = database.sql.SQL('EXECUTE {name}{params}').format(
+                name=database.sql.Identifier(self.name),
+                params=database.sql.SQL('({})').format(database.sql.SQL(', ').join([database.sql.Placeholder()] * len(params))) if params else database.sql.SQL('')
+            )
+        return self._execute[len(params)]
+
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of connections to a PostgreSQL database.
+    Provides the same interface as `database.PostgreSQL`, plus prepared statements.
+    Connections are in autocommit mode.
+    '''
+
+    def __init__(self, host: str, port: int, database: str, user: str, password: str, size: int) -> None:
+        self._dsn = extensions.make_dsn(host=host, port=port, dbname=database, user=user, password=password)
+
+        # Connections are opened when needed, and kept open once returned to the pool
+        self._idle: list[_Connection] = []
+        self._idle_lock = threading.Lock()
+        # Callers wait for a free connection when all of them are in use
+        self._available = threading.BoundedSemaphore(size)
+
+        self._statements: dict[str, PreparedStatement] = {}
+
+    @contextmanager
+    def connection(self) -> Iterator[_Connection]:
+        '''Borrows a connection from the pool.'''
+
+        with self._available:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self._dsn, connection_factory=_Connection)
+                conn.autocommit = True
+
+            try:
+                yield conn
+            finally:
+                # Broken connections are discarded, a new one will be opened when needed
+                if not conn.closed:
+                    with self._idle_lock:
+                        self._idle.append(conn)
+
+    def prepare(self, name: str, query: database.sql.Composable) -> PreparedStatement:
+        '''
+        Registers a statement to be prepared on each connection the first time it is executed there.
+
+        Parameters:
+            name (str): Name of the prepared statement, must be unique.
+            query (database.sql.Composable): The statement, with positional parameters (`$1`, `$2`, ...).
+        '''
+
+        if name in self._statements:
+            raise ValueError(f'Statement {name} is already registered')
+
+        statement = PreparedStatement(name, query)
+        self._statements[name] = statement
+        return statement
+
+    def execute_prepared(self, statement: PreparedStatement, *params) -> list[tuple] | None:
+        '''
+        Executes a registered statement with the given parameters.
+
+        Returns:
+            list[tuple] | None: The rows returned by the statement, or None if it does not return rows.
+        '''
+
+        with self.connection() as conn:
+            statement._prepare(conn)
+            with conn.cursor() as cur:
+                cur.execute(statement._execute_sql(params), params)
+                if cur.description is None:
+                    return None
+                return cur.fetchall()
+
+    def execute(self, query: str, data: dict[str, any] | None = None, commit: bool = True) -> None:
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, data)
+
+    def execute_and_fetch(self, query: str, data: dict[str, any] | None = None) -> list[tuple[any, ...]]:
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, data)
+                return cur.fetchall()
+
+    def insert(self, schema: str, table: str, data: dict[str, any], return_fields: list[str] = []):
+        '''Inserts a row into a table. Returns the requested fields of the inserted row, if any.'''
+
+        if len(return_fields) > 0:
+            base_query = 'INSERT INTO {schema}.{table}({fields}) VALUES({values}) RETURNING {return_fields}'
+        else:
+            base_query = 'INSERT INTO {schema}.{table}({fields}) VALUES({values})'
+
+        query = database.sql.SQL(base_query).format(
+            schema=database.sql.Identifier(schema),
+            table=database.sql.Identifier(table),
+            fields=database.sql.SQL(',').join([database.sql.Identifier(key) for key in data.keys()]),
+            values=database.sql.SQL(',').join([database.sql.Placeholder(key) for key in data.keys()]),
+            return_fields=database.sql.SQL(',').join([database.sql.Identifier(key) for key in return_fields])
+        )
+
+        if len(return_fields) > 0:
+            return self.execute_and_fetch(query, data)
+        self.execute(query, data)
+
+
+db = ConnectionPool(
     host        =       os.getenv('DB_HOST', 'localhost'),
     port        =   int(os.getenv('DB_PORT', '5432')),
     database    =       os.getenv('DB_DATABASE', 'postgres'),
     user        =       os.getenv('DB_USERNAME', 'postgres'),
     password    =       os.getenv('DB_PASSWORD', ''),
+    size        =       POOL_SIZE,
 )
-
@@ -1,6 +1,38 @@
 from dav_tools import database
 from .connection import db, SCHEMA
 
+import hashlib
+import json
+
+from server.sql import SQLCode
+
+
+def split(dataset: str) -> tuple[list[str], str]:
+    '''
+    Split a dataset into statements and compute its content hash.
+
+    Returns:
+        tuple[list[str], str]: The statements, in order, and the SHA-256 of the statements.
+    '''
+
+    statements = [statement.query for statement in SQLCode(dataset).split()]
+    content_hash = hashlib.sha256(json.dumps(statements).encode()).hexdigest()
+    return statements, content_hash
+
+def validate(dataset: str) -> None:
+    '''
+    Check that a dataset can be split into statements.
+
+    Raises:
+        ValueError: If the dataset contains no statements, or unterminated strings or comments.
+    '''
+
+    code = SQLCode(dataset)
+    if not code.is_terminated():
+        raise ValueError('Dataset contains an unterminated string, identifier or comment')
+    if next(code.split(), None) is None:
+        raise ValueError('Dataset contains no statements')
+
 def get(dataset_id: int | None) -> str:
     '''Get the dataset for a given dataset ID'''
 
@@ -57,19 +89,48 @@ def list_all(username: str) -> list[dict]:
     ]
 
 def add(name: str, dataset: str) -> None:
-    '''Add a dataset to the database'''
+    '''Add a dataset to the database. The dataset is split and validated before being stored.'''
+
+    validate(dataset)
+    statements, content_hash = split(dataset)
 
     query = database.sql.SQL(
     '''
-        INSERT INTO {schema}.datasets(name, dataset)
-        VALUES ({name}, {dataset})
+        INSERT INTO {schema}.datasets(name, dataset, statements, content_hash)
+        VALUES ({name}, {dataset}, {statements}, {content_hash})
     ''').format(
         schema=database.sql.Identifier(SCHEMA),
         name=database.sql.Placeholder('name'),
-        dataset=database.sql.Placeholder('dataset')
+        dataset=database.sql.Placeholder('dataset'),
+        statements=database.sql.Placeholder('statements'),
+        content_hash=database.sql.Placeholder('content_hash')
     )
 
     db.execute(query, {
         'name': name,
-        'dataset': dataset
-    })
\ No newline at end of file
+        'dataset': dataset,
+        'statements': statements,
+        'content_hash': content_hash
+    })
+
+def store_statements(dataset_id: int, statements: list[str], content_hash: str) -> None:
+    '''Store the statements of a dataset added before they were split at upload time'''
+
+    query = database.sql.SQL(
+    '''
+        UPDATE {schema}.datasets
+        SET statements = {statements},
+            content_hash = {content_hash}
+        WHERE id = {dataset_id}
+    ''').format(
+        schema=database.sql.Identifier(SCHEMA),
+        statements=database.sql.Placeholder('statements'),
+        content_hash=database.sql.Placeholder('content_hash'),
+        dataset_id=database.sql.Placeholder('dataset_id')
+    )
+
+    db.execute(query, {
+        'statements': statements,
+        'content_hash': content_hash,
+        'dataset_id': dataset_id
+    })
@@ -1,5 +1,6 @@
 from dav_tools import database
 from .connection import db, SCHEMA
+from . import dataset as _dataset
 
 # TODO: is this needed?
 def list_all() -> list[dict]:
@@ -71,14 +72,19 @@ def get(exercise_id: int, username: str) -> dict:
         'dataset_id': result[0][1]
     }
 
-def get_dataset(exercise_id: int) -> str:
-    '''Get the dataset for a given exercise ID'''
+def get_dataset_statements(exercise_id: int) -> tuple[list[str], str | None]:
+    '''
+    Get the dataset for a given exercise ID, already split into statements.
+
+    Returns:
+        tuple[list[str], str | None]: The statements, and the content hash of the dataset (None if there is no dataset).
+    '''
 
     query = database.sql.SQL(
         '''
-        SELECT dataset
+        SELECT d.id, d.dataset, d.statements, d.content_hash
         FROM {schema}.exercises e
-            JOIN {schema}.datasets d ON e.dataset_id = d.id                     
+            JOIN {schema}.datasets d ON e.dataset_id = d.id
         WHERE e.id = {exercise_id}
     ''').format(
         schema=database.sql.Identifier(SCHEMA),
@@ -90,9 +96,16 @@ def get_dataset(exercise_id: int) -> str:
     })
 
     if len(result) == 0:
-        return '-- No dataset provided'
+        return [], None
+
+    dataset_id, dataset, statements, content_hash = result[0]
+
+    # Datasets added before statements were stored are split on first use
+    if statements is None:
+        statements, content_hash = _dataset.split(dataset)
+        _dataset.store_statements(dataset_id, statements, content_hash)
 
-    return result[0][0]
+    return statements, content_hash
 
 def create(title: str, request: str, dataset_id: int | None, expected_answer: str, is_ai_generated: bool) -> int:
     '''Create a new exercise'''
@@ -0,0 +1,58 @@
+from dav_tools import database
+from .connection import db, SCHEMA
+
+import datetime
+
+_GET = db.prepare('lensql_get_llm_answer', database.sql.SQL('''
+    UPDATE {schema}.llm_answers
+    SET hits = hits + 1
+    WHERE key = $1 AND creation_ts > $2
+    RETURNING answer, creation_ts
+''').format(
+    schema=database.sql.Identifier(SCHEMA)
+))
+
+def get(key: str, max_age: datetime.timedelta) -> tuple[str, datetime.datetime] | None:
+    '''Get a cached answer, if it is not older than `max_age`. Returns the answer and its creation time.'''
+
+    result = db.execute_prepared(_GET, key, datetime.datetime.now() - max_age)
+
+    if len(result) == 0:
+        return None
+    return result[0]
+
+def store(key: str, kind: str, answer: str) -> None:
+    '''Store an answer, replacing any previous answer with the same key'''
+
+    query = database.sql.SQL('''
+        INSERT INTO {schema}.llm_answers(key, kind, answer, creation_ts)
+        VALUES ({key}, {kind}, {answer}, NOW())
+        ON CONFLICT (key) DO UPDATE
+        SET answer = EXCLUDED.answer, creation_ts = EXCLUDED.creation_ts, hits = 0
+    ''').format(
+        schema=database.sql.Identifier(SCHEMA),
+        key=database.sql.Placeholder('key'),
+        kind=database.sql.Placeholder('kind'),
+        answer=database.sql.Placeholder('answer')
+    )
+
+    db.execute(query, {
+        'key': key,
+        'kind': kind,
+        'answer': answer
+    })
+
+def delete_expired(max_age: datetime.timedelta) -> None:
+    '''Delete the answers older than `max_age`'''
+
+    query = database.sql.SQL('''
+        DELETE FROM {schema}.llm_answers
+        WHERE creation_ts <= {oldest}
+    ''').format(
+        schema=database.sql.Identifier(SCHEMA),
+        oldest=database.sql.Placeholder('oldest')
+    )
+
+    db.execute(query, {
+        'oldest': datetime.datetime.now() - max_age
+    })
@@ -1,9 +1,13 @@
 from dav_tools import database
 from .connection import db, SCHEMA
+from . import queries
 
 def log(answer: str, button: str, query_id: str, msg_idx: int) -> int:
     '''Log a new message'''
 
+    # The message references the query, which may still be waiting to be written
+    queries.ensure_logged(query_id)
+
     result = db.insert(SCHEMA, 'messages', {
         'query_id': query_id,
         'answer': answer,
@@ -1,45 +1,106 @@
 from dav_tools import database
 from .connection import db, SCHEMA
+from . import _write_behind
+
+import datetime
+import os
+from server.sql import QueryResult, ResultSet
+
+# Maximum size of the compressed rows stored for a single query
+MAX_STORED_RESULT_BYTES = int(os.getenv('MAX_STORED_RESULT_BYTES', str(256 * 1024)))
+# Maximum time spent waiting for a logged query to be written before reading it
+READ_FLUSH_TIMEOUT_SECONDS = 10
+
+
+def _query_row(value: tuple[int, QueryResult, datetime.datetime]) -> tuple:
+    '''Column values for a logged query. Datasets are stored compressed, messages and errors are stored as text.'''
+
+    batch_id, query_result, ts = value
+
+    if query_result.data is not None:
+        result_str = None
+        result_data = query_result.data.compress(MAX_STORED_RESULT_BYTES)
+        result_rows = len(query_result.data)
+    else:
+        result_str = query_result.result
+        result_data = None
+        result_rows = None
+
+    return batch_id, query_result.query, query_result.success, result_str, result_data, result_rows, query_result.error_position, ts
+
+# Batches and queries are written in the background, batches first since queries reference them
+_batches = _write_behind.Table('query_batches', ['username', 'exercise_id', 'ts'])
+_queries = _write_behind.Table('queries', ['batch_id', 'query', 'success', 'result', 'result_data', 'result_rows', 'error_position', 'ts'], _query_row)
+_log = _write_behind.WriteBehind(_batches, _queries)
+
+_GET = db.prepare('lensql_get_query', database.sql.SQL('''
+    SELECT query
+    FROM {schema}.queries
+    WHERE id = $1
+''').format(
+    schema=database.sql.Identifier(SCHEMA)
+))
+
+_GET_RESULT = db.prepare('lensql_get_query_result', database.sql.SQL('''
+    SELECT result, result_data
+    FROM {schema}.queries
+    WHERE id = $1
+''').format(
+    schema=database.sql.Identifier(SCHEMA)
+))
+
+_GET_ERROR_POSITION = db.prepare('lensql_get_query_error_position', database.sql.SQL('''
+    SELECT error_position
+    FROM {schema}.queries
+    WHERE id = $1
+''').format(
+    schema=database.sql.Identifier(SCHEMA)
+))
 
 def log_batch(username: str, exercise_id: int) -> int:
-    '''Log a new query batch for a user and exercise ID.'''
+    '''Log a new query batch for a user and exercise ID. The batch is written in the background.'''
+
+    return _log.append(_batches, (username, exercise_id, datetime.datetime.now()))
 
-    result = db.insert(SCHEMA, 'query_batches', {
-        'username': username,
-        'exercise_id': exercise_id,
-    }, ['id'])
+def log(batch_id: int, query_result: QueryResult) -> int:
+    '''
+    Log a new query with its result and success status. The query is written in the background.
+    Datasets are stored compressed, messages and errors are stored as text.
+    '''
 
-    batch_id = result[0][0]
-    return batch_id
+    return _log.append(_queries, (batch_id, query_result, datetime.datetime.now()))
 
-def log(batch_id: int, query: str, success: bool, result_str: str) -> int:
-    '''Log a new query with its result and success status.'''
+def log_all(username: str, exercise_id: int, query_results: list[QueryResult]) -> list[int]:
+    '''
+    Log a new query batch together with its queries, e.g. for builtins whose results are all known in advance.
+    Everything is written in the background, with no round trips to the database.
 
-    result = db.insert(SCHEMA, 'queries', {
-        'batch_id': batch_id,
-        'query': query,
-        'success': success,
-        'result': result_str
-    }, ['id'])
+    Returns:
+        list[int]: The ids of the logged queries, in the same order as `query_results`.
+    '''
 
-    query_id = result[0][0]
+    batch_id = log_batch(username, exercise_id)
+    return [log(batch_id, query_result) for query_result in query_results]
 
-    return query_id
+def ensure_logged(query_id: int) -> None:
+    '''Waits until a logged query has been written, e.g. before reading it or referencing it.'''
+
+    if _log.is_pending(_queries, int(query_id)):
+        _log.flush(READ_FLUSH_TIMEOUT_SECONDS)
+
+def flush() -> None:
+    '''Waits until all the logged batches and queries have been written.'''
+    _log.flush()
+
+def log_stats() -> dict:
+    '''Statistics about the queries waiting to be written.'''
+    return _log.stats()
 
 def get(query_id: int) -> str:
     '''Get the query string for a given query ID.'''
 
-    query = database.sql.SQL('''
-        SELECT query
-        FROM {schema}.queries
-        WHERE id = {query_id}
-    ''').format(
-        schema=database.sql.Identifier(SCHEMA),
-        query_id=database.sql.Placeholder('query_id')
-    )
-    result = db.execute_and_fetch(query, {
-        'query_id': query_id
-    })
+    ensure_logged(query_id)
+    result = db.execute_prepared(_GET, query_id)
 
     if len(result) == 0:
         return None
@@ -47,19 +108,25 @@ def get(query_id: int) -> str:
     return result[0][0]
 
 def get_result(query_id: int) -> str:
-    '''Get the result string for a given query ID.'''
-
-    query = database.sql.SQL('''
-        SELECT result
-        FROM {schema}.queries
-        WHERE id = {query_id}
-    ''').format(
-        schema=database.sql.Identifier(SCHEMA),
-        query_id=database.sql.Placeholder('query_id')
-    )
-    result = db.execute_and_fetch(query, {
-        'query_id': query_id
-    })
+    '''Get the result string for a given query ID. Stored datasets are rendered as HTML.'''
+
+    ensure_logged(query_id)
+    result = db.execute_prepared(_GET_RESULT, query_id)
+
+    if len(result) == 0:
+        return None
+
+    result_str, result_data = result[0]
+    if result_data is not None:
+        return ResultSet.decompress(result_data).to_html()
+
+    return result_str
+
+def get_error_position(query_id: int) -> int | None:
+    '''Get the position of the error in the query (1 is the first character) for a given query ID, if it is known.'''
+
+    ensure_logged(query_id)
+    result = db.execute_prepared(_GET_ERROR_POSITION, query_id)
 
     if len(result) == 0:
         return None
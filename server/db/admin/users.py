@@ -30,6 +30,23 @@ def get_info(username: str) -> dict:
         'is_teacher': result[0][1],
     }
 
+_GET_STATEMENT_TIMEOUT = db.prepare('lensql_get_statement_timeout', database.sql.SQL('''
+    SELECT statement_timeout_seconds
+    FROM {schema}.users
+    WHERE username = $1
+''').format(
+    schema=database.sql.Identifier(SCHEMA)
+))
+
+def get_statement_timeout(username: str) -> int | None:
+    '''Get the maximum duration of a single statement for a user, in seconds, or None to use the default'''
+
+    result = db.execute_prepared(_GET_STATEMENT_TIMEOUT, username)
+
+    if len(result) == 0:
+        return None
+    return result[0][0]
+
 def get_learning_stats(username: str) -> dict:
     '''Get learning statistics for a user'''
 
@@ -1,3 +1,5 @@
-from . import queries
-from .cleanup import start_cleanup_thread
+from . import queries, datasets, completion
+from .connection import prewarm, prewarm_stats
+from .request_queue import cancel, CancelToken, QueueFull
+from .cleanup import start_expiry_scheduler, stats as connection_stats
     
\ No newline at end of file
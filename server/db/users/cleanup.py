@@ -1,40 +1,109 @@
-from . import connection
+'''
+Expiry of idle connections.
 
+Connections are kept in a heap ordered by expiry time, i.e. last use plus MAX_IDLE_TIME.
+A task on the `engine` event loop sleeps until the earliest expiry, then closes that connection
+if it has not been used in the meantime, or schedules it again otherwise.
+Connections in use (see `connection.lease`) are never closed.
+'''
+
+from . import connection, engine
+
+import asyncio
 import datetime
+import heapq
+import itertools
 import os
-import threading
-import time
 from dav_tools import messages
 
-MAX_CONNECTION_AGE = datetime.timedelta(hours=float(os.getenv('MAX_CONNECTION_HOURS', '4')))
-CLEANUP_INTERVAL_SECONDS = int(os.getenv('CLEANUP_INTERVAL_SECONDS', '60'))
+# Connections unused for longer than this are closed. Their session state is restored when the user comes back
+MAX_IDLE_TIME = datetime.timedelta(minutes=float(os.getenv('MAX_IDLE_MINUTES', '30')))
+
+# (expiry time, insertion order, username, connection)
+_heap: list[tuple[datetime.datetime, int, str, 'connection.AsyncDBConnection']] = []
+_counter = itertools.count()
+_wakeup: asyncio.Event | None = None
+_scheduler: asyncio.Task | None = None
+
+# Number of connections closed because they expired
+reaped = 0
+
+
+def _push(expiry: datetime.datetime, username: str, conn: 'connection.AsyncDBConnection') -> None:
+    heapq.heappush(_heap, (expiry, next(_counter), username, conn))
+
+def schedule(username: str, conn: 'connection.AsyncDBConnection') -> None:
+    '''Schedules the expiry of a newly opened connection. Must be run on the `engine` event loop.'''
+
+    _push(conn.last_operation_ts + MAX_IDLE_TIME, username, conn)
+    if _wakeup is not None:
+        _wakeup.set()
+
+async def _expire_next() -> None:
+    '''Waits for the earliest expiry, then closes or reschedules the corresponding connection.'''
+    global reaped
+
+    _wakeup.clear()
+    if not _heap:
+        await _wakeup.wait()
+        return
 
+    expiry, _, username, conn = _heap[0]
+    delay = (expiry - datetime.datetime.now()).total_seconds()
+    if delay > 0:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        return
 
-def _connection_cleanup_thread():
-    connections = connection.connections
-    conn_lock = connection.conn_lock
+    heapq.heappop(_heap)
 
+    # The connection has already been closed (e.g. evicted to make room for other users)
+    if connection.connections.get(username) is not conn:
+        return
+
+    now = datetime.datetime.now()
+    next_expiry = conn.last_operation_ts + MAX_IDLE_TIME
+    if next_expiry > now:
+        _push(next_expiry, username, conn)
+        return
+
+    if await connection.close_connection(username):
+        reaped += 1
+        messages.info(f"Closed expired connection for user: {username}")
+    else:
+        # In use at the moment: check again later
+        _push(now + MAX_IDLE_TIME, username, conn)
+
+async def _expiry_scheduler() -> None:
     while True:
-        now = datetime.datetime.now()
-        for username, conn in connections.items():
-            if now - conn.last_operation_ts <= MAX_CONNECTION_AGE:
-                continue
-        
-            with conn_lock:
-                try:
-                    connections[username].close()
-                    del connections[username]
-                    messages.info(f"Closed expired connection for user: {username}")
-                except Exception as e:
-                    messages.error(f"Error closing connection for user {username}: {e}")
-
-        time.sleep(CLEANUP_INTERVAL_SECONDS)
-
-def start_cleanup_thread():
+        try:
+            await _expire_next()
+        except Exception as e:
+            messages.error(f"Error expiring connections: {e}")
+
+async def _start() -> None:
+    global _wakeup, _scheduler
+
+    if _scheduler is not None:
+        return
+
+    _wakeup = asyncio.Event()
+    _scheduler = asyncio.create_task(_expiry_scheduler())
+
+def start_expiry_scheduler():
     '''
-    Starts a thread that will periodically check for expired connections
-    and close them if they are older than MAX_CONNECTION_AGE.
+    Starts closing connections that have not been used for more than MAX_IDLE_TIME.
+    Calling this function more than once has no effect.
     '''
-    cleanup_thread = threading.Thread(target=_connection_cleanup_thread, daemon=True)
-    cleanup_thread.start()
-    
\ No newline at end of file
+    engine.run(_start())
+
+def stats() -> dict:
+    '''Statistics about connection expiry.'''
+
+    return {
+        'open': len(connection.connections),
+        'scheduled': len(_heap),
+        'reaped': reaped,
+    }
@@ -0,0 +1,256 @@
+'''
+Autocompletion of schema, table, column and function names.
+
+Each connection keeps an index of the names in the user's database, built from `pg_catalog` the first time
+completions are requested. Completions are served from the index only, without touching the database.
+When a statement may change the catalog (see `queries.CATALOG_STATEMENTS`), the index is refreshed in the background:
+only relations whose catalog rows changed since the last refresh (i.e. with a different `xmin`) have their columns read again.
+Until the refresh completes, completions are served from the previous index.
+'''
+
+from . import connection, engine
+
+import asyncio
+import bisect
+from psycopg2 import extensions
+from dav_tools import messages
+
+# Maximum number of completions returned
+MAX_COMPLETIONS = 50
+
+_SCHEMAS = '''
+    SELECT nspname
+    FROM pg_catalog.pg_namespace
+    WHERE nspname NOT LIKE 'pg\\_%' AND nspname <> 'information_schema'
+'''
+
+_RELATIONS = '''
+    SELECT
+        c.oid,
+        -- Changes whenever the relation, its schema or its columns are modified (e.g. renamed)
+        concat_ws(':', n.xmin, c.xmin, (SELECT sum(a.xmin::text::bigint) FROM pg_catalog.pg_attribute AS a WHERE a.attrelid = c.oid)),
+        n.nspname,
+        c.relname,
+        c.relkind
+    FROM
+        pg_catalog.pg_class AS c
+        JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE
+        c.relkind IN ('r', 'p', 'v', 'm', 'f')
+        AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+        AND n.nspname NOT LIKE 'pg\\_toast%'
+        AND NOT pg_catalog.pg_is_other_temp_schema(n.oid)
+        AND (pg_catalog.pg_has_role(c.relowner, 'USAGE')
+            OR pg_catalog.has_any_column_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES'))
+'''
+
+_COLUMNS = '''
+    SELECT a.attrelid, a.attname, pg_catalog.format_type(a.atttypid, a.atttypmod)
+    FROM pg_catalog.pg_attribute AS a
+    WHERE a.attrelid = ANY(%s::oid[]) AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attrelid, a.attnum
+'''
+
+# Functions in `pg_catalog` never change, and are read only when the index is first built.
+# Internal functions (type I/O, triggers, ...) are excluded
+_FUNCTIONS = '''
+    SELECT DISTINCT ON (n.nspname, p.proname) n.nspname, p.proname, pg_catalog.pg_get_function_identity_arguments(p.oid)
+    FROM
+        pg_catalog.pg_proc AS p
+        JOIN pg_catalog.pg_namespace AS n ON n.oid = p.pronamespace
+    WHERE
+        p.prokind IN ('f', 'a', 'w')
+        AND p.prorettype NOT IN ('internal'::regtype, 'cstring'::regtype, 'trigger'::regtype, 'event_trigger'::regtype, 'language_handler'::regtype)
+        AND NOT 'internal'::regtype = ANY(p.proargtypes)
+        AND NOT 'cstring'::regtype = ANY(p.proargtypes)
+        AND p.proname !~ '^_'
+        AND {schemas}
+    ORDER BY n.nspname, p.proname, p.oid
+'''
+_BUILTIN_FUNCTIONS  = _FUNCTIONS.format(schemas="n.nspname = 'pg_catalog'")
+_USER_FUNCTIONS     = _FUNCTIONS.format(schemas="n.nspname NOT IN ('pg_catalog', 'information_schema') AND NOT pg_catalog.pg_is_other_temp_schema(n.oid)")
+
+_RELATION_KINDS = {'r': 'table', 'p': 'table', 'v': 'view', 'm': 'view', 'f': 'table'}
+
+
+class Completion:
+    '''A name that can be inserted, with a short description.'''
+
+    def __init__(self, name: str, kind: str, detail: str):
+        self.name = name
+        self.kind = kind
+        self.detail = detail
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'detail': self.detail,
+        }
+
+
+class _Index:
+    '''
+    Names in a database, sorted for prefix lookup. Once built, an index is never modified:
+    refreshes build a new one, so that it can be read from any thread.
+    '''
+
+    def __init__(self, schemas: list[str], relations: dict[int, tuple[str, list[Completion]]],
+                 builtin_functions: list[Completion], user_functions: list[Completion]):
+        self.schemas = schemas
+        # oid -> (version, completions for the relation and its columns)
+        self.relations = relations
+        self.builtin_functions = builtin_functions
+        self.user_functions = user_functions
+
+        items = [Completion(schema, 'schema', 'schema') for schema in schemas]
+        for _, completions in relations.values():
+            items.extend(completions)
+        items.extend(builtin_functions)
+        items.extend(user_functions)
+
+        items.sort(key=lambda item: (item.name.lower(), item.kind, item.detail))
+        self._keys = [item.name.lower() for item in items]
+        self._items = items
+
+    def complete(self, prefix: str, limit: int) -> list[Completion]:
+        prefix = prefix.lower()
+        result = []
+        seen = set()
+
+        for i in range(bisect.bisect_left(self._keys, prefix), len(self._keys)):
+            if len(result) >= limit or not self._keys[i].startswith(prefix):
+                break
+            item = self._items[i]
+            # Same name for several objects (e.g. a column in many tables): show it once for each kind
+            if (item.name, item.kind) in seen:
+                continue
+            seen.add((item.name, item.kind))
+            result.append(item)
+
+        return result
+
+
+def _relation_completions(schema: str, name: str, kind: str, columns: list[tuple[str, str]]) -> list[Completion]:
+    '''Completions for a relation, both plain and schema-qualified, and for its columns, both plain and table-qualified.'''
+
+    kind = _RELATION_KINDS[kind]
+    completions = [
+        Completion(name, kind, f'{schema}.{name}'),
+        Completion(f'{schema}.{name}', kind, f'{schema}.{name}'),
+    ]
+    for column, column_type in columns:
+        completions.append(Completion(column, 'column', f'{name}.{column} {column_type}'))
+        completions.append(Completion(f'{name}.{column}', 'column', column_type))
+    return completions
+
+def _function_completions(rows: list[tuple[str, str, str]]) -> list[Completion]:
+    completions = []
+    for schema, name, arguments in rows:
+        completions.append(Completion(name, 'function', f'{schema}.{name}({arguments})'))
+        if schema != 'pg_catalog':
+            completions.append(Completion(f'{schema}.{name}', 'function', f'{schema}.{name}({arguments})'))
+    return completions
+
+async def _fetch(conn: 'connection.AsyncDBConnection', query: str, params: tuple | None = None) -> list[tuple]:
+    with conn.cursor() as cur:
+        await conn.execute(cur, query, params)
+        return cur.fetchall()
+
+async def _build(conn: 'connection.AsyncDBConnection', previous: _Index | None) -> _Index:
+    '''Builds the index of a connection, reusing the columns of the relations that did not change since `previous`.'''
+
+    schemas = [row[0] for row in await _fetch(conn, _SCHEMAS)]
+    relation_rows = await _fetch(conn, _RELATIONS)
+
+    relations = {}
+    changed = []
+    for oid, version, schema, name, kind in relation_rows:
+        if previous is not None and previous.relations.get(oid, (None,))[0] == version:
+            relations[oid] = previous.relations[oid]
+        else:
+            changed.append((oid, version, schema, name, kind))
+
+    columns: dict[int, list[tuple[str, str]]] = {}
+    if changed:
+        for oid, column, column_type in await _fetch(conn, _COLUMNS, ([oid for oid, *_ in changed],)):
+            columns.setdefault(oid, []).append((column, column_type))
+    for oid, version, schema, name, kind in changed:
+        relations[oid] = (version, _relation_completions(schema, name, kind, columns.get(oid, [])))
+
+    if previous is not None:
+        builtin_functions = previous.builtin_functions
+    else:
+        builtin_functions = _function_completions(await _fetch(conn, _BUILTIN_FUNCTIONS))
+    user_functions = _function_completions(await _fetch(conn, _USER_FUNCTIONS))
+
+    return _Index(schemas, relations, builtin_functions, user_functions)
+
+async def _refresh(username: str) -> None:
+    '''Builds or refreshes the index for a user, if their connection is not in the middle of a transaction.'''
+
+    try:
+        async with connection.lease(username) as conn, conn.lock:
+            # Catalog queries would become part of the user's transaction, and fail if it is aborted
+            if conn.connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                return
+
+            conn.completions_stale = False
+            try:
+                conn.completions = await _build(conn, conn.completions)
+            except Exception:
+                conn.completions_stale = True
+                raise
+    except Exception as e:
+        messages.warning(f'Cannot refresh completions for user {username}: {e}')
+    finally:
+        _refreshing.discard(username)
+
+_refreshing: set[str] = set()
+
+def schedule_refresh(username: str) -> None:
+    '''Refreshes the index of a user in the background, unless a refresh is already scheduled. Must be run on the `engine` event loop.'''
+
+    if username in _refreshing:
+        return
+    _refreshing.add(username)
+    asyncio.create_task(_refresh(username))
+
+def invalidate(conn: 'connection.AsyncDBConnection') -> None:
+    '''Marks the index of a connection as outdated. Must be run on the `engine` event loop.'''
+    conn.completions_stale = True
+
+def statement_executed(conn: 'connection.AsyncDBConnection') -> None:
+    '''
+    Refreshes the index of a connection after a statement, if it is outdated and the connection is not in a transaction.
+    Must be run on the `engine` event loop.
+    '''
+
+    if conn.completions is not None and conn.completions_stale and conn.connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE:
+        schedule_refresh(conn.username)
+
+def complete(username: str, prefix: str, limit: int = MAX_COMPLETIONS) -> list[Completion]:
+    '''
+    Returns the names starting with `prefix` (case-insensitive) in the user's database.
+    `prefix` can be qualified, e.g. `public.` lists the relations in a schema, and `table.` lists the columns of a table.
+    Never queries the database: if the index has not been built yet, its creation is started and no completions are returned.
+
+    Parameters:
+        username (str): The username of the database user.
+        prefix (str): The beginning of the name.
+        limit (int): Maximum number of completions.
+    Returns:
+        list[Completion]: The completions, sorted by name.
+    '''
+
+    conn = connection.connections.get(username)
+    index = conn.completions if conn is not None else None
+
+    if index is None:
+        asyncio.run_coroutine_threadsafe(_start_refresh(username), engine.get_loop())
+        return []
+
+    return index.complete(prefix, min(limit, MAX_COMPLETIONS))
+
+async def _start_refresh(username: str) -> None:
+    schedule_refresh(username)
@@ -1,14 +1,49 @@
+import asyncio
+import contextlib
 import datetime
 import os
 import psycopg2
-from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
 from dav_tools import messages
 
+from . import cleanup, engine
+from ..admin import users as admin_users
+
 HOST        =       os.getenv('USER_DB_HOST', 'localhost')
 PORT        =   int(os.getenv('USER_DB_PORT', '5432'))
 
+# Default maximum duration of a single statement, for users without a specific setting
+STATEMENT_TIMEOUT_SECONDS = int(os.getenv('STATEMENT_TIMEOUT_SECONDS', '60'))
+# Maximum number of connections kept open at the same time. Must be lower than `max_connections` on the users database
+MAX_CONNECTIONS = int(os.getenv('MAX_USER_CONNECTIONS', '400'))
+
+# Session settings saved when a connection is closed, and restored when the user connects again
+SESSION_SETTINGS = ('search_path',)
+# Maximum number of cancellation requests sent at the same time
+CANCEL_WORKERS = int(os.getenv('CANCEL_WORKERS', '4'))
+
+# Cancellation requests open a new connection to the server, which blocks: they are sent outside the event loop,
+# on their own threads, so that they are not held up by connections being opened
+_cancel_executor = ThreadPoolExecutor(max_workers=CANCEL_WORKERS, thread_name_prefix='users-db-cancel')
+
+
+class TooManyConnections(Exception):
+    '''Raised when the connection limit has been reached and no connection can be closed to make room.'''
+
 class DBConnection:
-    def __init__(self, dbname: str, username: str, autocommit: bool = True):
+    def __init__(self, dbname: str, username: str, autocommit: bool = True, statement_timeout: int | None = None):
+        '''
+        Opens a connection to the users database.
+
+        Parameters:
+            dbname (str): The database to connect to.
+            username (str): The user to connect as.
+            autocommit (bool): Whether to run each statement in its own transaction.
+            statement_timeout (int | None): Maximum duration of a single statement, in seconds. None or 0 means no limit.
+        '''
+
         self.dbname = dbname
         self.username = username
         self.autocommit = autocommit
@@ -19,7 +54,8 @@ class DBConnection:
             port=PORT,
             dbname=dbname,
             user=username,
-            password='' # Password is not needed for the db_users
+            password='', # Password is not needed for the db_users
+            options=f'-c statement_timeout={(statement_timeout or 0) * 1000}'
         )
 
         self.connection.autocommit = autocommit
@@ -32,6 +68,14 @@ class DBConnection:
 
     def cursor(self):
         return self.connection.cursor()
+
+    def cancel(self):
+        '''
+        Cancels the statement currently running on this connection, if any.
+        Can be called from a different thread than the one running the statement.
+        Blocks until the server has received the request, on a new network connection.
+        '''
+        self.connection.cancel()
     
     def rollback(self):
         self.connection.rollback()
@@ -74,24 +118,266 @@ class DBConnection:
             pass
         
 
-connections: dict[str, DBConnection] = {}
-conn_lock = Lock()
+class AsyncDBConnection(DBConnection):
+    '''
+    Asynchronous connection to the users database, living on the `engine` event loop.
+    The connection is always in autocommit mode: transactions must be managed with explicit statements.
+    '''
+
+    def __init__(self, dbname: str, username: str, statement_timeout: int | None = None):
+        '''Starts opening a connection. `wait_ready` must be awaited before using it.'''
+
+        self.dbname = dbname
+        self.username = username
+        self.autocommit = True
+
+        # Operations on the same connection cannot overlap
+        self.lock = asyncio.Lock()
+        # Number of requests currently using the connection (see `lease`): the connection is not closed while in use
+        self.leases = 0
+        # Whether the connection has been opened in advance (see `prewarm`), and whether any request has used it
+        self.prewarmed = False
+        self.used = False
+
+        # Content hash of the last dataset initialized in the database, if it has not been modified since
+        self.dataset_hash: str | None = None
+        # Results of builtin catalog queries, cleared when a statement may change them (see `queries.CATALOG_STATEMENTS`)
+        self.catalog: dict = {}
+        # Whether the transaction in progress may have changed the catalog: ending it may change the catalog again
+        self.catalog_changed_in_transaction = False
+        # Index of the names in the database, for autocompletion, and whether it is outdated (see `completion`)
+        self.completions = None
+        self.completions_stale = False
+
+        self.last_operation_ts = datetime.datetime.now()
+        self.connection = psycopg2.connect(
+            host=HOST,
+            port=PORT,
+            dbname=dbname,
+            user=username,
+            password='', # Password is not needed for the db_users
+            options=f'-c statement_timeout={(statement_timeout or 0) * 1000}',
+            async_=True
+        )
+
+    async def wait_ready(self):
+        '''Waits until the connection is established.'''
+        await engine.wait(self.connection)
+
+    async def execute(self, cur, query: str, params: tuple | None = None):
+        '''Executes a query on the given cursor of this connection, and waits for it to complete.'''
+        cur.execute(query, params)
+        await engine.wait(self.connection)
+
+    def cancel(self) -> asyncio.Future:
+        '''
+        Cancels the statement currently running on this connection, if any.
+        Must be run on the `engine` event loop. Returns immediately: the returned future completes once the server has received the request.
+        '''
+
+        future = asyncio.get_running_loop().run_in_executor(_cancel_executor, super().cancel)
+        future.add_done_callback(self._cancel_done)
+        return future
+
+    def _cancel_done(self, future: asyncio.Future) -> None:
+        if future.exception() is not None:
+            messages.warning(f"Cannot cancel query for user {self.username}: {future.exception()}")
+
+
+# Open connections, from the least to the most recently used
+connections: OrderedDict[str, AsyncDBConnection] = OrderedDict()
+
+# State of the sessions of users whose connection has been closed
+_saved_sessions: dict[str, tuple[dict[str, str], str | None]] = {}
+
+def _is_idle(conn: AsyncDBConnection) -> bool:
+    '''Whether a connection can be closed without affecting its user, i.e. it is not in use nor inside a transaction.'''
+    return conn.leases == 0 and not conn.lock.locked() and conn.connection.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+async def close_connection(username: str) -> bool:
+    '''
+    Closes the connection for the given username, saving its session state so that it can be restored later.
+    Connections in use are not closed.
+    Must be run on the `engine` event loop.
+
+    Returns:
+        bool: Whether the connection has been closed.
+    '''
+
+    conn = connections.get(username)
+    if conn is None or conn.leases > 0:
+        return False
+
+    async with conn.lock:
+        # A request may have started using the connection while waiting for the lock
+        if conn.leases > 0:
+            return False
 
-def get_connection(username: str, autocommit: bool = True) -> DBConnection:
+        try:
+            settings = {}
+            with conn.cursor() as cur:
+                for setting in SESSION_SETTINGS:
+                    await conn.execute(cur, f'SHOW {setting}')
+                    settings[setting] = cur.fetchone()[0]
+            _saved_sessions[username] = (settings, conn.dataset_hash)
+        except Exception as e:
+            messages.warning(f"Cannot save session state for user {username}: {e}")
+
+        if connections.get(username) is conn:
+            del connections[username]
+        conn.close()
+
+    if conn.prewarmed and not conn.used:
+        _prewarm_stats['unused'] += 1
+
+    return True
+
+async def _restore_session(username: str, conn: AsyncDBConnection) -> None:
+    '''Restores the session state saved when the previous connection of the user was closed.'''
+
+    saved = _saved_sessions.pop(username, None)
+    if saved is None:
+        return
+
+    settings, conn.dataset_hash = saved
+    with conn.cursor() as cur:
+        for setting, value in settings.items():
+            cur.execute('SELECT set_config(%s, %s, false)', (setting, value))
+            await engine.wait(conn.connection)
+
+async def _make_room() -> None:
+    '''Closes the least recently used idle connection, if the connection limit has been reached.'''
+
+    # Connections being opened count towards the limit, including the one making room
+    if len(connections) + len(_connecting) <= MAX_CONNECTIONS:
+        return
+
+    for username, conn in list(connections.items()):
+        if _is_idle(conn) and await close_connection(username):
+            messages.info(f"Closed least recently used connection for user: {username}")
+            return
+
+    raise TooManyConnections('Too many users are connected at the moment, please try again later')
+
+# Connections being opened, by username
+_connecting: dict[str, asyncio.Task] = {}
+
+async def _open_connection(username: str, prewarmed: bool) -> AsyncDBConnection:
+    '''Opens a new connection for the given username and adds it to the open connections.'''
+
+    loop = asyncio.get_running_loop()
+    statement_timeout = await loop.run_in_executor(None, admin_users.get_statement_timeout, username)
+    if statement_timeout is None:
+        statement_timeout = STATEMENT_TIMEOUT_SECONDS
+
+    await _make_room()
+
+    # Starting a connection resolves the host name, which blocks: do it outside the event loop
+    conn = await loop.run_in_executor(None, lambda: AsyncDBConnection(dbname=username, username=username, statement_timeout=statement_timeout))
+    try:
+        await conn.wait_ready()
+        await _restore_session(username, conn)
+    except BaseException:
+        conn.close()
+        raise
+
+    conn.prewarmed = prewarmed
+    connections[username] = conn
+    cleanup.schedule(username, conn)
+    return conn
+
+def _start_connecting(username: str, prewarmed: bool = False) -> asyncio.Task:
+    '''Starts opening a connection for the given username. Other requests for the same user wait for the same task.'''
+
+    task = asyncio.create_task(_open_connection(username, prewarmed))
+    _connecting[username] = task
+    task.add_done_callback(lambda done: _connecting.get(username) is done and _connecting.pop(username))
+    return task
+
+async def get_connection(username: str) -> AsyncDBConnection:
     '''
-    Returns the connection for the given username.
-    If the connection does not exist, it raises an exception.
+    Returns the connection for the given username, opening it if it does not exist.
+    If the connection limit has been reached, the least recently used idle connection is closed.
+
+    Only one connection is opened for each user: concurrent requests from the same user wait for the same connection,
+    while connections for different users are opened concurrently.
+    Must be run on the `engine` event loop.
     '''
 
     if username in connections:
+        connections.move_to_end(username)
         conn = connections[username]
         conn.clear_notices()
         return conn
 
-    with conn_lock:
-        conn = DBConnection(dbname=username, username=username, autocommit=autocommit)
-        connections[username] = conn
+    task = _connecting.get(username)
+    if task is None:
+        task = _start_connecting(username)
 
-        return conn
-    
-    
\ No newline at end of file
+    # A cancelled request must not cancel the connection other requests are waiting for
+    return await asyncio.shield(task)
+
+@contextlib.asynccontextmanager
+async def lease(username: str) -> AsyncIterator[AsyncDBConnection]:
+    '''
+    Returns the connection for the given username, which is not closed until the context is exited.
+    Must be run on the `engine` event loop.
+    '''
+
+    conn = await get_connection(username)
+
+    if not conn.used:
+        conn.used = True
+        _prewarm_stats['hits' if conn.prewarmed else 'misses'] += 1
+
+    conn.leases += 1
+    try:
+        yield conn
+    finally:
+        conn.leases -= 1
+        conn.update_last_operation_ts()
+
+# Pre-warmed connections: `hits` and `misses` count the first request on each connection,
+# depending on whether the connection had been pre-warmed or had to be opened on demand
+_prewarm_stats = {
+    'scheduled': 0,
+    'skipped': 0,
+    'failed': 0,
+    'hits': 0,
+    'misses': 0,
+    'unused': 0,
+}
+
+async def _prewarm(username: str) -> None:
+    if username in connections or username in _connecting:
+        return
+
+    # Pre-warming is speculative: never close other users' connections to make room
+    if len(connections) + len(_connecting) >= MAX_CONNECTIONS:
+        _prewarm_stats['skipped'] += 1
+        return
+
+    try:
+        await _start_connecting(username, prewarmed=True)
+    except Exception as e:
+        _prewarm_stats['failed'] += 1
+        messages.warning(f"Cannot pre-warm connection for user {username}: {e}")
+
+def prewarm(username: str) -> None:
+    '''
+    Opens the connection for the given username in the background, including its session setup
+    (statement timeout, restored session settings), so that the first request does not have to wait for it.
+    Returns immediately. Can be called from any thread.
+    '''
+
+    _prewarm_stats['scheduled'] += 1
+    asyncio.run_coroutine_threadsafe(_prewarm(username), engine.get_loop())
+
+def prewarm_stats() -> dict:
+    '''Statistics about pre-warmed connections.'''
+
+    first_uses = _prewarm_stats['hits'] + _prewarm_stats['misses']
+    return {
+        **_prewarm_stats,
+        'hit_rate': _prewarm_stats['hits'] / first_uses if first_uses else None,
+    }
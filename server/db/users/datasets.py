@@ -0,0 +1,233 @@
+'''
+Initialization of exercise datasets in the users' databases.
+
+Datasets are stored already split into statements, together with a content hash (see `db.admin.dataset`).
+Each dataset is run only once, in a temporary database, and the result is saved as a dump.
+Users' databases are then initialized by restoring the dump, which is much faster than running the script again.
+If the dump cannot be created or restored (e.g. `pg_dump` is not installed, or the script fails),
+the statements are run in the user's database, in bulk mode (see `queries.execute_bulk`).
+
+Initialization is a request like any other: it runs during its turn in the queue of the user (see `request_queue`),
+so that it does not race the user's other requests.
+'''
+
+from .connection import DBConnection, HOST, PORT, AsyncDBConnection, lease
+from .request_queue import CancelToken, Turn
+from . import completion, engine, queries
+
+import asyncio
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable
+from dav_tools import messages
+from psycopg2 import extensions
+from dav_tools.database import sql
+
+from server.sql import SQLCode, QueryResult, QueryResultMessage
+
+# Directory where dataset dumps are stored
+SNAPSHOT_DIR    = os.getenv('DATASET_SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'lensql_datasets'))
+# PostgreSQL client programs, must be at least as recent as the users database server
+PG_DUMP         = os.getenv('PG_DUMP', 'pg_dump')
+PG_RESTORE      = os.getenv('PG_RESTORE', 'pg_restore')
+# Maximum time allowed for creating or restoring a dump
+SNAPSHOT_TIMEOUT_SECONDS = int(os.getenv('SNAPSHOT_TIMEOUT_SECONDS', '300'))
+# Maximum number of dumps created or restored at the same time
+SNAPSHOT_WORKERS = int(os.getenv('SNAPSHOT_WORKERS', '4'))
+
+# Statements changing the session state, which is not part of a dump
+SESSION_STATEMENTS = ('SET', 'RESET')
+
+# Dumps are created and restored on their own threads: they can take minutes,
+# and must not hold up the executor used to open connections (see `connection._open_connection`)
+_executor = ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS, thread_name_prefix='dataset-snapshot')
+# Dumps being created, by fingerprint. Only accessed from the `engine` event loop
+_builds: dict[str, asyncio.Future] = {}
+# Datasets for which a dump could not be created
+_unsupported: set[str] = set()
+
+
+def _snapshot_path(fingerprint: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f'{fingerprint}.dump')
+
+def _run(args: list[str], username: str) -> None:
+    '''Runs a PostgreSQL client program against the users database server, raising an exception if it fails.'''
+
+    env = {**os.environ, 'PGHOST': HOST, 'PGPORT': str(PORT), 'PGUSER': username}
+    result = subprocess.run(args, env=env, capture_output=True, text=True, timeout=SNAPSHOT_TIMEOUT_SECONDS)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+
+def _drop_build_database(dbname: str, role: str) -> None:
+    with DBConnection(dbname='postgres', username='postgres') as admin_conn:
+        with admin_conn.cursor() as cur:
+            cur.execute(sql.SQL('DROP DATABASE IF EXISTS {dbname}').format(dbname=sql.Identifier(dbname)))
+            cur.execute(sql.SQL('DROP ROLE IF EXISTS {role}').format(role=sql.Identifier(role)))
+
+def _build_snapshot(statements: list[str], fingerprint: str) -> None:
+    '''
+    Runs the dataset statements in a temporary database and dumps it.
+    The statements are run by a temporary role with the same privileges as a user (see `add_user`), not by a superuser,
+    so that the result is the same as running them in a user's database.
+    '''
+
+    dbname = f'lensql_dataset_{fingerprint[:16]}'
+    role = dbname
+    path = _snapshot_path(fingerprint)
+
+    # Left over by a build that did not complete
+    _drop_build_database(dbname, role)
+
+    try:
+        with DBConnection(dbname='postgres', username='postgres') as admin_conn:
+            with admin_conn.cursor() as cur:
+                cur.execute(sql.SQL('CREATE DATABASE {dbname} TEMPLATE template0').format(dbname=sql.Identifier(dbname)))
+                cur.execute(sql.SQL('CREATE ROLE {role} WITH LOGIN CREATEROLE').format(role=sql.Identifier(role)))
+                cur.execute(sql.SQL('GRANT ALL PRIVILEGES ON DATABASE {dbname} TO {role}').format(
+                    dbname=sql.Identifier(dbname),
+                    role=sql.Identifier(role)
+                ))
+
+        with DBConnection(dbname=dbname, username='postgres') as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL('ALTER SCHEMA public OWNER TO {role}').format(role=sql.Identifier(role)))
+
+        with DBConnection(dbname=dbname, username=role) as conn:
+            with conn.cursor() as cur:
+                for batch in queries.split_batches(statements):
+                    cur.execute('\n'.join(batch))
+
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        _run([PG_DUMP, '--format=custom', '--no-owner', '--no-acl', f'--file={tmp_path}', dbname], 'postgres')
+        os.replace(tmp_path, path)
+    finally:
+        _drop_build_database(dbname, role)
+
+def _create_snapshot(statements: list[str], fingerprint: str) -> str | None:
+    '''Creates the dump for the given dataset. Returns its path, or None if it cannot be created.'''
+
+    try:
+        _build_snapshot(statements, fingerprint)
+        messages.info(f'Created dataset snapshot {fingerprint[:16]}')
+        return _snapshot_path(fingerprint)
+    except Exception as e:
+        messages.warning(f'Cannot create dataset snapshot {fingerprint[:16]}, falling back to script execution: {e}')
+        _unsupported.add(fingerprint)
+        return None
+
+async def _get_snapshot(statements: list[str], fingerprint: str) -> str | None:
+    '''
+    Returns the path of the dump for the given dataset, creating it if needed.
+    Only one dump is created at a time for a given dataset: other requests wait for it on the event loop, without using a thread.
+    Must be run on the `engine` event loop.
+
+    Returns:
+        str | None: The path of the dump, or None if it cannot be created.
+    '''
+
+    path = _snapshot_path(fingerprint)
+
+    if os.path.exists(path):
+        return path
+    if fingerprint in _unsupported:
+        return None
+
+    build = _builds.get(fingerprint)
+    if build is None:
+        build = asyncio.get_running_loop().run_in_executor(_executor, _create_snapshot, statements, fingerprint)
+        _builds[fingerprint] = build
+        build.add_done_callback(lambda _: _builds.pop(fingerprint, None))
+
+    # A cancelled request must not cancel the dump other requests are waiting for
+    return await asyncio.shield(build)
+
+def _restore(username: str, path: str) -> bool:
+    '''Restores a dump in the user's database, as the user. Returns whether the restore succeeded.'''
+
+    try:
+        _run([PG_RESTORE, '--no-owner', '--no-acl', '--clean', '--if-exists', '--single-transaction', f'--dbname={username}', path], username)
+        return True
+    except Exception as e:
+        messages.warning(f'Cannot restore dataset snapshot for user {username}, falling back to script execution: {e}')
+        return False
+
+def _set_dataset_hash(conn: AsyncDBConnection, content_hash: str) -> None:
+    conn.dataset_hash = content_hash
+    # The database may have been restored from a dump, outside of the connection
+    conn.catalog.clear()
+    completion.invalidate(conn)
+    completion.statement_executed(conn)
+
+async def _init_in_turn(turn: Turn, statements: list[str], content_hash: str, force: bool) -> AsyncIterator[QueryResult]:
+    '''Initializes a dataset during the turn of the request, see `init`.'''
+
+    session_statements = [statement for statement in statements if SQLCode(statement).first_token in SESSION_STATEMENTS]
+    loop = asyncio.get_running_loop()
+
+    async with lease(turn.username) as conn:
+        turn.connection = conn
+
+        if not force and conn.dataset_hash == content_hash:
+            yield QueryResultMessage(
+                message='SKIP',
+                query='-- Dataset already initialized',
+                notices=[])
+            async for result in queries.execute_in_turn(turn, session_statements, strip_comments=False):
+                yield result
+            return
+
+        # The dump is restored on a separate connection: it would wait for the locks held by an open transaction
+        restored = False
+        if conn.connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            messages.info(f'Transaction in progress for user {turn.username}, running the dataset script')
+        elif not turn.cancelled:
+            path = await _get_snapshot(statements, content_hash)
+            if path is not None and not turn.cancelled:
+                restored = await loop.run_in_executor(_executor, _restore, turn.username, path)
+
+        if not restored:
+            success = True
+            async for result in queries.execute_bulk_in_turn(turn, statements):
+                success = success and result.success
+                yield result
+
+            if success and not turn.cancelled:
+                _set_dataset_hash(conn, content_hash)
+            return
+
+        yield QueryResultMessage(
+            message=f'RESTORE {len(statements)}',
+            query='-- Dataset restored from snapshot',
+            notices=[])
+
+        async for result in queries.execute_in_turn(turn, session_statements, strip_comments=False):
+            yield result
+        _set_dataset_hash(conn, content_hash)
+
+def init(username: str, statements: list[str], content_hash: str | None, *, force: bool = False, token: CancelToken | None = None) -> Iterable[QueryResult]:
+    '''
+    Initializes a dataset in the user's database.
+
+    The dataset is restored from a dump, then the statements changing the session state (e.g. `SET search_path`)
+    are run on the user's connection, so that the result is the same as running all the statements.
+    If the database already holds the same version of the dataset, and has not been modified since, only the
+    session statements are run.
+    If the user has a transaction in progress, the statements are run on the user's connection instead of restoring the dump.
+
+    Parameters:
+        username (str): The username of the database user.
+        statements (list[str]): The dataset statements, in order.
+        content_hash (str | None): The content hash of the dataset. None if there is no dataset.
+        force (bool): Whether to initialize the dataset even if the database already holds it.
+        token (CancelToken | None): Used to cancel the initialization.
+    Returns:
+        Iterable[QueryResult]: The results of the executed statements.
+    '''
+
+    if content_hash is None:
+        return iter([])
+
+    return engine.iterate(queries.serialized(username, '\n'.join(statements), lambda turn: _init_in_turn(turn, statements, content_hash, force), token))
@@ -0,0 +1,74 @@
+'''
+Event loop running all the operations on the users database.
+
+Connections to the users database are asynchronous: they all live on a single asyncio event loop,
+running on a dedicated thread, so that a slow query only blocks the request that issued it.
+Request threads submit work to the loop with `run` and `iterate`, and wait for its results.
+'''
+
+import asyncio
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, TypeVar
+from psycopg2 import extensions, OperationalError
+
+T = TypeVar('T')
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    '''Returns the event loop, starting it the first time it is needed.'''
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='users-db-loop', daemon=True).start()
+
+    return _loop
+
+def run(coro: Awaitable[T]) -> T:
+    '''Runs a coroutine on the event loop and waits for its result. Must not be called from the loop itself.'''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+def iterate(agen: AsyncIterator[T]) -> Iterator[T]:
+    '''
+    Exposes an asynchronous generator running on the event loop as a regular generator.
+    Closing the returned generator also closes `agen`.
+    '''
+
+    try:
+        while True:
+            try:
+                item = run(agen.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        run(agen.aclose())
+
+async def wait(connection: extensions.connection) -> None:
+    '''Waits until the pending operation on an asynchronous psycopg2 connection has completed.'''
+
+    loop = asyncio.get_running_loop()
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+
+        if state == extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise OperationalError(f'Unexpected poll state: {state}')
+
+        fd = connection.fileno()
+        ready = loop.create_future()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
@@ -1,61 +1,479 @@
-from ..connection import get_connection
+from ..connection import lease, AsyncDBConnection
+from .. import engine, request_queue
+from .. import completion
 from . import builtin
 
-import pandas as pd
-from typing import Iterable
-from dav_tools import messages
+import os
+import re
+from typing import AsyncIterator, Callable, Iterable
+from psycopg2 import errorcodes, extensions
 
-from server.sql import SQLCode, SQLException, QueryResult, QueryResultDataset, QueryResultError, QueryResultMessage
+from server.sql import SQLCode, SQLException, ResultSet, QueryResult, QueryResultDataset, QueryResultError, QueryResultMessage, QueryResultQueued, QueryResultRejected
 
-def execute(username: str, query_str: str, *, strip_comments: bool = True) -> Iterable[QueryResult]:
+# Maximum number of rows returned for a single statement
+MAX_RESULT_ROWS     = int(os.getenv('MAX_RESULT_ROWS', '10000'))
+# Maximum (approximate) size in bytes of the rows returned for a single statement
+MAX_RESULT_BYTES    = int(os.getenv('MAX_RESULT_BYTES', str(8 * 1024 * 1024)))
+# Number of rows fetched from the server at a time
+FETCH_BATCH_SIZE    = int(os.getenv('FETCH_BATCH_SIZE', '500'))
+# Maximum number of statements, and their total size in bytes, sent in a single round trip in bulk mode
+BULK_BATCH_STATEMENTS   = int(os.getenv('BULK_BATCH_STATEMENTS', '1000'))
+BULK_BATCH_BYTES        = int(os.getenv('BULK_BATCH_BYTES', str(1024 * 1024)))
+
+# Statements that can be run through a server-side cursor
+STREAMABLE_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'TABLE')
+# Statements that do not modify the database contents (see `AsyncDBConnection.dataset_hash`).
+# Queries are not included: `SELECT ... INTO`, `SELECT nextval(...)` or functions with side effects modify the database,
+# and not all of these changes can be detected afterwards (e.g. `nextval` does not always assign a transaction id)
+READ_ONLY_STATEMENTS = ('SHOW', 'SET', 'RESET')
+# Statements that may change the results of builtins (see `AsyncDBConnection.catalog`): DDL, privileges, search path,
+# and rollbacks, which may undo DDL. Functions running DDL (e.g. `SELECT my_function()`) are not detected.
+# Queries creating a table (`SELECT ... INTO`) and the end of transactions that changed the catalog are handled separately
+CATALOG_STATEMENTS = ('CREATE', 'ALTER', 'DROP', 'TRUNCATE', 'COMMENT', 'GRANT', 'REVOKE', 'REASSIGN', 'SECURITY', 'IMPORT',
+                      'SET', 'RESET', 'DISCARD', 'ROLLBACK', 'ABORT', 'DO', 'CALL')
+# Queries that may create a table with `INTO`
+SELECT_INTO_STATEMENTS = ('SELECT', 'WITH')
+# Statements ending a transaction: they undo it instead, if it failed
+COMMIT_STATEMENTS = ('COMMIT', 'END')
+# Statements that cannot be batched, since they control transactions or cannot run inside a transaction block
+UNBATCHABLE_STATEMENTS = ('BEGIN', 'START', 'COMMIT', 'END', 'ROLLBACK', 'ABORT', 'SAVEPOINT', 'RELEASE', 'PREPARE', 'VACUUM', 'REINDEX')
+# Clauses that prevent statements from running inside a transaction block, e.g. `CREATE DATABASE`
+UNBATCHABLE_CLAUSES = ('DATABASE', 'TABLESPACE', 'CONCURRENTLY', 'SYSTEM', 'SUBSCRIPTION')
+
+_INTO = re.compile(r'\bINTO\b', re.IGNORECASE)
+
+_CURSOR_NAME = 'lensql_cursor'
+_SAVEPOINT_NAME = 'lensql_cursor_savepoint'
+_DECLARE_CURSOR = f'DECLARE {_CURSOR_NAME} NO SCROLL CURSOR FOR '
+
+
+class _DeclareCursorError(Exception):
+    '''Raised when a statement fails while being declared as a cursor. `error` is the exception raised by the server.'''
+
+    def __init__(self, error: Exception):
+        super().__init__(error)
+        self.error = error
+
+
+def _row_size(row: tuple) -> int:
+    '''Approximate size of a row, as it will be rendered.'''
+    return sum(len(str(value)) for value in row if value is not None) + len(row)
+
+async def _fetch_rows(fetch, max_rows: int, max_bytes: int) -> tuple[list[tuple], bool]:
     '''
-    Executes the given SQL queries and returns the results.
-    The queries will be separated into individual statements.
+    Fetches rows in batches until there are no more rows or a budget is exceeded.
 
     Parameters:
-        username (str): The username of the database user.
-        query_str (str): The SQL query string to execute. The query string can contain multiple SQL statements separated by semicolons.
+        fetch (Callable[[int], Awaitable[list[tuple]]]): Coroutine function returning at most the given number of rows.
+        max_rows (int): Maximum number of rows to keep.
+        max_bytes (int): Maximum approximate size of the rows to keep.
     Returns:
-        Iterable[QueryResult]: An iterable of QueryResult objects.
+        tuple[list[tuple], bool]: The rows, and whether the result has been truncated.
     '''
 
-    for statement in SQLCode(query_str).split():
-    
-        # NOTE: do not `strip_comments` from the SQL code for very large queries
-        #   as it takes the server too much time to parse the SQL code,
-        #   causing a timeout error in the client.
-        if strip_comments:
-            statement = statement.strip_comments()
+    rows = []
+    size = 0
+
+    while True:
+        batch = await fetch(min(FETCH_BATCH_SIZE, max_rows - len(rows) + 1))
+        if not batch:
+            return rows, False
+
+        for row in batch:
+            size += _row_size(row)
+            if len(rows) >= max_rows or size > max_bytes:
+                return rows, True
+            rows.append(row)
+
+async def _execute_streaming(conn: AsyncDBConnection, statement: SQLCode, max_rows: int, max_bytes: int) -> tuple[list[str], list[tuple], bool] | None:
+    '''
+    Executes a statement through a server-side cursor, so that only the rows within budget are transferred.
+
+    A transaction is opened if needed, since cursors only exist inside transactions.
+    If the user is already inside a transaction, the cursor is declared in a savepoint instead,
+    so that the user's transaction is not affected if the statement cannot be declared as a cursor.
+
+    Returns:
+        tuple[list[str], list[tuple], bool] | None: Column names, rows and whether the result has been truncated.
+            None if the statement cannot be run through a cursor (e.g. `WITH` containing an `INSERT`).
+    Raises:
+        _DeclareCursorError: If the statement fails while being declared, e.g. because it is invalid or has been cancelled.
+            The statement has not been executed, and must not be executed again.
+    '''
+
+    status = conn.connection.info.transaction_status
+    if status == extensions.TRANSACTION_STATUS_IDLE:
+        own_transaction = True
+    elif status == extensions.TRANSACTION_STATUS_INTRANS:
+        own_transaction = False
+    else:
+        return None
+
+    with conn.cursor() as cur:
+        await conn.execute(cur, 'BEGIN' if own_transaction else f'SAVEPOINT {_SAVEPOINT_NAME}')
 
         try:
-            conn = get_connection(username)
-            with conn.cursor() as cur:
-                cur.execute(statement.query)
-                    
-                if cur.description:  # Check if the query has a result set
-                    rows = cur.fetchall()
-                    columns = [desc[0] for desc in cur.description]
-                    yield QueryResultDataset(
-                        result=pd.DataFrame(rows, columns=columns),
+            await conn.execute(cur, f'{_DECLARE_CURSOR}{statement.query}')
+        except Exception as e:
+            # Only this error means that the statement is valid but cannot be a cursor: nothing has been executed yet
+            if getattr(e, 'pgcode', None) == errorcodes.FEATURE_NOT_SUPPORTED:
+                if own_transaction:
+                    await conn.execute(cur, 'ROLLBACK')
+                else:
+                    await conn.execute(cur, f'ROLLBACK TO SAVEPOINT {_SAVEPOINT_NAME}')
+                    await conn.execute(cur, f'RELEASE SAVEPOINT {_SAVEPOINT_NAME}')
+                return None
+
+            # Any other error (including cancellation and timeouts) is the error of the statement.
+            # Inside the user's transaction, the transaction is left failed, as if the statement had been run directly
+            if own_transaction:
+                await conn.execute(cur, 'ROLLBACK')
+            raise _DeclareCursorError(e) from e
+
+        try:
+            if not own_transaction:
+                await conn.execute(cur, f'RELEASE SAVEPOINT {_SAVEPOINT_NAME}')
+
+            async def fetch(size: int) -> list[tuple]:
+                await conn.execute(cur, f'FETCH FORWARD {size} FROM {_CURSOR_NAME}')
+                return cur.fetchall()
+
+            rows, truncated = await _fetch_rows(fetch, max_rows, max_bytes)
+            columns = [desc[0] for desc in cur.description]
+
+            await conn.execute(cur, f'CLOSE {_CURSOR_NAME}')
+            if own_transaction:
+                await conn.execute(cur, 'COMMIT')
+        except Exception:
+            if own_transaction:
+                await conn.execute(cur, 'ROLLBACK')
+            raise
+
+    return columns, rows, truncated
+
+async def _execute_statement(conn: AsyncDBConnection, statement: SQLCode, max_rows: int, max_bytes: int) -> QueryResult:
+    '''Executes a single statement and returns its result. Errors are not handled.'''
+
+    streamed = None
+    # `SELECT ... INTO` cannot be a cursor, and the server reports it as a syntax error: do not even try
+    if statement.first_token in STREAMABLE_STATEMENTS and _INTO.search(statement.query) is None:
+        streamed = await _execute_streaming(conn, statement, max_rows, max_bytes)
+
+    if streamed is not None:
+        columns, rows, truncated = streamed
+        return QueryResultDataset(
+            result=ResultSet(columns, rows, truncated),
+            query=statement.query,
+            notices=conn.notices)
+
+    with conn.cursor() as cur:
+        await conn.execute(cur, statement.query)
+
+        if cur.description:  # Check if the query has a result set
+            async def fetch(size: int) -> list[tuple]:
+                return cur.fetchmany(size)
+
+            rows, truncated = await _fetch_rows(fetch, max_rows, max_bytes)
+            columns = [desc[0] for desc in cur.description]
+            return QueryResultDataset(
+                result=ResultSet(columns, rows, truncated),
+                query=statement.query,
+                notices=conn.notices)
+
+        # No result set, return message status
+        return QueryResultMessage(
+            message=f'{cur.statusmessage}',
+            query=statement.query,
+            notices=conn.notices)
+
+async def serialized(username: str, query: str, run: Callable[[request_queue.Turn], AsyncIterator[QueryResult]],
+                     token: request_queue.CancelToken | None) -> AsyncIterator[QueryResult]:
+    '''
+    Runs a request when its turn comes in the queue of its user (see `request_queue`).
+    `run` is called with the turn, and returns the results of the request.
+    While waiting, the position in the queue is reported with `QueryResultQueued` objects.
+    If the queue is full, the request is rejected immediately with a `QueryResultRejected`.
+    If the request is cancelled while waiting, it is not run.
+    '''
+
+    try:
+        turn = request_queue.enqueue(username, token)
+    except request_queue.QueueFull as e:
+        yield QueryResultRejected(
+            message=str(e),
+            query=query)
+        return
+
+    results = None
+    try:
+        async for position in turn.wait():
+            yield QueryResultQueued(position=position, query=query)
+
+        if turn.cancelled:
+            return
+
+        results = run(turn)
+        async for result in results:
+            yield result
+    finally:
+        await turn.wait_cancel_sent()
+        turn.release()
+        if results is not None:
+            await results.aclose()
+
+def _may_change_catalog(conn: AsyncDBConnection, statement: SQLCode) -> bool:
+    '''Whether a statement, about to be executed, may change the results of builtins and the names used for autocompletion.'''
+
+    first_token = statement.first_token
+
+    if first_token in CATALOG_STATEMENTS:
+        return True
+    if first_token in SELECT_INTO_STATEMENTS:
+        return _INTO.search(statement.query) is not None
+    if first_token in COMMIT_STATEMENTS:
+        return conn.catalog_changed_in_transaction or conn.connection.info.transaction_status == extensions.TRANSACTION_STATUS_INERROR
+    return False
+
+async def execute_in_turn(turn: request_queue.Turn, query_str: str | list[str], *,
+                          strip_comments: bool = True,
+                          max_rows: int = MAX_RESULT_ROWS,
+                          max_bytes: int = MAX_RESULT_BYTES) -> AsyncIterator[QueryResult]:
+    '''Executes the statements of a request, during its turn (see `serialized`). See `execute_async` for the details.'''
+
+    if isinstance(query_str, str):
+        statements = SQLCode(query_str).split()
+    else:
+        statements = map(SQLCode, query_str)
+
+    if strip_comments:
+        statements = (statement.strip_comments() for statement in statements)
+
+    conn = None
+    try:
+        # A single lease for the whole request: the connection, and with it temporary tables,
+        # session settings and open transactions, cannot be closed between two statements
+        async with lease(turn.username) as conn:
+            turn.connection = conn
+
+            for statement in statements:
+                try:
+                    async with conn.lock:
+                        # Do not run the remaining statements if the request has been cancelled,
+                        # also while waiting for the lock
+                        if turn.cancelled:
+                            return
+
+                        if statement.first_token not in READ_ONLY_STATEMENTS:
+                            conn.dataset_hash = None
+                        changes_catalog = _may_change_catalog(conn, statement)
+                        if changes_catalog:
+                            conn.catalog.clear()
+                            completion.invalidate(conn)
+
+                        result = await _execute_statement(conn, statement, max_rows, max_bytes)
+
+                        # Changes made inside a transaction are undone if it is rolled back
+                        if conn.connection.info.transaction_status == extensions.TRANSACTION_STATUS_IDLE:
+                            conn.catalog_changed_in_transaction = False
+                        elif changes_catalog:
+                            conn.catalog_changed_in_transaction = True
+                    completion.statement_executed(conn)
+                except _DeclareCursorError as e:
+                    result = QueryResultError(
+                        exception=SQLException(e.error, offset=len(_DECLARE_CURSOR)),
+                        query=statement.query,
+                        notices=conn.notices)
+                except Exception as e:
+                    result = QueryResultError(
+                        exception=SQLException(e),
                         query=statement.query,
                         notices=conn.notices)
-                    continue
 
-                
-                # No result set, return message status 
-                yield QueryResultMessage(
-                    message=f'{cur.statusmessage}',
-                    query=statement.query,
-                    notices=conn.notices)
+                yield result
+    except Exception as e:
+        if conn is not None:
+            raise
 
-            conn.update_last_operation_ts()
-        except Exception as e:
-            try:
-                conn.rollback()
-                conn.update_last_operation_ts()
-            except Exception as e:
-                messages.error(f"Error rolling back connection for user {username}: {e}")
+        # The connection could not be opened: report it as the result of the first statement
+        statement = next(iter(statements), None)
+        if statement is not None:
             yield QueryResultError(
                 exception=SQLException(e),
                 query=statement.query,
+                notices=[])
+
+async def execute_async(username: str, query_str: str | list[str], *,
+                        token: request_queue.CancelToken | None = None,
+                        strip_comments: bool = True,
+                        max_rows: int = MAX_RESULT_ROWS,
+                        max_bytes: int = MAX_RESULT_BYTES) -> AsyncIterator[QueryResult]:
+    '''
+    Executes the given SQL queries and returns the results.
+    The queries will be separated into individual statements.
+
+    Result sets are streamed from the server in batches, and only the first `max_rows` rows
+    (or `max_bytes` bytes) are kept. Results exceeding these limits are marked as truncated.
+
+    If the request is cancelled (see `request_queue.CancelToken`), the running statement fails
+    and the remaining statements are not executed. A request cancelled while waiting for its turn is not executed.
+
+    Requests from the same user are executed one at a time: while waiting, `QueryResultQueued` objects
+    report the position of the request in the queue.
+
+    Must be run on the `engine` event loop. Use `execute` from regular threads.
+
+    Parameters:
+        username (str): The username of the database user.
+        query_str (str | list[str]): The SQL query string to execute. The query string can contain multiple SQL statements separated by semicolons.
+            A list of statements, already split, is executed as is.
+        token (CancelToken | None): Used to cancel the request.
+        strip_comments (bool): Whether to strip comments from each statement before executing it.
+        max_rows (int): Maximum number of rows to return for each statement.
+        max_bytes (int): Maximum approximate size of the rows to return for each statement.
+    Returns:
+        AsyncIterator[QueryResult]: An asynchronous iterator of QueryResult objects.
+    '''
+
+    query = query_str if isinstance(query_str, str) else '\n'.join(query_str)
+    async for result in serialized(username, query, lambda turn: execute_in_turn(turn, query_str, strip_comments=strip_comments, max_rows=max_rows, max_bytes=max_bytes), token):
+        yield result
+
+def execute(username: str, query_str: str | list[str], *,
+            token: request_queue.CancelToken | None = None,
+            strip_comments: bool = True,
+            max_rows: int = MAX_RESULT_ROWS,
+            max_bytes: int = MAX_RESULT_BYTES) -> Iterable[QueryResult]:
+    '''
+    Executes the given SQL queries and returns the results, see `execute_async`.
+    Statements are run on the `engine` event loop, while results are yielded to the calling thread.
+    '''
+
+    return engine.iterate(execute_async(username, query_str,
+                                        token=token,
+                                        strip_comments=strip_comments,
+                                        max_rows=max_rows,
+                                        max_bytes=max_bytes))
+
+def _is_batchable(statement: SQLCode) -> bool:
+    '''Whether a statement can be sent together with other statements, in the same implicit transaction.'''
+
+    first_token = statement.first_token
+    if first_token in UNBATCHABLE_STATEMENTS:
+        return False
+    if first_token in ('CREATE', 'DROP', 'ALTER'):
+        return not any(statement.has_clause(clause) for clause in UNBATCHABLE_CLAUSES)
+    return True
+
+def split_batches(statements: list[str]) -> Iterable[list[str]]:
+    '''
+    Groups consecutive statements into batches, to be sent to the server in a single round trip.
+    Statements that cannot be batched are returned in a batch of their own.
+    '''
+
+    batch = []
+    size = 0
+
+    for statement in statements:
+        if not _is_batchable(SQLCode(statement)):
+            if batch:
+                yield batch
+            yield [statement]
+            batch = []
+            size = 0
+            continue
+
+        if batch and (len(batch) >= BULK_BATCH_STATEMENTS or size + len(statement) > BULK_BATCH_BYTES):
+            yield batch
+            batch = []
+            size = 0
+
+        batch.append(statement)
+        size += len(statement)
+
+    if batch:
+        yield batch
+
+async def execute_bulk_in_turn(turn: request_queue.Turn, statements: list[str]) -> AsyncIterator[QueryResult]:
+    '''Executes the statements of a bulk request, during its turn (see `serialized`). See `execute_bulk_async` for the details.'''
+
+    async with lease(turn.username) as conn:
+        turn.connection = conn
+        conn.dataset_hash = None
+        conn.catalog.clear()
+        completion.invalidate(conn)
+        # Statements are run inside the user's transaction, if there is one
+        if conn.connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            conn.catalog_changed_in_transaction = True
+
+        total = len(statements)
+        done = 0
+
+        for batch in split_batches(statements):
+            if turn.cancelled:
+                return
+
+            errors = []
+            async with conn.lock:
+                with conn.cursor() as cur:
+                    try:
+                        await conn.execute(cur, '\n'.join(batch))
+                    except Exception as e:
+                        if len(batch) == 1 or turn.cancelled:
+                            errors.append((batch[0], e))
+                        else:
+                            # The whole batch has been rolled back: find the failing statements
+                            for statement in batch:
+                                if turn.cancelled:
+                                    break
+                                try:
+                                    await conn.execute(cur, statement)
+                                except Exception as e:
+                                    errors.append((statement, e))
+
+            for statement, e in errors:
+                yield QueryResultError(
+                    exception=SQLException(e),
+                    query=statement,
+                    notices=conn.notices)
+
+            if turn.cancelled:
+                return
+
+            done += len(batch)
+            yield QueryResultMessage(
+                message=f'{done}/{total} statements executed',
+                query=f'-- Statements {done - len(batch) + 1}-{done}',
                 notices=conn.notices)
+            conn.clear_notices()
+
+async def execute_bulk_async(username: str, statements: list[str], *, token: request_queue.CancelToken | None = None) -> AsyncIterator[QueryResult]:
+    '''
+    Executes many statements (e.g. a dataset) with as few round trips as possible.
+
+    Statements are sent in batches (see `split_batches`). A batch runs in a single implicit transaction:
+    if any of its statements fails, the whole batch is rolled back and its statements are run again one at a time,
+    so that the effects are the same as running each statement on its own.
+
+    Only a progress message for each batch and the errors of the failing statements are returned.
+    Result sets are discarded. The request waits for its turn in the queue of the user, as in `execute_async`.
+
+    Must be run on the `engine` event loop. Use `execute_bulk` from regular threads.
+
+    Parameters:
+        username (str): The username of the database user.
+        statements (list[str]): The statements to execute, in order.
+        token (CancelToken | None): Used to cancel the request.
+    Returns:
+        AsyncIterator[QueryResult]: Progress messages and errors.
+    '''
+
+    async for result in serialized(username, '\n'.join(statements), lambda turn: execute_bulk_in_turn(turn, statements), token):
+        yield result
+
+def execute_bulk(username: str, statements: list[str], *, token: request_queue.CancelToken | None = None) -> Iterable[QueryResult]:
+    '''
+    Executes many statements with as few round trips as possible, see `execute_bulk_async`.
+    Statements are run on the `engine` event loop, while results are yielded to the calling thread.
+    '''
+
+    return engine.iterate(execute_bulk_async(username, statements, token=token))
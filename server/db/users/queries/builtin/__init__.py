@@ -1,60 +1,83 @@
-from ...connection import get_connection as _get_connection
+from ...connection import lease as _lease
+from ... import engine as _engine, request_queue as _request_queue
 from ._queries import Queries as _Queries
-from server.sql import SQLException, QueryResult, QueryResultDataset, QueryResultError
-import pandas as pd
+from server.sql import SQLException, ResultSet, QueryResult, QueryResultDataset, QueryResultError
 
-from dav_tools import messages
 
+# Builtins available to users, by command name (e.g. `list-schemas`).
+# LIST_USERS is excluded, since it would show the other users of the server
+COMMANDS = {query.name.lower().replace('_', '-'): query for query in _Queries if query is not _Queries.LIST_USERS}
 
-def _execute_builtin(username: str, query: _Queries) -> QueryResult:
-    '''Runs a builtin query and returns the result.'''
+
+async def _execute_builtins_async(username: str, queries: list[_Queries]) -> list[QueryResult]:
+    '''
+    Runs builtin queries on the `engine` event loop, in a single turn, and returns their results.
+
+    Raises:
+        QueueFull: If the user has too many requests waiting.
+    '''
+
+    # Builtins wait for their turn without reporting the position, since they return a single response
+    turn = _request_queue.enqueue(username)
 
     try:
-        conn = _get_connection(username)
-        with conn.cursor() as cur:
-            cur.execute(query.value)
-            rows = cur.fetchall()
-            columns = [desc[0] for desc in cur.description]
-            result = pd.DataFrame(rows, columns=columns)
+        async for _ in turn.wait():
+            pass
+
+        results = []
+        async with _lease(username) as conn, conn.lock:
+            turn.connection = conn
+            for query in queries:
+                results.append(await _execute_builtin_query(conn, query))
+        return results
+    except Exception as e:
+        return [
+            QueryResultError(
+                exception=SQLException(e),
+                query=query.name,
+                notices=[])
+            for query in queries
+        ]
+    finally:
+        await turn.wait_cancel_sent()
+        turn.release()
+
+async def _execute_builtin_query(conn, query: _Queries) -> QueryResult:
+    '''Returns the result of a builtin query, from the connection catalog cache if possible.'''
 
+    try:
+        result = conn.catalog.get(query)
+        if result is None:
+            with conn.cursor() as cur:
+                await conn.execute(cur, query.value)
+                rows = cur.fetchall()
+                columns = [desc[0] for desc in cur.description]
+                result = ResultSet(columns, rows)
+            conn.catalog[query] = result
 
-        conn.update_last_operation_ts()
         return QueryResultDataset(
             result=result,
             query=query.name,
             notices=conn.notices)
     except Exception as e:
-        try:
-            conn.rollback()
-            conn.update_last_operation_ts()
-        except Exception as e:
-            messages.error(f"Error rolling back connection for user {username}: {e}")
         return QueryResultError(
             exception=SQLException(e),
             query=query.name,
             notices=conn.notices)
 
-def list_schemas(username: str) -> QueryResult:
-    '''Lists all schemas in the database.'''
-
-    return _execute_builtin(username, _Queries.LIST_SCHEMAS)
-
-def list_tables(username: str) -> QueryResult:
-    '''Lists tables in the current search_path.'''
-
-    return _execute_builtin(username, _Queries.LIST_TABLES)
-
-def list_all_tables(username: str) -> QueryResult:
-    '''Lists all tables in the database.'''
-
-    return _execute_builtin(username, _Queries.LIST_ALL_TABLES)
-
-def list_constraints(username: str) -> QueryResult:
-    '''Lists all constraints in the database.'''
-
-    return _execute_builtin(username, _Queries.LIST_CONSTRAINTS)
-
-def show_search_path(username: str) -> QueryResult:
-    '''Shows the search path for the database.'''
-
-    return _execute_builtin(username, _Queries.SHOW_SEARCH_PATH)
+def execute(username: str, commands: list[str]) -> list[QueryResult]:
+    '''
+    Runs several builtins with a single turn in the user's queue.
+
+    Parameters:
+        username (str): The username of the database user.
+        commands (list[str]): The builtin command names, see `COMMANDS`.
+    Returns:
+        list[QueryResult]: The results, in the same order as `commands`.
+    Raises:
+        KeyError: If a command does not exist.
+        QueueFull: If the user has too many requests waiting.
+    '''
+
+    queries = [COMMANDS[command] for command in commands]
+    return _engine.run(_execute_builtins_async(username, queries))
@@ -26,45 +26,110 @@ class Queries(Enum):
             schema_name;
     '''
 
+    # Table and constraint listings read `pg_catalog` directly, since `information_schema` views are slow on databases with many objects.
+    # Only objects the user has some privilege on are listed, as in `information_schema`.
+
     LIST_TABLES = '''
         SELECT
-            table_schema AS schema,
-            table_name as table,
-            table_type as type
+            n.nspname AS schema,
+            c.relname AS table,
+            CASE
+                WHEN n.oid = pg_my_temp_schema() THEN 'LOCAL TEMPORARY'
+                WHEN c.relkind IN ('r', 'p') THEN 'BASE TABLE'
+                WHEN c.relkind = 'v' THEN 'VIEW'
+                WHEN c.relkind = 'f' THEN 'FOREIGN'
+            END AS type
         FROM
-            information_schema.tables
+            pg_catalog.pg_class AS c
+            JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
         WHERE
-            table_schema = current_schema()
+            c.relkind IN ('r', 'p', 'v', 'f')
+            AND n.nspname = current_schema()
+            AND (pg_catalog.pg_has_role(c.relowner, 'USAGE')
+                OR pg_catalog.has_table_privilege(c.oid, 'SELECT, INSERT, UPDATE, DELETE, TRUNCATE, REFERENCES, TRIGGER')
+                OR pg_catalog.has_any_column_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES'))
         ORDER BY
-            table_schema,
-            table_name;
+            n.nspname,
+            c.relname;
     '''
 
     LIST_ALL_TABLES = '''
         SELECT
-            table_schema AS schema,
-            table_name as table,
-            table_type as type
+            n.nspname AS schema,
+            c.relname AS table,
+            CASE
+                WHEN n.oid = pg_my_temp_schema() THEN 'LOCAL TEMPORARY'
+                WHEN c.relkind IN ('r', 'p') THEN 'BASE TABLE'
+                WHEN c.relkind = 'v' THEN 'VIEW'
+                WHEN c.relkind = 'f' THEN 'FOREIGN'
+            END AS type
         FROM
-            information_schema.tables
+            pg_catalog.pg_class AS c
+            JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+        WHERE
+            c.relkind IN ('r', 'p', 'v', 'f')
+            AND NOT pg_catalog.pg_is_other_temp_schema(n.oid)
+            AND (pg_catalog.pg_has_role(c.relowner, 'USAGE')
+                OR pg_catalog.has_table_privilege(c.oid, 'SELECT, INSERT, UPDATE, DELETE, TRUNCATE, REFERENCES, TRIGGER')
+                OR pg_catalog.has_any_column_privilege(c.oid, 'SELECT, INSERT, UPDATE, REFERENCES'))
         ORDER BY
-            table_schema,
-            table_name;
+            n.nspname,
+            c.relname;
     '''
 
+    # NOT NULL constraints are listed as CHECK, as in `information_schema`. Before PostgreSQL 18 they are not in
+    # `pg_constraint`: they are derived from the columns instead, with the same names `information_schema` gives them
     LIST_CONSTRAINTS = '''
         SELECT
-            tc.table_schema AS schema,
-            tc.table_name AS table,
-            tc.constraint_name AS constraint,
-            tc.constraint_type AS type
+            n.nspname AS schema,
+            c.relname AS table,
+            con.constraint,
+            con.type
         FROM
-            information_schema.table_constraints AS tc
+            (
+                SELECT
+                    con.conrelid AS relid,
+                    con.conname AS constraint,
+                    CASE con.contype
+                        WHEN 'c' THEN 'CHECK'
+                        WHEN 'f' THEN 'FOREIGN KEY'
+                        WHEN 'n' THEN 'CHECK'
+                        WHEN 'p' THEN 'PRIMARY KEY'
+                        WHEN 'u' THEN 'UNIQUE'
+                    END AS type
+                FROM
+                    pg_catalog.pg_constraint AS con
+                WHERE
+                    con.contype IN ('c', 'f', 'n', 'p', 'u')
+                UNION ALL
+                SELECT
+                    a.attrelid,
+                    c.relnamespace::text || '_' || a.attrelid::text || '_' || a.attnum::text || '_not_null',
+                    'CHECK'
+                FROM
+                    pg_catalog.pg_attribute AS a
+                    JOIN pg_catalog.pg_class AS c ON c.oid = a.attrelid
+                WHERE
+                    a.attnotnull
+                    AND a.attnum > 0
+                    AND NOT a.attisdropped
+                    AND NOT EXISTS (
+                        SELECT
+                        FROM pg_catalog.pg_constraint AS nn
+                        WHERE nn.conrelid = a.attrelid AND nn.contype = 'n' AND nn.conkey[1] = a.attnum
+                    )
+            ) AS con
+            JOIN pg_catalog.pg_class AS c ON c.oid = con.relid
+            JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
         WHERE
-            tc.table_schema <> 'pg_catalog'
-            AND tc.table_schema <> 'information_schema'
+            c.relkind IN ('r', 'p')
+            AND n.nspname <> 'pg_catalog'
+            AND n.nspname <> 'information_schema'
+            AND NOT pg_catalog.pg_is_other_temp_schema(n.oid)
+            AND (pg_catalog.pg_has_role(c.relowner, 'USAGE')
+                OR pg_catalog.has_table_privilege(c.oid, 'INSERT, UPDATE, DELETE, TRUNCATE, REFERENCES, TRIGGER'))
         ORDER BY
-            tc.table_schema,
-            tc.table_name,
-            tc.constraint_name;
-    '''
\ No newline at end of file
+            n.nspname,
+            c.relname,
+            con.constraint;
+    '''
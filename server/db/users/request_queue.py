@@ -0,0 +1,194 @@
+'''
+Per-user request queues.
+
+Each user has a single connection, shared by all their requests (e.g. two browser tabs, or a query
+racing a builtin). Requests from the same user are executed one at a time, in arrival order,
+so that their statements, notices and transaction state do not interleave.
+Requests from different users are not affected by each other.
+
+Each request can be cancelled on its own with a `CancelToken`: a waiting request leaves the queue,
+while the statement of a running request is cancelled. Other requests of the same user are not affected.
+'''
+
+import asyncio
+import os
+from collections import deque
+from typing import AsyncIterator
+from dav_tools import messages
+
+from . import engine
+
+# Maximum number of requests waiting for their turn, for each user. Further requests are rejected
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '3'))
+
+
+class QueueFull(Exception):
+    '''Raised when a user has too many requests waiting to be executed.'''
+
+
+class _RequestQueue:
+    '''Requests of a single user: the one running, and the ones waiting for their turn.'''
+
+    def __init__(self):
+        self.running: Turn | None = None
+        self.waiting: deque['Turn'] = deque()
+
+    def notify(self) -> None:
+        '''Wakes up the waiting requests, so that they can check their position.'''
+        for turn in self.waiting:
+            turn.moved.set()
+
+_queues: dict[str, _RequestQueue] = {}
+
+
+class Turn:
+    '''
+    The turn of a request in the queue of its user.
+    `wait` must be iterated until exhausted before running the request, and `wait_cancel_sent` and `release` must always be called afterwards.
+    If the request is cancelled while waiting, `wait` returns without starting the turn: `cancelled` must be checked
+    before running the request, and between its statements.
+    '''
+
+    def __init__(self, username: str, queue: _RequestQueue):
+        self.username = username
+        self.queue = queue
+        self.moved = asyncio.Event()
+        self.running = False
+        self.released = False
+        self.cancelled = False
+        # Connection the request is running on, set by the request once it has one, cancelled by `cancel`
+        self.connection = None
+        # Cancellation being sent to the server, if any (see `wait_cancel_sent`)
+        self.cancelling: asyncio.Future | None = None
+
+    async def wait(self) -> AsyncIterator[int]:
+        '''
+        Waits for the turn of the request.
+        While waiting, yields the position of the request in the queue (1 means next) every time it changes.
+        '''
+
+        queue = self.queue
+        last_position = None
+
+        while not self.cancelled:
+            if queue.running is None and queue.waiting[0] is self:
+                queue.waiting.popleft()
+                queue.running = self
+                self.running = True
+                queue.notify()
+                return
+
+            position = queue.waiting.index(self) + 1
+            if position != last_position:
+                last_position = position
+                yield position
+
+            self.moved.clear()
+            await self.moved.wait()
+
+    def cancel(self) -> None:
+        '''
+        Cancels the request: if it is waiting, it leaves the queue; if it is running, its current statement is cancelled.
+        Must be run on the `engine` event loop. The cancellation is sent to the server in the background (see `AsyncDBConnection.cancel`).
+        '''
+
+        if self.cancelled or self.released:
+            return
+        self.cancelled = True
+
+        if self.running:
+            if self.connection is not None:
+                self.cancelling = self.connection.cancel()
+        else:
+            self.release()
+            self.moved.set()
+
+    async def wait_cancel_sent(self) -> None:
+        '''
+        Waits until the cancellation of the running statement, if any, has been received by the server.
+        Must be awaited before `release`: a cancellation received after the turn has ended would cancel the next request instead.
+        '''
+
+        if self.cancelling is not None:
+            await asyncio.wait([self.cancelling])
+
+    def release(self) -> None:
+        '''Leaves the queue, or ends the turn if the request was running. Calling it more than once has no effect.'''
+
+        if self.released:
+            return
+        self.released = True
+
+        queue = self.queue
+        if self.running:
+            queue.running = None
+        else:
+            queue.waiting.remove(self)
+        queue.notify()
+
+        if queue.running is None and not queue.waiting and _queues.get(self.username) is queue:
+            del _queues[self.username]
+
+
+class CancelToken:
+    '''
+    Cancels a single request (see `Turn.cancel`), also before its turn has been created.
+    Created by the caller and passed to the function executing the request. Can be used from any thread.
+    '''
+
+    def __init__(self):
+        self.cancelled = False
+        self.turn: Turn | None = None
+
+    def cancel(self) -> None:
+        '''Cancels the request. Returns immediately.'''
+        engine.get_loop().call_soon_threadsafe(self._cancel)
+
+    def _cancel(self) -> None:
+        self.cancelled = True
+        if self.turn is not None:
+            self.turn.cancel()
+
+
+def enqueue(username: str, token: CancelToken | None = None) -> Turn:
+    '''
+    Adds a request to the queue of the given user. Must be run on the `engine` event loop.
+    If `token` has already been cancelled, the turn is cancelled as soon as it is created.
+
+    Raises:
+        QueueFull: If the user already has MAX_QUEUED_REQUESTS requests waiting.
+    '''
+
+    queue = _queues.setdefault(username, _RequestQueue())
+    if len(queue.waiting) >= MAX_QUEUED_REQUESTS:
+        raise QueueFull(f'Too many requests are waiting for your previous queries to complete (at most {MAX_QUEUED_REQUESTS}), please try again later')
+
+    turn = Turn(username, queue)
+    queue.waiting.append(turn)
+
+    if token is not None:
+        token.turn = turn
+        if token.cancelled:
+            turn.cancel()
+
+    return turn
+
+async def _cancel_running(username: str) -> bool:
+    queue = _queues.get(username)
+    if queue is None or queue.running is None:
+        return False
+
+    queue.running.cancel()
+    messages.info(f"Cancelled query for user: {username}")
+    return True
+
+def cancel(username: str) -> bool:
+    '''
+    Cancels the request currently running for the given user, if any. Requests waiting for their turn are not affected.
+    Can be called from any thread, except the `engine` event loop.
+
+    Returns:
+        bool: Whether a request was running.
+    '''
+
+    return engine.run(_cancel_running(username))
@@ -1,55 +1,84 @@
-from dav_tools import chatgpt
+'''
+Answers to students' questions about their queries, generated by an LLM.
 
-from . import _prompts
+Answers are streamed: each function returns the answer text in chunks, as soon as they are generated.
+Generations are rate-limited for each user (see `_executor`): functions raise `RateLimited` when a request must be retried later.
+'''
+
+from dav_tools import chatgpt, messages
+import time
+from typing import Iterator
+
+from . import _backends, _cache, _executor, _prompts, _single_flight
+from ._executor import RateLimited
 
 
 MessageRole = chatgpt.MessageRole
 
+# Generates the answers, see `_backends` for the available backends
+backend = _backends.from_env()
+
+
+def _generate(kind: str, prompt: str) -> Iterator[str]:
+    '''Streams the answer from the backend, logging the prompt size and how long the answer took.'''
 
-def explain_error_message(code: str, exception: str) -> str:
-    message = chatgpt.Message()
-    
-    message.add_message(MessageRole.USER, _prompts.explain_error(code, exception))
-    answer = message.generate_answer()
+    start = time.monotonic()
+    first_chunk = None
+    for chunk in backend.stream(prompt):
+        if first_chunk is None:
+            first_chunk = time.monotonic() - start
+        yield chunk
 
-    return answer
+    messages.debug(f'LLM {kind}: ~{_prompts.estimate_tokens(prompt)} prompt tokens, '
+                   f'first chunk after {first_chunk or 0:.2f} s, answer after {time.monotonic() - start:.2f} s')
 
-def locate_error_cause(code: str, exception: str) -> str:
-    message = chatgpt.Message()
-    
-    message.add_message(MessageRole.USER, _prompts.locate_error_cause(code, exception))
-    answer = message.generate_answer()
+def _stream_answer(username: str, kind: str, prompt: str, code: str, exception: str | None = None, position: int | None = None) -> Iterator[str]:
+    '''
+    Streams the answer to a prompt about a query.
+    Cached answers are returned as a single chunk. Identical questions asked at the same time share the same generation,
+    and generated answers are cached once complete.
 
-    return answer
+    Raises:
+        RateLimited: If a new generation is needed, but cannot be started now.
+    '''
 
-def provide_error_example(code: str, exception: str) -> str:
-    message = chatgpt.Message()
+    key = _cache.key(kind, code, exception, position)
+    answer = _cache.get(key)
+    if answer is not None:
+        return iter([answer])
 
-    message.add_message(MessageRole.USER, _prompts.provide_error_example(code, exception))
-    answer = message.generate_answer()
+    return _single_flight.stream(
+        key,
+        lambda: _generate(kind, prompt),
+        lambda answer: _cache.put(key, kind, answer),
+        lambda job: _executor.submit(username, job)
+    )
 
-    return answer
+def explain_error_message(username: str, code: str, exception: str, position: int | None = None) -> Iterator[str]:
+    return _stream_answer(username, 'explain_error', _prompts.explain_error(code, exception, position), code, exception)
 
-def fix_query(code: str, exception: str) -> str:
-    message = chatgpt.Message()
+def locate_error_cause(username: str, code: str, exception: str, position: int | None = None) -> Iterator[str]:
+    return _stream_answer(username, 'locate_error_cause', _prompts.locate_error_cause(code, exception, position), code, exception, position)
 
-    message.add_message(MessageRole.USER, _prompts.fix_query(code, exception))
-    answer = message.generate_answer()
+def provide_error_example(username: str, code: str, exception: str, position: int | None = None) -> Iterator[str]:
+    return _stream_answer(username, 'provide_error_example', _prompts.provide_error_example(code, exception, position), code, exception)
 
-    return answer
+def fix_query(username: str, code: str, exception: str, position: int | None = None) -> Iterator[str]:
+    return _stream_answer(username, 'fix_query', _prompts.fix_query(code, exception, position), code, exception, position)
 
-def describe_my_query(code: str) -> str:
-    message = chatgpt.Message()
-    
-    message.add_message(MessageRole.USER, _prompts.describe_my_query(code))
-    answer = message.generate_answer()
+def describe_my_query(username: str, code: str) -> Iterator[str]:
+    return _stream_answer(username, 'describe_my_query', _prompts.describe_my_query(code), code)
 
-    return answer
+def explain_my_query(username: str, code: str) -> Iterator[str]:
+    return _stream_answer(username, 'explain_my_query', _prompts.explain_my_query(code), code)
 
-def explain_my_query(code: str) -> str:
-    message = chatgpt.Message()
-    
-    message.add_message(MessageRole.USER, _prompts.explain_my_query(code))
-    answer = message.generate_answer()
+def stats() -> dict:
+    '''Statistics about the prompts, the answer cache, the coalescing of identical requests and the generation queue.'''
 
-    return answer
+    return {
+        'backend': backend.name,
+        'cache': _cache.stats(),
+        'single_flight': _single_flight.stats(),
+        'executor': _executor.stats(),
+        'prompts': _prompts.stats(),
+    }
@@ -0,0 +1,133 @@
+'''
+Backends generating LLM answers.
+
+The backend is selected with `LLM_BACKEND`:
+    - `openai`: answers are generated by the OpenAI API (default).
+    - `fake`: answers are generated locally, with configurable latency, streaming rate and errors.
+      Useful to load-test the server without network access and without spending API credits.
+'''
+
+import hashlib
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+from dav_tools import chatgpt
+
+
+class Backend(ABC):
+    '''Generates the answer to a prompt.'''
+
+    name: str
+
+    @abstractmethod
+    def stream(self, prompt: str) -> Iterator[str]:
+        '''Yields the answer to `prompt` in chunks, as soon as they are generated.'''
+        pass
+
+
+class OpenAIBackend(Backend):
+    name = 'openai'
+
+    def __init__(self, model: str):
+        from openai import OpenAI
+
+        self.model = model
+        # Same requirement as `dav_tools.chatgpt`: without an API key, answers cannot be generated
+        self._client = OpenAI() if os.getenv('OPENAI_API_KEY') is not None else None
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        if self._client is None:
+            raise Exception('OPENAI_API_KEY not set')
+
+        stream = self._client.chat.completions.create(
+            model=self.model,
+            messages=[{'role': chatgpt.MessageRole.USER, 'content': prompt}],
+            stream=True,
+        )
+
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Release the HTTP connection, also when the generation fails
+            stream.close()
+
+
+class FakeBackend(Backend):
+    '''
+    Generates placeholder answers, without network access.
+
+    The answer text depends only on the prompt. Latency and errors are drawn from a random generator
+    seeded with `seed`, so a benchmark issuing the same requests in the same order behaves the same way every time.
+
+    Parameters:
+        latency_median_ms (float): Median time before the first chunk. Latencies follow a log-normal distribution.
+        latency_sigma (float): Spread of the latency distribution. 0 means a constant latency.
+        tokens_per_second (float): Rate at which chunks are streamed after the first one. 0 means no delay.
+        answer_tokens (int): Number of chunks in each answer.
+        error_rate (float): Probability that a generation fails, between 0 and 1.
+        seed (int): Seed of the random generator.
+    '''
+
+    name = 'fake'
+
+    _WORDS = ['the', 'query', 'table', 'column', 'row', 'join', 'select', 'where', 'group', 'value', 'key', 'result']
+
+    def __init__(self, latency_median_ms: float, latency_sigma: float, tokens_per_second: float,
+                 answer_tokens: int, error_rate: float, seed: int):
+        self.latency_median = latency_median_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _answer(self, prompt: str) -> list[str]:
+        digest = hashlib.sha256(prompt.encode()).digest()
+        words = [self._WORDS[digest[i % len(digest)] % len(self._WORDS)] for i in range(self.answer_tokens)]
+        return [f'{word} ' for word in words[:-1]] + [f'{words[-1]}.'] if words else []
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        with self._lock:
+            latency = self.latency_median * self._random.lognormvariate(0, self.latency_sigma)
+            fails_at = self._random.randrange(self.answer_tokens + 1) if self._random.random() < self.error_rate else None
+
+        time.sleep(latency)
+
+        for i, token in enumerate(self._answer(prompt)):
+            if i == fails_at:
+                raise Exception('Simulated LLM backend error')
+            if i > 0 and self.tokens_per_second > 0:
+                time.sleep(1 / self.tokens_per_second)
+            yield token
+
+        if fails_at == self.answer_tokens:
+            raise Exception('Simulated LLM backend error')
+
+
+def from_env() -> Backend:
+    '''Creates the backend selected by `LLM_BACKEND`.'''
+
+    name = os.getenv('LLM_BACKEND', 'openai')
+
+    if name == 'openai':
+        return OpenAIBackend(os.getenv('LLM_MODEL', chatgpt.AIModel.GPT4o_mini))
+
+    if name == 'fake':
+        return FakeBackend(
+            latency_median_ms   = float(os.getenv('LLM_FAKE_LATENCY_MEDIAN_MS', '1000')),
+            latency_sigma       = float(os.getenv('LLM_FAKE_LATENCY_SIGMA', '0.5')),
+            tokens_per_second   = float(os.getenv('LLM_FAKE_TOKENS_PER_SECOND', '50')),
+            answer_tokens       =   int(os.getenv('LLM_FAKE_ANSWER_TOKENS', '200')),
+            error_rate          = float(os.getenv('LLM_FAKE_ERROR_RATE', '0')),
+            seed                =   int(os.getenv('LLM_FAKE_SEED', '0')),
+        )
+
+    raise ValueError(f'Unknown LLM backend: {name}')
@@ -0,0 +1,130 @@
+'''
+Cache of LLM answers.
+
+Answers are keyed by the kind of prompt, the query and the error message.
+Answers that do not depend on the values in the query (e.g. explaining an error message) are keyed by the normalized query
+(see `SQLCode.normalize`), so that students making the same mistake on the same exercise share the same answer.
+Answers quoting the query (see `EXACT_KINDS`) are keyed by the query without comments and by the position of the error,
+since they mention its values and the line of the error.
+Answers are stored in the admin database, with an in-process LRU cache in front of it.
+Both expire after TTL.
+'''
+
+import datetime
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dav_tools import messages
+
+from server.db import admin as db_admin
+from server.sql import SQLCode
+
+# Maximum number of answers kept in memory
+MAX_ENTRIES = int(os.getenv('LLM_CACHE_SIZE', '1000'))
+# Answers older than this are generated again
+TTL = datetime.timedelta(hours=float(os.getenv('LLM_CACHE_TTL_HOURS', str(7 * 24))))
+# Expired answers are deleted from the database every this many stored answers
+DELETE_EXPIRED_EVERY = 100
+
+# Kinds of prompts whose answers quote the query, including its literal values and the line of the error
+EXACT_KINDS = ('locate_error_cause', 'fix_query', 'describe_my_query', 'explain_my_query')
+
+# key -> (answer, creation time), from the least to the most recently used
+_entries: OrderedDict[str, tuple[str, datetime.datetime]] = OrderedDict()
+_lock = threading.Lock()
+_stored = 0
+
+_stats = {
+    'memory_hits': 0,
+    'db_hits': 0,
+    'misses': 0,
+}
+
+
+def key(kind: str, code: str, exception: str | None = None, position: int | None = None) -> str:
+    '''
+    Cache key for a prompt about a query and, optionally, its error message.
+
+    Parameters:
+        kind (str): The kind of prompt.
+        code (str): The query the prompt is about.
+        exception (str | None): The error message, if the query failed.
+        position (int | None): Position of the error in `code`, if known. Only used for `EXACT_KINDS`.
+    Returns:
+        str: The cache key.
+    '''
+
+    if kind in EXACT_KINDS:
+        query = SQLCode(code).strip_comments().query
+        location = '' if position is None else str(position)
+    else:
+        query = SQLCode(code).normalize().query.rstrip(';')
+        location = ''
+
+    parts = [kind, query, location, (exception or '').strip()]
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+def _remember(key: str, answer: str, creation_ts: datetime.datetime) -> None:
+    with _lock:
+        _entries[key] = (answer, creation_ts)
+        _entries.move_to_end(key)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+def get(key: str) -> str | None:
+    '''Returns the cached answer for a key, or None if there is none or it expired.'''
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            answer, creation_ts = entry
+            if datetime.datetime.now() - creation_ts < TTL:
+                _entries.move_to_end(key)
+                _stats['memory_hits'] += 1
+                return answer
+            del _entries[key]
+
+    try:
+        entry = db_admin.llm_answers.get(key, TTL)
+    except Exception as e:
+        messages.warning(f'Cannot read cached LLM answer: {e}')
+        entry = None
+
+    with _lock:
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        _stats['db_hits'] += 1
+
+    answer, creation_ts = entry
+    _remember(key, answer, creation_ts)
+    return answer
+
+def put(key: str, kind: str, answer: str) -> None:
+    '''Caches an answer.'''
+    global _stored
+
+    _remember(key, answer, datetime.datetime.now())
+
+    with _lock:
+        _stored += 1
+        delete_expired = _stored % DELETE_EXPIRED_EVERY == 0
+
+    try:
+        db_admin.llm_answers.store(key, kind, answer)
+        if delete_expired:
+            db_admin.llm_answers.delete_expired(TTL)
+    except Exception as e:
+        messages.warning(f'Cannot store LLM answer: {e}')
+
+def stats() -> dict:
+    '''Number of answers served from memory, from the database, and generated, since startup.'''
+
+    with _lock:
+        total = sum(_stats.values())
+        return {
+            **_stats,
+            'entries': len(_entries),
+            'hit_rate': (_stats['memory_hits'] + _stats['db_hits']) / total if total else None,
+        }
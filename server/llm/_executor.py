@@ -0,0 +1,160 @@
+'''
+Bounded execution of LLM generations.
+
+Generations run on a fixed pool of worker threads, so that a burst of requests cannot exhaust the server threads.
+Before being queued, each generation must take a token from the bucket of the user who requested it, and from a global bucket:
+buckets refill at a constant rate, so each user, and the server as a whole, can make only a limited number of requests per minute.
+Requests over the limits, or arriving when too many generations are already waiting, are rejected immediately
+with the time after which they can be retried.
+'''
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+# Maximum number of generations running at the same time
+WORKERS                 = int(os.getenv('LLM_WORKERS', '8'))
+# Maximum number of generations waiting for a worker. Further requests are rejected
+MAX_QUEUED              = int(os.getenv('LLM_MAX_QUEUED', '32'))
+# Generations each user can start per minute, and at once after being idle
+USER_REQUESTS_PER_MINUTE    = float(os.getenv('LLM_USER_REQUESTS_PER_MINUTE', '6'))
+USER_BURST                  = int(os.getenv('LLM_USER_BURST', '3'))
+# Generations all users together can start per minute, and at once after being idle
+GLOBAL_REQUESTS_PER_MINUTE  = float(os.getenv('LLM_GLOBAL_REQUESTS_PER_MINUTE', '120'))
+GLOBAL_BURST                = int(os.getenv('LLM_GLOBAL_BURST', '30'))
+# Per-user buckets are discarded once full, when there are more than this many of them
+MAX_USER_BUCKETS = 1000
+
+
+class RateLimited(Exception):
+    '''Raised when a generation cannot be started now. `retry_after` is the number of seconds to wait before trying again.'''
+
+    def __init__(self, retry_after: float):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'Too many requests, please try again in {self.retry_after} s')
+
+
+class _TokenBucket:
+    def __init__(self, requests_per_minute: float, capacity: int):
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        '''Seconds until a token is available, 0 if one is available now.'''
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='llm-generation')
+_lock = threading.Lock()
+
+_user_buckets: dict[str, _TokenBucket] = {}
+_global_bucket = _TokenBucket(GLOBAL_REQUESTS_PER_MINUTE, GLOBAL_BURST)
+
+_queued = 0
+_running = 0
+# Average duration of a generation, used to estimate when a full queue will have room again
+_average_run_seconds = 10.0
+
+_stats = {
+    'submitted': 0,
+    'rejected_user': 0,
+    'rejected_global': 0,
+    'rejected_queue': 0,
+    'total_wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+}
+
+
+def submit(username: str, job: Callable[[], None]) -> None:
+    '''
+    Queues a generation on behalf of a user.
+
+    Raises:
+        RateLimited: If the user or the server exceeded their request rate, or too many generations are waiting.
+    '''
+    global _queued
+
+    with _lock:
+        now = time.monotonic()
+
+        if _queued >= MAX_QUEUED:
+            _stats['rejected_queue'] += 1
+            raise RateLimited(_average_run_seconds * (_queued + 1) / WORKERS)
+
+        if len(_user_buckets) > MAX_USER_BUCKETS:
+            for name in [name for name, bucket in _user_buckets.items() if bucket.is_full(now)]:
+                del _user_buckets[name]
+
+        user_bucket = _user_buckets.setdefault(username, _TokenBucket(USER_REQUESTS_PER_MINUTE, USER_BURST))
+
+        wait = user_bucket.wait_time(now)
+        if wait > 0:
+            _stats['rejected_user'] += 1
+            raise RateLimited(wait)
+
+        wait = _global_bucket.wait_time(now)
+        if wait > 0:
+            _stats['rejected_global'] += 1
+            raise RateLimited(wait)
+
+        user_bucket.take()
+        _global_bucket.take()
+        _queued += 1
+        _stats['submitted'] += 1
+
+    _executor.submit(_run, job, time.monotonic())
+
+def _run(job: Callable[[], None], submitted: float) -> None:
+    global _queued, _running, _average_run_seconds
+
+    started = time.monotonic()
+    with _lock:
+        _queued -= 1
+        _running += 1
+        wait = started - submitted
+        _stats['total_wait_seconds'] += wait
+        _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], wait)
+
+    try:
+        job()
+    finally:
+        with _lock:
+            _running -= 1
+            _average_run_seconds = 0.9 * _average_run_seconds + 0.1 * (time.monotonic() - started)
+
+def stats() -> dict:
+    '''Current queue depth and running generations, and rejections and waiting times since startup.'''
+
+    with _lock:
+        started = _stats['submitted'] - _queued
+        return {
+            'workers': WORKERS,
+            'running': _running,
+            'queued': _queued,
+            'submitted': _stats['submitted'],
+            'rejected_user': _stats['rejected_user'],
+            'rejected_global': _stats['rejected_global'],
+            'rejected_queue': _stats['rejected_queue'],
+            'average_wait_seconds': _stats['total_wait_seconds'] / started if started else None,
+            'max_wait_seconds': _stats['max_wait_seconds'],
+            'average_run_seconds': _average_run_seconds,
+        }
@@ -1,5 +1,106 @@
+'''
+Prompts sent to the LLM.
+
+Queries are included in the prompt only up to a token budget: longer queries are trimmed, always in the same way,
+so that identical questions produce identical prompts.
+For errors, only the statement that failed is included, centered on the position of the error reported by the server.
+'''
+
+import math
+import os
+import threading
+
 from ..sql import SQLCode
 
+# Maximum number of tokens used by the query in each prompt
+MAX_QUERY_TOKENS = int(os.getenv('LLM_PROMPT_MAX_QUERY_TOKENS', '1000'))
+# Rough average for code and English text, used to estimate the prompt size without a tokenizer
+CHARS_PER_TOKEN = 4
+
+_lock = threading.Lock()
+_stats = {
+    'prompts': 0,
+    'trimmed': 0,
+    'total_tokens': 0,
+    'max_tokens': 0,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    '''Approximate number of tokens in a text.'''
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def _trim(code: str, position: int | None = None) -> str:
+    '''
+    Trims the code to `MAX_QUERY_TOKENS`, keeping the part around `position`, or the beginning of the code if there is no position.
+    Omitted parts are replaced by a comment saying how much was left out.
+    '''
+
+    max_chars = MAX_QUERY_TOKENS * CHARS_PER_TOKEN
+    if len(code) <= max_chars:
+        return code
+
+    with _lock:
+        _stats['trimmed'] += 1
+
+    start = 0 if position is None else max(0, min(position - max_chars // 2, len(code) - max_chars))
+    end = start + max_chars
+
+    parts = []
+    if start > 0:
+        parts.append(f'/* {start} characters omitted */ ')
+    parts.append(code[start:end])
+    if end < len(code):
+        parts.append(f' /* {len(code) - end} characters omitted */')
+    return ''.join(parts)
+
+def _query(code: str) -> SQLCode:
+    '''The query without comments, trimmed to the token budget.'''
+
+    return SQLCode(_trim(SQLCode(code).strip_comments().query))
+
+def _failing_query(code: str, position: int | None) -> tuple[SQLCode, str]:
+    '''
+    The statement that caused the error, trimmed to the token budget around the error position.
+
+    Parameters:
+        code (str): The query that caused the error.
+        position (int | None): Position of the error in `code` (1 is the first character), as reported by the server, if known.
+    Returns:
+        tuple[SQLCode, str]: The statement, and a sentence saying where the error is in it (empty if the position is unknown).
+    '''
+
+    if position is not None and 0 < position <= len(code):
+        # The position refers to the query exactly as it was run
+        query = SQLCode(_trim(code, position - 1))
+        return query, f'The error is on line {code.count(chr(10), 0, position - 1) + 1} of the query.'
+
+    # Execution stops at the failing statement, so the last one is the most likely culprit
+    statements = [statement.strip_comments().query for statement in SQLCode(code).split()] or ['']
+    return SQLCode(_trim(statements[-1])), ''
+
+def _sized(prompt: str) -> str:
+    '''Records the size of a prompt.'''
+
+    tokens = estimate_tokens(prompt)
+    with _lock:
+        _stats['prompts'] += 1
+        _stats['total_tokens'] += tokens
+        _stats['max_tokens'] = max(_stats['max_tokens'], tokens)
+    return prompt
+
+def stats() -> dict:
+    '''Number of prompts built and of queries trimmed, and the estimated size of prompts in tokens, since startup.'''
+
+    with _lock:
+        return {
+            'prompts': _stats['prompts'],
+            'trimmed': _stats['trimmed'],
+            'average_tokens': _stats['total_tokens'] / _stats['prompts'] if _stats['prompts'] else None,
+            'max_tokens': _stats['max_tokens'],
+        }
+
+
 RESPONSE_FORMAT = '''
 Format the response as follows:
 - SQL code (e.g. tables, columns or keywords) should be enclosed in <code></code> tags
@@ -13,11 +114,10 @@ MOTIVATIONAL_MESSAGE_ERROR = '''
 BRIEF MOTIVATIONALLY-POSITIVE MESSAGE RELATED TO THE SPECIFIC ERROR ENCOUNTERED.
 '''
 
-def explain_error(code: str, exception: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+def explain_error(code: str, exception: str, position: int | None = None, language='PostgreSQL'):
+    query, error_position = _failing_query(code, position)
     
-    return  f'''
+    return _sized(f'''
 I encountered an error while trying to execute the following {language} query. Please briefly explain what this error means.
 Do not provide the correct answer, I only want an explanation of the error.
 
@@ -28,6 +128,7 @@ Do not provide the correct answer, I only want an explanation of the error.
 
 -- Error --
 {exception}
+{error_position}
 
 -- Template answer --
 The error <b>{exception}</b> means that EXPLANATION.
@@ -37,14 +138,13 @@ The error occurred because REASON.
 <br>
 <br>
 <i>{MOTIVATIONAL_MESSAGE_ERROR}</i>
-'''
+''')
 
 
-def locate_error_cause(code: str, exception: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+def locate_error_cause(code: str, exception: str, position: int | None = None, language='PostgreSQL'):
+    query, error_position = _failing_query(code, position)
 
-    return f'''
+    return _sized(f'''
 I encountered an error while trying to execute the following {language} query.
 Please tell me which part of the query I should check to fix the error.
 Do not correct the query, I only want guidance on where to look to fix the error.
@@ -56,19 +156,19 @@ Do not correct the query, I only want guidance on where to look to fix the error
 
 -- Error --
 {exception}
+{error_position}
 
 -- Template answer --
 This error is caused by a problem in the following clause:
 <pre class="code m">RELEVANT CODE</pre>
 <br>
 <i>{MOTIVATIONAL_MESSAGE_ERROR}</i>
-'''
+''')
 
-def provide_error_example(code: str, exception: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+def provide_error_example(code: str, exception: str, position: int | None = None, language='PostgreSQL'):
+    query, error_position = _failing_query(code, position)
 
-    return f'''
+    return _sized(f'''
 Please provide a simplified minimalistic example of a {language} query that would cause the same error as the one below.
 The example should be extremely simplified, leaving out all query parts that do not contribute to generating the error message.
 Remove conditions that are not necessary to reproduce the error.
@@ -81,19 +181,19 @@ Do not provide the correct answer and do not try to fix eventual errors, I only
 
 -- Error --
 {exception}
+{error_position}
 
 -- Template answer --
 The following query would cause the same error as the one you provided, because BRIEF EXPLANATION:
 <pre class="code m">EXAMPLE QUERY</pre>
 <br>
 <i>{MOTIVATIONAL_MESSAGE_ERROR}</i>
-'''
+''')
 
-def fix_query(code: str, exception: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+def fix_query(code: str, exception: str, position: int | None = None, language='PostgreSQL'):
+    query, error_position = _failing_query(code, position)
 
-    return f'''
+    return _sized(f'''
 Please provide a fixed version of the following {language} query that would not cause the same error as the one below.
 Return only the relevant part fixed, without any additional explanation.
 
@@ -104,6 +204,7 @@ Return only the relevant part fixed, without any additional explanation.
 
 -- Error --
 {exception}
+{error_position}
 
 -- Template answer --
 To fix the query, you could for example change
@@ -112,13 +213,12 @@ to:
 <pre class="code m">FIXED QUERY PART</pre>
 <br>
 <i>{MOTIVATIONAL_MESSAGE_RESULT}</i>
-'''
+''')
 
 def describe_my_query(code: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+    query = _query(code)
 
-    return f'''
+    return _sized(f'''
 Please explain the purpose of the following {language} query. What is the query trying to achieve?
 Do not provide the correct answer and do not try to fix eventual errors, I only want an explanation of this query's purpose.
 Assume the user has willingly formulated the query this way.
@@ -132,11 +232,10 @@ Assume the user has willingly formulated the query this way.
 The query you wrote <b>GOAL DESCRIPTION</b>.
 <br><br>
 <i>{MOTIVATIONAL_MESSAGE_RESULT}</i>
-'''
+''')
 
 def explain_my_query(code: str, language='PostgreSQL'):
-    query = SQLCode(code)
-    query = query.strip_comments()
+    query = _query(code)
 
     clauses = [
         {
@@ -175,7 +274,7 @@ def explain_my_query(code: str, language='PostgreSQL'):
     # templates for each clause present in the query
     templates = ''.join([f'<li>{clause["template"]}</li>' for clause in clauses])
 
-    return f'''
+    return _sized(f'''
 Please explain the purpose of the following {language} query. What is the query trying to achieve?
 Do not provide the correct answer and do not try to fix eventual errors, I only want an explanation of this query's purpose.
 Assume the user has willingly formulated the query this way.
@@ -196,4 +295,4 @@ Here is a detailed explanation of the query:
 </ol>
 <br>
 <i>{MOTIVATIONAL_MESSAGE_RESULT}</i>
-'''
+''')
@@ -0,0 +1,102 @@
+'''
+Coalescing of identical LLM requests.
+
+When several students ask the same question at the same time (e.g. the same error on the same exercise),
+only the first request generates the answer: the others follow the same generation, receiving the same chunks as they arrive.
+Generation runs on the LLM executor, independently of the requests, so that it completes even if the client that started it goes away.
+'''
+
+import threading
+from typing import Callable, Iterator
+
+_flights: dict[str, '_Flight'] = {}
+_lock = threading.Lock()
+
+_stats = {
+    'generations': 0,
+    'coalesced': 0,
+}
+
+
+class _Flight:
+    '''A generation in progress, with the chunks generated so far.'''
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Exception | None = None
+        self._cond = threading.Condition()
+
+    def run(self, generate: Callable[[], Iterator[str]], on_complete: Callable[[str], None]) -> None:
+        try:
+            for chunk in generate():
+                with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+            on_complete(''.join(self.chunks))
+        except Exception as e:
+            self.error = e
+        finally:
+            # Requests arriving from now on find the answer in the cache, or start a new generation after an error
+            with _lock:
+                del _flights[self.key]
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def follow(self) -> Iterator[str]:
+        '''
+        Yields all the chunks of the answer, from the first one, waiting for them to be generated.
+
+        Raises:
+            Exception: The error that stopped the generation, if any.
+        '''
+
+        sent = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.chunks) > sent or self.done)
+                chunks = self.chunks[sent:]
+                done = self.done
+
+            yield from chunks
+            sent += len(chunks)
+
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+def stream(key: str, generate: Callable[[], Iterator[str]], on_complete: Callable[[str], None],
+           submit: Callable[[Callable[[], None]], None]) -> Iterator[str]:
+    '''
+    Streams the answer for `key`, joining the generation in progress for the same key if there is one.
+
+    Parameters:
+        key (str): Identifies the question: requests with the same key receive the same answer.
+        generate (Callable): Starts generating the answer, returning its chunks. Called only if no generation is in progress.
+        on_complete (Callable): Called with the complete answer, before other requests stop joining this generation.
+        submit (Callable): Runs the generation in the background. Errors raised by it are propagated, and no generation is started.
+    '''
+
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _Flight(key)
+            submit(lambda: flight.run(generate, on_complete))
+            _flights[key] = flight
+            _stats['generations'] += 1
+        else:
+            _stats['coalesced'] += 1
+
+    return flight.follow()
+
+def stats() -> dict:
+    '''Number of generations started, and of requests that joined a generation in progress, since startup.'''
+
+    with _lock:
+        return {
+            **_stats,
+            'in_progress': len(_flights),
+        }
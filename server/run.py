@@ -1,7 +1,7 @@
-from server import create_app, start_cleanup_thread
+from server import create_app, start_expiry_scheduler
 
 
-start_cleanup_thread()
+start_expiry_scheduler()
 
 app = create_app()
 
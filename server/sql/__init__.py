@@ -1,2 +1,3 @@
-from .result import QueryResult, QueryResultDataset, QueryResultError, QueryResultMessage
-from .code import SQLCode, SQLException
\ No newline at end of file
+from .result import QueryResult, QueryResultDataset, QueryResultError, QueryResultMessage, QueryResultQueued, QueryResultRejected
+from .code import SQLCode, SQLException
+from .result_set import ResultSet
\ No newline at end of file
@@ -0,0 +1,214 @@
+'''
+Minimal PostgreSQL lexer, used to split scripts into statements and to remove comments.
+
+Only the tokens that can contain semicolons or comment markers are recognized:
+comments (including nested block comments), string constants (including E-strings),
+quoted identifiers and dollar-quoted strings. Code between comments and semicolons is matched
+by a single regex, so the cost is linear in the length of the code.
+'''
+
+import re
+from typing import Iterable
+
+
+# Code without comments or semicolons: string constants, quoted identifiers and dollar-quoted strings
+# are matched as a whole, so that comment markers and semicolons inside them are ignored.
+_CODE = re.compile(r"""
+    (?:
+          [^;'"$/\-eE]+                                     # anything that cannot start a special token
+        | '[^']*(?:''[^']*)*'                               # string constant
+        | "[^"]*(?:""[^"]*)*"                               # quoted identifier
+        | (?<![A-Za-z0-9_$])[eE]'(?:[^'\\]|\\.|'')*'        # string constant with C-style escapes
+        | (?<=[A-Za-z0-9_$])[eE]                            # `e` inside a word
+        | [eE](?!')                                         # `e` not starting a string constant with C-style escapes
+        | (?<![A-Za-z0-9_$])
+          \$(?P<tag>(?:[A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?)\$
+          .*?
+          \$(?P=tag)\$                                      # dollar-quoted string
+        | (?<=[A-Za-z0-9_$])\$                              # dollar sign inside an identifier
+        | \$(?!(?:[A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?\$)
+                                                            # dollar sign not starting a dollar-quoted string
+        | -(?!-)
+        | /(?!\*)
+    )*
+""", re.VERBOSE | re.DOTALL)
+
+# Tokens relevant for normalization, see `normalize`
+_NORMALIZE_TOKEN = re.compile(r"""
+      (?P<literal>
+          (?<![A-Za-z0-9_$])[eE]'(?:[^'\\]|\\.|'')*'         # string constant with C-style escapes
+        | '[^']*(?:''[^']*)*'                                   # string constant
+        | \$(?P<tag>(?:[A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?)\$.*?\$(?P=tag)\$   # dollar-quoted string
+        | (?<![A-Za-z0-9_$])(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?   # number
+      )
+    | (?P<identifier>"[^"]*(?:""[^"]*)*")                       # quoted identifier
+    | (?P<word>[A-Za-z_\u0080-\uffff][A-Za-z0-9_$\u0080-\uffff]*)
+    | (?P<space>\s+)
+    | .
+""", re.VERBOSE | re.DOTALL)
+
+_BLOCK_COMMENT_DELIMITER = re.compile(r'/\*|\*/')
+_TRAILING_LINE_COMMENT = re.compile(r'[ \t]*--[^\n]*')
+_WORD = re.compile(r'[A-Za-z_]+')
+
+COMMENT = 'comment'
+SEMICOLON = 'semicolon'
+OTHER = 'other'
+UNTERMINATED = 'unterminated'
+
+
+def _block_comment_end(code: str, start: int) -> int:
+    '''
+    Position right after the block comment starting at `start`, which can contain nested comments.
+    -1 if the comment is not terminated.
+    '''
+
+    depth = 0
+    for match in _BLOCK_COMMENT_DELIMITER.finditer(code, start):
+        if match.group() == '/*':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return -1
+
+def tokenize(code: str) -> Iterable[tuple[str, int, int]]:
+    '''
+    Splits the code into spans of comments, semicolons and everything else.
+
+    Returns:
+        Iterable[tuple[str, int, int]]: Token kind (`COMMENT`, `SEMICOLON`, `OTHER` or `UNTERMINATED`), start and end position.
+            `UNTERMINATED` tokens extend to the end of the code.
+    '''
+
+    pos = 0
+    length = len(code)
+
+    while pos < length:
+        end = _CODE.match(code, pos).end()
+        if end > pos:
+            yield OTHER, pos, end
+            pos = end
+
+        if pos >= length:
+            return
+
+        if code.startswith(';', pos):
+            end = pos + 1
+            yield SEMICOLON, pos, end
+        elif code.startswith('--', pos):
+            end = code.find('\n', pos)
+            end = length if end == -1 else end
+            yield COMMENT, pos, end
+        elif code.startswith('/*', pos):
+            end = _block_comment_end(code, pos)
+            if end == -1:
+                end = length
+                yield UNTERMINATED, pos, end
+            else:
+                yield COMMENT, pos, end
+        else:
+            # Unterminated string, identifier or dollar-quoted string
+            end = length
+            yield UNTERMINATED, pos, end
+
+        pos = end
+
+def split(code: str) -> list[str]:
+    '''
+    Splits the code into individual statements.
+    Statements keep their trailing semicolon, and a comment on the same line right after it.
+    Statements containing only comments and whitespace are discarded.
+    '''
+
+    statements = []
+    start = 0
+    has_code = False
+
+    for kind, token_start, token_end in tokenize(code):
+        if token_start < start:
+            # Trailing comment, already included in the previous statement
+            continue
+
+        if kind == OTHER or kind == UNTERMINATED:
+            has_code = has_code or not code[token_start:token_end].isspace()
+        elif kind == SEMICOLON:
+            end = token_end
+            trailing_comment = _TRAILING_LINE_COMMENT.match(code, end)
+            if trailing_comment:
+                end = trailing_comment.end()
+
+            if has_code:
+                statements.append(code[start:end].strip())
+            start = end
+            has_code = False
+
+    if has_code:
+        statements.append(code[start:].strip())
+
+    return statements
+
+def strip_comments(code: str) -> str:
+    '''Removes all comments from the code. Block comments are replaced by a space, to keep tokens separated.'''
+
+    parts = []
+    for kind, start, end in tokenize(code):
+        if kind != COMMENT:
+            parts.append(code[start:end])
+        elif code.startswith('/*', start):
+            parts.append(' ')
+    return ''.join(parts).strip()
+
+def normalize(code: str) -> str:
+    '''
+    Canonical form of the code, equal for queries that differ only in comments, whitespace,
+    case of keywords and unquoted identifiers, or literal values.
+    Literals (strings and numbers) are replaced by `?`, and whitespace is kept only between words.
+    '''
+
+    parts = []
+    # Whether the last part is a word, a literal or a quoted identifier, which need a space before the next one
+    last_is_word = False
+
+    for match in _NORMALIZE_TOKEN.finditer(strip_comments(code)):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+
+        if kind == 'literal':
+            text = '?'
+        elif kind == 'word':
+            text = match.group().lower()
+        else:
+            text = match.group()
+
+        is_word = kind is not None
+        if is_word and last_is_word:
+            parts.append(' ')
+        parts.append(text)
+        last_is_word = is_word
+
+    return ''.join(parts)
+
+def is_terminated(code: str) -> bool:
+    '''Whether all strings, quoted identifiers, dollar-quoted strings and block comments in the code are closed.'''
+
+    return all(kind != UNTERMINATED for kind, _, _ in tokenize(code))
+
+def first_keyword(code: str) -> str | None:
+    '''First word of the code, ignoring comments, whitespace and opening parentheses.'''
+
+    for kind, start, end in tokenize(code):
+        if kind == COMMENT:
+            continue
+        if kind == SEMICOLON:
+            return None
+
+        text = code[start:end].lstrip(' \t\r\n(')
+        if not text:
+            continue
+        match = _WORD.match(text)
+        return match.group() if match else None
+
+    return None
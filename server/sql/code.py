@@ -1,49 +1,58 @@
-import sqlparse
 from typing import Iterable, Self
 
-
-# Maximum length of SQL code to strip comments from
-STRIP_COMMENTS_MAX_LENGTH = 1000
+from . import _lexer
 
 
 class SQLCode:
     def __init__(self, query: str):
         self.query = query
 
-    def strip_comments(self, *, force: bool = False) -> Self:
+    def strip_comments(self) -> Self:
         '''
             Remove comments from the SQL query
-            If the query is too long, it will not be stripped unless force is set to True.
-            This is to avoid performance issues with very large queries.
 
-            Parameters:
-                force (bool): If True, strip comments even if the query is too long.
             Returns:
                 SQLCode: A new SQLCode object with comments stripped.
         '''
 
-        if len(self.query) > STRIP_COMMENTS_MAX_LENGTH and not force:
-            return self
-        
-        code = sqlparse.format(self.query, strip_comments=True)
+        code = _lexer.strip_comments(self.query)
+        return SQLCode(code)
+
+    def normalize(self) -> Self:
+        '''
+            Canonical form of the SQL query, ignoring comments, whitespace, case and literal values
+
+            Returns:
+                SQLCode: A new SQLCode object with the normalized query.
+        '''
+
+        code = _lexer.normalize(self.query)
         return SQLCode(code)
 
     def has_clause(self, clause: str) -> bool:
         '''Check if the SQL query has a specific clause'''
         return clause.upper() in self.query.upper()
 
+    def is_terminated(self) -> bool:
+        '''Check if all strings, quoted identifiers and comments in the SQL query are closed'''
+        return _lexer.is_terminated(self.query)
+
     def split(self) -> Iterable[Self]:
         '''Split the SQL query into individual statements'''
-        for query in sqlparse.split(self.query, strip_semicolon=False):
+        for query in _lexer.split(self.query):
             yield SQLCode(query)
     
     @property
     def first_token(self) -> str:
-        statement = sqlparse.parse(self.query)[0]
-        first_token = statement.token_first(skip_cm=True)
+        '''
+            The first keyword of the query, in uppercase.
+            Leading comments and parentheses are skipped without parsing the whole statement,
+            so this is cheap to compute even for very large statements.
+        '''
+        first_token = _lexer.first_keyword(self.query)
         
         if first_token:
-            return first_token.value.upper()
+            return first_token.upper()
         
         return None
 
@@ -52,7 +61,14 @@ class SQLCode:
         return self.query
     
 class SQLException:
-    def __init__(self, exception: Exception):
+    def __init__(self, exception: Exception, offset: int = 0):
+        '''
+        Parameters:
+            exception (Exception): The exception raised while executing the statement.
+            offset (int): Number of characters added before the statement when it was executed
+                (e.g. a cursor declaration), subtracted from the position reported by the server.
+        '''
+
         self.exception = exception
 
         self.name = type(self.exception).__name__
@@ -60,6 +76,11 @@ class SQLException:
         message = str(self.exception.args[0]) if self.exception.args else ''
         self.description = message.splitlines()[0]
         self.traceback = message.splitlines()[1:]
+
+        # Position of the error in the statement (1 is the first character), as reported by the server, if known
+        diag = getattr(self.exception, 'diag', None)
+        position = diag.statement_position if diag is not None else None
+        self.position = int(position) - offset if position and int(position) > offset else None
     
     def __str__(self):
         return f'{self.name}: {self.description}'
@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
-import pandas as pd
 from .code import SQLException
+from .result_set import ResultSet
 
 class QueryResult(ABC):
     '''Represents the result of a SQL query.'''
@@ -9,7 +9,11 @@ class QueryResult(ABC):
         self.success = success
         self.type = query_type
         self.notices = notices
+        self.truncated = False
+        self.data = None
         self.id = None
+        # Position of the error in the query (1 is the first character), for failed queries, if known
+        self.error_position = None
 
     @property
     @abstractmethod
@@ -28,6 +32,7 @@ class QueryResultError(QueryResult):
             notices=notices,
             query_type='message')
         self._result = exception
+        self.error_position = exception.position
 
     @property
     def result(self) -> str:
@@ -35,25 +40,22 @@ class QueryResultError(QueryResult):
 
 class QueryResultDataset(QueryResult):
     '''Represents the result of a SQL query that returned a dataset.'''
-    def __init__(self, result: pd.DataFrame, query: str, notices: list = []):
+    def __init__(self, result: ResultSet, query: str, notices: list = []):
         super().__init__(
             query=query,
             success=True,
             notices=notices,
             query_type='dataset')
-        self._result = result
+        self.data = result
+        self.truncated = result.truncated
+        self._html = None
 
     @property
     def result(self) -> str:
-        result = self._result.replace({None: 'NULL'})
-
-        result = result.to_html(
-            classes='table table-bordered table-hover table-responsive',
-            show_dimensions=True,
-            border=0
-        )
-        result = result.replace('<thead>', '<thead class="table-dark">').replace('<tbody>', '<tbody class="table-group-divider">')
-        return result
+        # Rendered only once, the first time it is needed
+        if self._html is None:
+            self._html = self.data.to_html()
+        return self._html
 
 class QueryResultMessage(QueryResult):
     '''Represents the result of a SQL query that returned a message.'''
@@ -68,3 +70,31 @@ class QueryResultMessage(QueryResult):
     @property
     def result(self) -> str:
         return self._result
+
+class QueryResultQueued(QueryResult):
+    '''Represents a request waiting for the previous requests of the same user to complete.'''
+    def __init__(self, position: int, query: str):
+        super().__init__(
+            query=query,
+            success=True,
+            notices=[],
+            query_type='queue')
+        self.position = position
+
+    @property
+    def result(self) -> str:
+        return f'Waiting for previous queries to complete (position in queue: {self.position})'
+
+class QueryResultRejected(QueryResult):
+    '''Represents a request that has not been executed, e.g. because too many requests of the same user are waiting.'''
+    def __init__(self, message: str, query: str):
+        super().__init__(
+            query=query,
+            success=False,
+            notices=[],
+            query_type='rejected')
+        self._result = message
+
+    @property
+    def result(self) -> str:
+        return self._result
@@ -0,0 +1,95 @@
+from html import escape as _escape
+import json
+import zlib
+
+
+TABLE_CLASSES = 'dataframe table table-bordered table-hover table-responsive'
+
+
+class ResultSet:
+    '''
+        Rows returned by a SQL query, together with the names of their columns.
+        Rows are kept as they are returned by the database driver, without any conversion.
+    '''
+
+    __slots__ = ('columns', 'rows', 'truncated')
+
+    def __init__(self, columns: list[str], rows: list[tuple], truncated: bool = False):
+        self.columns = columns
+        self.rows = rows
+        self.truncated = truncated
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @staticmethod
+    def _cell(value) -> str:
+        '''Text representation of a single value, escaped for HTML.'''
+        if value is None:
+            return 'NULL'
+        return _escape(str(value).strip(), quote=False)
+
+    def to_html(self) -> str:
+        '''
+            Render the rows as an HTML table.
+            The markup is the same produced by `pandas.DataFrame.to_html`, with Bootstrap classes.
+        '''
+
+        cell = self._cell
+        parts = [
+            f'<table class="{TABLE_CLASSES}">\n',
+            '  <thead class="table-dark">\n',
+            '    <tr style="text-align: right;">\n',
+            '      <th></th>\n',
+        ]
+        parts.extend(f'      <th>{cell(column)}</th>\n' for column in self.columns)
+        parts.append('    </tr>\n  </thead>\n  <tbody class="table-group-divider">\n')
+
+        for i, row in enumerate(self.rows):
+            parts.append(f'    <tr>\n      <th>{i}</th>\n')
+            parts.extend(f'      <td>{cell(value)}</td>\n' for value in row)
+            parts.append('    </tr>\n')
+
+        parts.append(f'  </tbody>\n</table>\n<p>{len(self.rows)} rows × {len(self.columns)} columns</p>')
+
+        if self.truncated:
+            parts.append(f'<p><i>Result truncated: only the first {len(self.rows)} rows are shown.</i></p>')
+
+        return ''.join(parts)
+
+    def to_json(self) -> str:
+        '''
+            Serialize the rows as a JSON object with `columns`, `rows` and `truncated` keys.
+            Values that have no JSON representation (e.g. dates, decimals) are converted to strings.
+        '''
+
+        return json.dumps({
+            'columns': self.columns,
+            'rows': self.rows,
+            'truncated': self.truncated,
+        }, default=str, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> 'ResultSet':
+        '''Load rows serialized with `to_json`.'''
+        result = json.loads(data)
+        return cls(result['columns'], result['rows'], result['truncated'])
+
+    def compress(self, max_bytes: int) -> bytes:
+        '''
+            Serialize and compress the rows, for storage.
+            If the compressed data exceeds `max_bytes`, only the first rows are kept and the result is marked as truncated.
+        '''
+
+        data = zlib.compress(self.to_json().encode())
+        if len(data) <= max_bytes or len(self.rows) == 0:
+            return data
+
+        # Keep the fraction of rows that is expected to fit, with some margin
+        keep = int(len(self.rows) * max_bytes / len(data) * 0.9)
+        return ResultSet(self.columns, self.rows[:keep], True).compress(max_bytes)
+
+    @classmethod
+    def decompress(cls, data: bytes) -> 'ResultSet':
+        '''Load rows stored with `compress`.'''
+        return cls.from_json(zlib.decompress(data).decode())
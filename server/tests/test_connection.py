@@ -0,0 +1,91 @@
+'''
+Concurrency of `db.users.connection.get_connection`, without a database server:
+`psycopg2.connect` is replaced by a fake that counts the connections opened for each user.
+'''
+
+import asyncio
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+from psycopg2 import extensions
+
+from server.db.users import connection, engine
+
+USERS = 200
+REQUESTS_PER_USER = 5
+# Time spent by the fake connect, so that concurrent requests for the same user overlap
+CONNECT_SECONDS = 0.01
+
+
+class _FakeConnection:
+    '''The parts of an asynchronous psycopg2 connection used by `AsyncDBConnection`.'''
+
+    def __init__(self, username: str):
+        self.username = username
+        self.info = mock.Mock(transaction_status=extensions.TRANSACTION_STATUS_IDLE)
+        self.notices = []
+        self.closed = False
+
+    def poll(self) -> int:
+        return extensions.POLL_OK
+
+    def cancel(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class GetConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.prefix = f'test_connection_{id(self)}_'
+        self.connects = Counter()
+        self.lock = threading.Lock()
+
+        def connect(**kwargs):
+            time.sleep(CONNECT_SECONDS)
+            with self.lock:
+                self.connects[kwargs['user']] += 1
+            return _FakeConnection(kwargs['user'])
+
+        patches = [
+            mock.patch.object(connection.psycopg2, 'connect', side_effect=connect),
+            mock.patch.object(connection.admin_users, 'get_statement_timeout', return_value=None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.addCleanup(self._close_connections)
+
+    def _close_connections(self):
+        for username in [username for username in connection.connections if username.startswith(self.prefix)]:
+            connection.connections.pop(username).close()
+
+    def test_one_connection_per_user(self):
+        usernames = [f'{self.prefix}{i}' for i in range(USERS)]
+        requests = [username for username in usernames for _ in range(REQUESTS_PER_USER)]
+
+        async def connect_all():
+            return await asyncio.gather(*(connection.get_connection(username) for username in requests))
+
+        results = engine.run(connect_all())
+
+        self.assertEqual(self.connects, Counter({username: 1 for username in usernames}))
+
+        # All the requests of a user received the same connection
+        by_user = {}
+        for username, conn in zip(requests, results):
+            by_user.setdefault(username, set()).add(id(conn))
+        self.assertTrue(all(len(conns) == 1 for conns in by_user.values()))
+
+        # Later requests reuse the open connection
+        engine.run(connect_all())
+        self.assertEqual(sum(self.connects.values()), USERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+'''
+Statement splitting, comment stripping and normalization (see `server.sql._lexer`).
+'''
+
+import unittest
+
+from server.sql import _lexer
+
+
+class SplitTest(unittest.TestCase):
+    def test_statements(self):
+        self.assertEqual(_lexer.split('SELECT 1; SELECT 2;\nSELECT 3'), ['SELECT 1;', 'SELECT 2;', 'SELECT 3'])
+
+    def test_trailing_comment(self):
+        self.assertEqual(_lexer.split('SELECT 1; -- first\nSELECT 2;'), ['SELECT 1; -- first', 'SELECT 2;'])
+
+    def test_empty_statements(self):
+        self.assertEqual(_lexer.split(';; -- only a comment\n/* another */;\n  '), [])
+
+    def test_strings(self):
+        self.assertEqual(_lexer.split("SELECT 'a;b', 'it''s; -- no'; SELECT 2"), ["SELECT 'a;b', 'it''s; -- no';", 'SELECT 2'])
+
+    def test_quoted_identifiers(self):
+        self.assertEqual(_lexer.split('SELECT "a;""b" FROM t; SELECT 2'), ['SELECT "a;""b" FROM t;', 'SELECT 2'])
+
+    def test_escape_strings(self):
+        self.assertEqual(_lexer.split(r"SELECT E'it\'s; /* no */'; SELECT 2"), [r"SELECT E'it\'s; /* no */';", 'SELECT 2'])
+        self.assertEqual(_lexer.split(r"SELECT e'a\\'; SELECT 2"), [r"SELECT e'a\\';", 'SELECT 2'])
+
+    def test_backslash_in_standard_strings(self):
+        # Backslashes are not escapes outside E-strings, also after a word ending with `e`
+        self.assertEqual(_lexer.split(r"SELECT 'a\'; SELECT 2"), [r"SELECT 'a\';", 'SELECT 2'])
+        self.assertEqual(_lexer.split(r"SELECT date'a\'; SELECT 2"), [r"SELECT date'a\';", 'SELECT 2'])
+
+    def test_dollar_quoted_strings(self):
+        code = 'CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; -- no $$ LANGUAGE sql; SELECT 2;'
+        self.assertEqual(_lexer.split(code), ['CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; -- no $$ LANGUAGE sql;', 'SELECT 2;'])
+
+    def test_dollar_quoted_strings_with_tags(self):
+        code = 'DO $body$ BEGIN RAISE NOTICE $$a;$$; END $body$; SELECT $x$ $body$; $x$;'
+        self.assertEqual(_lexer.split(code), ['DO $body$ BEGIN RAISE NOTICE $$a;$$; END $body$;', 'SELECT $x$ $body$; $x$;'])
+
+    def test_dollar_in_identifiers(self):
+        # `$b$` inside an identifier does not start a dollar-quoted string
+        self.assertEqual(_lexer.split('SELECT a$b$c FROM t$1; SELECT 2'), ['SELECT a$b$c FROM t$1;', 'SELECT 2'])
+
+    def test_parameters(self):
+        self.assertEqual(_lexer.split('SELECT $1; SELECT $2;'), ['SELECT $1;', 'SELECT $2;'])
+
+    def test_nested_block_comments(self):
+        code = 'SELECT 1 /* a /* b; */ c; */; SELECT 2'
+        self.assertEqual(_lexer.split(code), ['SELECT 1 /* a /* b; */ c; */;', 'SELECT 2'])
+
+    def test_unterminated(self):
+        for code in ["SELECT 'abc; SELECT 2", 'SELECT "abc; SELECT 2', "SELECT E'abc\\'; SELECT 2", 'SELECT $$abc; SELECT 2',
+                     'SELECT 1 /* a /* b */; SELECT 2']:
+            with self.subTest(code=code):
+                self.assertEqual(_lexer.split(code), [code])
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_spans_cover_the_code(self):
+        code = "SELECT E'\\'', $t$;$t$ -- c\n/* a /* b */ */; 'x"
+        end = 0
+        for _, start, token_end in _lexer.tokenize(code):
+            self.assertEqual(start, end)
+            end = token_end
+        self.assertEqual(end, len(code))
+
+    def test_is_terminated(self):
+        self.assertTrue(_lexer.is_terminated("SELECT 'a', \"b\", $$c$$, E'\\'' /* d /* e */ */"))
+        for code in ["SELECT 'a", 'SELECT "a', 'SELECT $t$ a $$', "SELECT E'a\\'", 'SELECT /* a /* b */']:
+            with self.subTest(code=code):
+                self.assertFalse(_lexer.is_terminated(code))
+
+
+class StripCommentsTest(unittest.TestCase):
+    def test_comments(self):
+        self.assertEqual(_lexer.strip_comments('-- header\nSELECT 1 -- one\nFROM/* a /* nested */ */t'), 'SELECT 1 \nFROM t')
+
+    def test_comment_markers_in_literals(self):
+        code = "SELECT '-- a', \"/* b */\", $$-- c$$, E'\\' -- d'"
+        self.assertEqual(_lexer.strip_comments(code), code)
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_equivalent_queries(self):
+        self.assertEqual(
+            _lexer.normalize("SELECT  A, 'x' FROM T -- comment\nWHERE b = 3.5"),
+            _lexer.normalize("select a,'y' from t where b=42"))
+
+    def test_literals(self):
+        self.assertEqual(_lexer.normalize("SELECT E'\\'', $t$ a $t$, 1e3, .5, x1"), 'select ?,?,?,?,x1')
+
+    def test_quoted_identifiers(self):
+        self.assertNotEqual(_lexer.normalize('SELECT "A" FROM t'), _lexer.normalize('SELECT "a" FROM t'))
+
+
+class FirstKeywordTest(unittest.TestCase):
+    def test_first_keyword(self):
+        self.assertEqual(_lexer.first_keyword('/* c */ ((SELECT 1))'), 'SELECT')
+        self.assertEqual(_lexer.first_keyword('-- c\nwith x AS (SELECT 1) TABLE x'), 'with')
+        self.assertIsNone(_lexer.first_keyword('-- only a comment'))
+        self.assertIsNone(_lexer.first_keyword('; SELECT 1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
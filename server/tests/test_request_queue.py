@@ -0,0 +1,178 @@
+'''
+Per-user request queues (see `db.users.request_queue`), without a database server.
+'''
+
+import asyncio
+import unittest
+from unittest import mock
+
+from server.db.users import engine, request_queue
+
+
+class _FakeConnection:
+    '''The part of `AsyncDBConnection` used to cancel a running request.'''
+
+    def __init__(self):
+        self.cancels = 0
+        self.sent = None
+
+    def cancel(self) -> asyncio.Future:
+        self.cancels += 1
+        self.sent = asyncio.get_running_loop().create_future()
+        return self.sent
+
+
+class RequestQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.username = f'test_request_queue_{id(self)}'
+
+    def tearDown(self):
+        self.assertNotIn(self.username, request_queue._queues)
+
+    async def _start(self, turn: request_queue.Turn) -> list[int]:
+        '''Waits for the turn, returning the positions reported while waiting.'''
+        return [position async for position in turn.wait()]
+
+    def test_requests_run_in_order(self):
+        async def run():
+            order = []
+
+            async def request(name: str, positions: list[int]):
+                turn = request_queue.enqueue(self.username)
+                try:
+                    self.assertEqual(await self._start(turn), positions)
+                    order.append(f'{name} start')
+                    await asyncio.sleep(0.01)
+                    order.append(f'{name} end')
+                finally:
+                    turn.release()
+
+            await asyncio.gather(request('a', []), request('b', [1]), request('c', [2, 1]))
+            return order
+
+        order = engine.run(run())
+        self.assertEqual(order, ['a start', 'a end', 'b start', 'b end', 'c start', 'c end'])
+
+    def test_users_are_independent(self):
+        other = f'{self.username}_other'
+
+        async def run():
+            first = request_queue.enqueue(self.username)
+            second = request_queue.enqueue(other)
+            try:
+                # Both start immediately
+                self.assertEqual(await self._start(first), [])
+                self.assertEqual(await self._start(second), [])
+            finally:
+                first.release()
+                second.release()
+
+        engine.run(run())
+        self.assertNotIn(other, request_queue._queues)
+
+    def test_queue_full(self):
+        async def run():
+            running = request_queue.enqueue(self.username)
+            await self._start(running)
+            waiting = [request_queue.enqueue(self.username) for _ in range(request_queue.MAX_QUEUED_REQUESTS)]
+            try:
+                with self.assertRaises(request_queue.QueueFull):
+                    request_queue.enqueue(self.username)
+            finally:
+                for turn in waiting:
+                    turn.release()
+                running.release()
+
+        with mock.patch.object(request_queue, 'MAX_QUEUED_REQUESTS', 2):
+            engine.run(run())
+
+    def test_cancel_waiting_request(self):
+        async def run():
+            running = request_queue.enqueue(self.username)
+            await self._start(running)
+
+            cancelled = request_queue.enqueue(self.username)
+            last = request_queue.enqueue(self.username)
+            last_positions = asyncio.create_task(self._start(last))
+            await asyncio.sleep(0)
+
+            cancelled.cancel()
+            # The cancelled request leaves the queue, and does not start
+            self.assertEqual(await self._start(cancelled), [])
+            self.assertTrue(cancelled.cancelled)
+            self.assertFalse(cancelled.running)
+            self.assertEqual(list(running.queue.waiting), [last])
+            await asyncio.sleep(0)
+
+            running.release()
+            self.assertEqual(await last_positions, [2, 1])
+            self.assertTrue(last.running)
+            last.release()
+            cancelled.release()
+
+        engine.run(run())
+
+    def test_cancel_running_request(self):
+        async def run():
+            conn = _FakeConnection()
+            running = request_queue.enqueue(self.username)
+            await self._start(running)
+            running.connection = conn
+            waiting = request_queue.enqueue(self.username)
+
+            running.cancel()
+            running.cancel()
+            self.assertEqual(conn.cancels, 1)
+            self.assertTrue(running.cancelled)
+            # Other requests of the user are not affected
+            self.assertFalse(waiting.cancelled)
+
+            # The turn does not end before the cancellation has been sent
+            ended = asyncio.create_task(running.wait_cancel_sent())
+            await asyncio.sleep(0.01)
+            self.assertFalse(ended.done())
+            conn.sent.set_result(None)
+            await ended
+
+            running.release()
+            await self._start(waiting)
+            waiting.release()
+
+        engine.run(run())
+
+    def test_cancel_token(self):
+        token = request_queue.CancelToken()
+        token.cancel()
+
+        async def run():
+            # The token is cancelled on the loop: this runs after it
+            turn = request_queue.enqueue(self.username, token)
+            self.assertTrue(turn.cancelled)
+            self.assertEqual(await self._start(turn), [])
+            turn.release()
+
+        engine.run(run())
+
+    def test_cancel_running_by_username(self):
+        async def start():
+            turn = request_queue.enqueue(self.username)
+            await self._start(turn)
+            turn.connection = _FakeConnection()
+            return turn
+
+        self.assertFalse(request_queue.cancel(self.username))
+
+        turn = engine.run(start())
+        self.assertTrue(request_queue.cancel(self.username))
+        self.assertEqual(turn.connection.cancels, 1)
+
+        async def end():
+            turn.connection.sent.set_result(None)
+            await turn.wait_cancel_sent()
+            turn.release()
+
+        engine.run(end())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+'''
+Write-behind logging into the admin database (see `db.admin._write_behind`), without a database server:
+id allocation and inserts are replaced by fakes that record what would have been written.
+'''
+
+import itertools
+import threading
+import unittest
+from unittest import mock
+
+from psycopg2 import OperationalError
+
+from server.db.admin import _write_behind
+
+ID_BLOCK_SIZE = 3
+# Generous, so that a slow machine does not fail the tests
+FLUSH_TIMEOUT_SECONDS = 10
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        self.id_blocks = 0
+        # (table name, rows) for each insert
+        self.inserts: list[tuple[str, list[tuple]]] = []
+        # Called with the table and the rows before each insert, can raise to make it fail
+        self.before_insert = lambda table, values: None
+
+        def execute_and_fetch(query):
+            with self.lock:
+                self.id_blocks += 1
+                return [(next(self.sequence),) for _ in range(ID_BLOCK_SIZE)]
+
+        def execute(table, values):
+            self.before_insert(table, values)
+            with self.lock:
+                self.inserts.append((table.name, values))
+
+        patches = [
+            mock.patch.object(_write_behind.db, 'execute_and_fetch', side_effect=execute_and_fetch),
+            mock.patch.object(_write_behind.Table, '_execute', autospec=True, side_effect=execute),
+            mock.patch.object(_write_behind, 'ID_BLOCK_SIZE', ID_BLOCK_SIZE),
+            mock.patch.object(_write_behind, 'RETRY_SECONDS', 0.01),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.parents = _write_behind.Table('parents', ['name'])
+        self.children = _write_behind.Table('children', ['parent_id', 'value'], lambda value: (value[0], value[1] * 2))
+        self.log = _write_behind.WriteBehind(self.parents, self.children)
+        self.addCleanup(self.log.close)
+
+    def rows(self, table_name: str) -> list[tuple]:
+        return [row for name, values in self.inserts if name == table_name for row in values]
+
+    def test_ids_are_preallocated_in_blocks(self):
+        ids = [self.log.append(self.parents, (f'p{i}',)) for i in range(7)]
+
+        self.assertEqual(ids, list(range(1, 8)))
+        self.assertEqual(self.id_blocks, 3)
+
+    def test_flush_writes_tables_in_order(self):
+        parent_id = self.log.append(self.parents, ('p',))
+        child_ids = [self.log.append(self.children, (parent_id, i)) for i in range(3)]
+
+        self.assertTrue(self.log.flush(FLUSH_TIMEOUT_SECONDS))
+
+        self.assertEqual(self.rows('parents'), [(parent_id, 'p')])
+        # `to_row` is applied when writing
+        self.assertEqual(self.rows('children'), [(child_id, parent_id, i * 2) for i, child_id in enumerate(child_ids)])
+        # Rows of a table are written after the rows of the tables registered before it
+        self.assertEqual([name for name, _ in self.inserts], ['parents', 'children'])
+        self.assertFalse(self.log.is_pending(self.children, child_ids[0]))
+        self.assertEqual(self.log.stats()['pending'], {'parents': 0, 'children': 0})
+
+    def test_rows_are_kept_while_the_database_is_unreachable(self):
+        failures = iter([OperationalError('connection refused')] * 2)
+
+        def before_insert(table, values):
+            error = next(failures, None)
+            if error is not None:
+                raise error
+        self.before_insert = before_insert
+
+        ids = [self.log.append(self.parents, (f'p{i}',)) for i in range(5)]
+        self.assertTrue(self.log.flush(FLUSH_TIMEOUT_SECONDS))
+
+        # Written once, in order
+        self.assertEqual(self.rows('parents'), [(row_id, f'p{i}') for i, row_id in enumerate(ids)])
+
+    def test_failing_rows_are_discarded(self):
+        def before_insert(table, values):
+            if any(value[1] == 'bad' for value in values):
+                raise ValueError('invalid row')
+        self.before_insert = before_insert
+
+        ids = [self.log.append(self.parents, (name,)) for name in ['a', 'bad', 'c']]
+        self.assertTrue(self.log.flush(FLUSH_TIMEOUT_SECONDS))
+
+        # The bulk insert fails, then rows are inserted one at a time
+        self.assertEqual(self.rows('parents'), [(ids[0], 'a'), (ids[2], 'c')])
+        self.assertFalse(self.log.is_pending(self.parents, ids[1]))
+
+    def test_close_writes_pending_rows(self):
+        row_id = self.log.append(self.parents, ('p',))
+        self.log.close()
+
+        self.assertEqual(self.rows('parents'), [(row_id, 'p')])
+
+
+if __name__ == '__main__':
+    unittest.main()
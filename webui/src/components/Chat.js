@@ -1,6 +1,7 @@
 import { useState } from "react";
 import useAuth from "../hooks/useAuth";
 import MessageBox from "./MessageBox";
+import { readNdjson } from "../utils/ndjson";
 
 
 function Chat({ queryId, success }) {
@@ -29,8 +30,13 @@ function Chat({ queryId, success }) {
         addMessage('Would you like to ask something else?', true);
     }
 
-    function removeLastMessage() {
-        setMessages((prevMessages) => prevMessages.slice(0, -1));
+    function replaceLastMessage(text, messageId = null) {
+        setMessages((prevMessages) => [...prevMessages.slice(0, -1), {
+            text,
+            isFromAssistant: true,
+            isThinking: false,
+            messageId,
+        }]);
     }
 
     function startThinking() {
@@ -38,103 +44,69 @@ function Chat({ queryId, success }) {
         setIsThinking(true);
     }
 
-    function stopThinking() {
-        removeLastMessage();
-        setIsThinking(false);
-    }
-
     function getLastMessageIdx() {
         return messages.filter(m => !m.isFromAssistant).length;
     };
 
-    async function handleDescribeQuery() {
-        addMessage("Describe what my query does", false);
+    // Shows the answer while it is being generated, replacing the "Thinking..." message
+    async function askAssistant(question, endpoint) {
+        addMessage(question, false);
         startThinking();
 
-        const data = await apiRequest('/api/messages/success/describe', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
+        try {
+            const stream = await apiRequest(endpoint, 'POST', {
+                'query_id': queryId,
+                'msg_idx': getLastMessageIdx(),
+            }, { stream: true });
+
+            let text = '';
+            await readNdjson(stream, (item) => {
+                if (item.type === 'chunk') {
+                    text += item.data;
+                    replaceLastMessage(text);
+                } else if (item.type === 'answer') {
+                    replaceLastMessage(item.answer, item.id);
+                } else if (item.type === 'error') {
+                    replaceLastMessage('Sorry, I could not answer your question. Please try again later.');
+                }
+            });
+        } catch (error) {
+            if (error.status === 429) {
+                replaceLastMessage(`Too many requests. Please try again in ${error.retryAfter} seconds.`);
+            } else {
+                replaceLastMessage('Sorry, I could not answer your question. Please try again later.');
+                console.error('Streaming error:', error);
+            }
+        } finally {
+            setIsThinking(false);
+        }
 
-        stopThinking();
-        addMessage(data.answer, true, false, data.id);
         focusOnLastUserMessage();
         addFollowupPrompt();
     }
 
-    async function handleExplainQuery() {
-        addMessage("Explain what each clause in my query is doing", false);
-        startThinking();
-
-        const data = await apiRequest('/api/messages/success/explain', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
+    async function handleDescribeQuery() {
+        await askAssistant("Describe what my query does", '/api/messages/success/describe');
+    }
 
-        stopThinking();
-        addMessage(data.answer, true, false, data.id);
-        focusOnLastUserMessage();
-        addFollowupPrompt();
+    async function handleExplainQuery() {
+        await askAssistant("Explain what each clause in my query is doing", '/api/messages/success/explain');
     }
 
     async function handleExplainError() {
-        addMessage("Explain what this error means", false);
-        startThinking();
-
-        const data = await apiRequest('/api/messages/error/explain', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
-
-        stopThinking();
-        focusOnLastUserMessage();
-        addMessage(data.answer, true, false, data.id);
-        addFollowupPrompt();
+        await askAssistant("Explain what this error means", '/api/messages/error/explain');
     }
 
     async function handleShowExample() {
-        addMessage("Show a simplified example that can cause this problem", false);
-        startThinking();
-
-        const data = await apiRequest('/api/messages/error/example', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
-
-        stopThinking();
-        addMessage(data.answer, true, false, data.id);
-        focusOnLastUserMessage();
-        addFollowupPrompt();
+        await askAssistant("Show a simplified example that can cause this problem", '/api/messages/error/example');
     }
 
     async function handleWhereToLook() {
-        addMessage("Show me which query part is causing this error", false);
-        startThinking();
-
-        const data = await apiRequest('/api/messages/error/locate', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
-
-        stopThinking();
-        addMessage(data.answer, true, false, data.id);
-        focusOnLastUserMessage();
-        addFollowupPrompt();
+        await askAssistant("Show me which query part is causing this error", '/api/messages/error/locate');
     }
 
     async function handleSuggestFix() {
-        addMessage("Suggest a fix for this error", false);
-        startThinking();
-
-        const data = await apiRequest('/api/messages/error/fix', 'POST', {
-            'query_id': queryId,
-            'msg_idx': getLastMessageIdx(),
-        });
-
-        stopThinking();
-        addMessage(data.answer, true, false, data.id);
-        focusOnLastUserMessage();
-        addFollowupPrompt();
+        await askAssistant("Suggest a fix for this error", '/api/messages/error/fix');
     }
 
     function focusOnLastUserMessage() {
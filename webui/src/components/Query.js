@@ -3,6 +3,8 @@ import { useAuth, RequestSizeError } from "../hooks/useAuth";
 
 import "../styles/Query.css";
 
+import { readNdjson } from "../utils/ndjson";
+
 import SqlEditor from "./SqlEditor";
 import QueryResult from "./QueryResult";
 import ButtonShowDataset from "./ButtonShowDataset";
@@ -12,11 +14,30 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
     const [sqlText, setSqlText] = useState('');
     const [isExecuting, setIsExecuting] = useState(false);
     const [result, setResult] = useState([]);
+    const [queuePosition, setQueuePosition] = useState(null);
 
     function displayResult(data) {
         setResult(data);
     }
 
+    function handleStreamItem(item) {
+        // Waiting for previous queries of the same user to complete
+        if (item.type === 'queue') {
+            setQueuePosition(item.position);
+            return;
+        }
+
+        // Not executed, e.g. too many queries waiting
+        if (item.type === 'rejected') {
+            setQueuePosition(null);
+            alert(item.message);
+            return;
+        }
+
+        setQueuePosition(null);
+        setResult(prev => [...prev, item]);
+    }
+
     // Show a confirmation dialog when the user tries to leave the page with unsaved changes
     useEffect(() => {
         const handleBeforeUnload = (e) => {
@@ -46,40 +67,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 'exercise_id': exerciseId,
             }, { stream: true });
 
-            const reader = stream.getReader();
-            const decoder = new TextDecoder();
-            let buffer = '';
-
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                if (value) {
-                    buffer += decoder.decode(value, { stream: true });
-
-                    let lines = buffer.split('\n');
-                    buffer = lines.pop(); // Keep last partial line
-
-                    for (let line of lines) {
-                        if (line.trim() === '') continue;
-                        try {
-                            const parsed = JSON.parse(line);
-                            setResult(prev => [...prev, parsed]);
-                        } catch (e) {
-                            console.error('Failed to parse line:', line);
-                        }
-                    }
-                }
-            }
-
-            if (buffer.trim() !== '') {
-                try {
-                    const parsed = JSON.parse(buffer);
-                    setResult(prev => [...prev, parsed]);
-                } catch (e) {
-                    console.error('Failed to parse last buffer:', buffer);
-                }
-            }
-
+            await readNdjson(stream, handleStreamItem);
         } catch (error) {
             if (error instanceof RequestSizeError) {
                 alert(`Query too large. Please try to split it into smaller parts. You need to remove at least ${error.size - error.maxSize} characters.`);
@@ -88,59 +76,34 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 console.error('Streaming error:', error);
             }
         } finally {
+            setQueuePosition(null);
             setIsExecuting(false);
         }
     }
 
 
-    async function handleShowSearchPath() {
+    async function handleBuiltin(command) {
         setIsExecuting(true);
 
-        const data = await apiRequest('/api/queries/builtin/show-search-path', 'POST', {
+        const data = await apiRequest(`/api/queries/builtin/${command}`, 'POST', {
             'exercise_id': exerciseId,
         });
         setIsExecuting(false);
-        displayResult(data);
-    }
-
-    async function handleListSchemas() {
-        setIsExecuting(true);
-
-        const data = await apiRequest('/api/queries/builtin/list-schemas', 'POST', {
-            'exercise_id': exerciseId,
-        });
-        setIsExecuting(false);
-        displayResult(data);
-    }
-
-    async function handleListTables() {
-        setIsExecuting(true);
 
-        const data = await apiRequest('/api/queries/builtin/list-tables', 'POST', {
-            'exercise_id': exerciseId,
-        });
-        setIsExecuting(false);
-        displayResult(data);
-    }
-
-    async function handleListAllTables() {
-        setIsExecuting(true);
+        // Not executed, e.g. too many queries waiting
+        if (!Array.isArray(data)) {
+            alert(data.message);
+            return;
+        }
 
-        const data = await apiRequest('/api/queries/builtin/list-all-tables', 'POST', {
-            'exercise_id': exerciseId,
-        });
-        setIsExecuting(false);
         displayResult(data);
     }
 
-    async function handleListConstraints() {
-        setIsExecuting(true);
-
-        const data = await apiRequest('/api/queries/builtin/list-constraints', 'POST', {
-            'exercise_id': exerciseId,
+    async function handleComplete(prefix) {
+        const data = await apiRequest('/api/queries/complete', 'POST', {
+            'prefix': prefix,
         });
-        setIsExecuting(false);
-        displayResult(data);
+        return data.completions || [];
     }
 
     function handleClearOutput() {
@@ -156,44 +119,12 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 'exercise_id': exerciseId,
             }, { stream: true });
 
-            const reader = stream.getReader();
-            const decoder = new TextDecoder();
-            let buffer = '';
-
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                if (value) {
-                    buffer += decoder.decode(value, { stream: true });
-
-                    let lines = buffer.split('\n');
-                    buffer = lines.pop(); // Keep last partial line
-
-                    for (let line of lines) {
-                        if (line.trim() === '') continue;
-                        try {
-                            const parsed = JSON.parse(line);
-                            setResult(prev => [...prev, parsed]);
-                        } catch (e) {
-                            console.error('Failed to parse line:', line);
-                        }
-                    }
-                }
-            }
-
-            if (buffer.trim() !== '') {
-                try {
-                    const parsed = JSON.parse(buffer);
-                    setResult(prev => [...prev, parsed]);
-                } catch (e) {
-                    console.error('Failed to parse last buffer:', buffer);
-                }
-            }
-
+            await readNdjson(stream, handleStreamItem);
         } catch (error) {
             alert('Error when creating dataset. See console for details.\nIf the dataset is very large, you can try manually executing commands in smaller batches.');
             console.error('Streaming error:', error);
         } finally {
+            setQueuePosition(null);
             setIsExecuting(false);
         }
     }
@@ -219,7 +150,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 />
             </div>
 
-            <SqlEditor onChange={setSqlText} onSubmit={handleExecute} />
+            <SqlEditor onChange={setSqlText} onSubmit={handleExecute} onComplete={handleComplete} />
 
             <div className="mt-3 support-buttons">
                 <button
@@ -233,7 +164,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 <button
                     className="btn btn-secondary me-1"
                     disabled={isExecuting}
-                    onClick={handleShowSearchPath}
+                    onClick={() => handleBuiltin('show-search-path')}
                 >
                     Show Search Path
                 </button>
@@ -241,7 +172,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 <button
                     className="btn btn-secondary me-1"
                     disabled={isExecuting}
-                    onClick={handleListSchemas}
+                    onClick={() => handleBuiltin('list-schemas')}
                 >
                     List Schemas
                 </button>
@@ -260,7 +191,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                         <li>
                             <button
                                 className="dropdown-item"
-                                onClick={handleListTables}
+                                onClick={() => handleBuiltin('list-tables')}
                             >
                                 Current Schema
                             </button>
@@ -268,7 +199,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                         <li>
                             <button
                                 className="dropdown-item"
-                                onClick={handleListAllTables}
+                                onClick={() => handleBuiltin('list-all-tables')}
                             >
                                 All Schemas
                             </button>
@@ -279,7 +210,7 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 <button
                     className="btn btn-secondary me-1"
                     disabled={isExecuting}
-                    onClick={handleListConstraints}
+                    onClick={() => handleBuiltin('list-constraints')}
                 >
                     List Constraints
                 </button>
@@ -293,6 +224,14 @@ function Query({ exerciseId, exerciseTitle, exerciseText, datasetId }) {
                 </button>
             </div>
 
+            {
+                queuePosition && (
+                    <div className="alert alert-info mt-3">
+                        Waiting for your previous queries to complete (position in queue: {queuePosition})
+                    </div>
+                )
+            }
+
             <div className="mt-3">
                 {
                     result.map((val, index) => (
@@ -1,10 +1,20 @@
 import '../styles/SqlEditor.css';
 
-import { useRef } from 'react';
+import { useEffect, useRef } from 'react';
 import Editor from '@monaco-editor/react';
 
-const SqlEditor = ({ onChange, onSubmit }) => {
+const SqlEditor = ({ onChange, onSubmit, onComplete }) => {
     const editorRef = useRef(null);
+    const completionProviderRef = useRef(null);
+
+    // The completion provider is registered once: always call the latest callback
+    const onCompleteRef = useRef(onComplete);
+    onCompleteRef.current = onComplete;
+
+    // Completion providers are global: remove ours when the editor is removed
+    useEffect(() => {
+        return () => completionProviderRef.current?.dispose();
+    }, []);
 
     const handleEditorDidMount = (editor, monaco) => {
         editorRef.current = editor;
@@ -15,6 +25,50 @@ const SqlEditor = ({ onChange, onSubmit }) => {
         // Run the query when the user presses Ctrl + Enter
         editor.addCommand(monaco.KeyMod.CtrlCmd | monaco.KeyCode.Enter, onSubmit);
 
+        // Suggest names from the user's database
+        if (onComplete) {
+            const kinds = {
+                schema: monaco.languages.CompletionItemKind.Module,
+                table: monaco.languages.CompletionItemKind.Class,
+                view: monaco.languages.CompletionItemKind.Interface,
+                column: monaco.languages.CompletionItemKind.Field,
+                function: monaco.languages.CompletionItemKind.Function,
+            };
+
+            completionProviderRef.current = monaco.languages.registerCompletionItemProvider('sql', {
+                triggerCharacters: ['.'],
+                provideCompletionItems: async (model, position) => {
+                    // Current word, including the qualifier (e.g. `table.col`)
+                    const line = model.getLineContent(position.lineNumber).substring(0, position.column - 1);
+                    const prefix = line.match(/[A-Za-z0-9_$.]*$/)[0];
+
+                    let completions = [];
+                    try {
+                        completions = await onCompleteRef.current(prefix);
+                    } catch (error) {
+                        console.error('Completion error:', error);
+                    }
+
+                    const range = {
+                        startLineNumber: position.lineNumber,
+                        endLineNumber: position.lineNumber,
+                        startColumn: position.column - prefix.length,
+                        endColumn: position.column,
+                    };
+
+                    return {
+                        suggestions: completions.map(completion => ({
+                            label: completion.name,
+                            kind: kinds[completion.kind],
+                            detail: completion.detail,
+                            insertText: completion.name,
+                            range: range,
+                        })),
+                    };
+                },
+            });
+        }
+
         // Focus the editor, allowing the user to start typing immediately
         editorRef.current.focus();
     };
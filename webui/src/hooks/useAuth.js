@@ -87,6 +87,7 @@ function AuthProvider({ children }) {
         if (!response.ok) {
             const error = new Error(`HTTP error ${response.status}`);
             error.status = response.status;
+            error.retryAfter = response.headers.get('Retry-After');
             throw error;
         }
 
@@ -0,0 +1,33 @@
+// Reads a stream of newline-delimited JSON objects, calling `onItem` for each of them as soon as it arrives.
+// Empty lines (sent by the server to keep the connection alive) are ignored.
+export async function readNdjson(stream, onItem) {
+    const reader = stream.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    function handleLine(line) {
+        if (line.trim() === '') return;
+        try {
+            onItem(JSON.parse(line));
+        } catch (e) {
+            console.error('Failed to parse line:', line);
+        }
+    }
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        if (value) {
+            buffer += decoder.decode(value, { stream: true });
+
+            let lines = buffer.split('\n');
+            buffer = lines.pop(); // Keep last partial line
+
+            for (let line of lines) {
+                handleLine(line);
+            }
+        }
+    }
+
+    handleLine(buffer);
+}